@@ -94,6 +94,11 @@ const apiData: { [key: string]: APIDescription } ={
                 type: "string",
                 description: "The image of the pod to create from (e.g. ubuntu2204-cuda12.1:latest)"
             }, 
+            job: {
+                type: "boolean",
+                optional: true,
+                description: "Run as a background job and return the job id right away, see /job/status and /job/wait"
+            }
         },
         example: {
             input: {ins: "myins", image: "ubuntu2204-cuda12.1:latest"},
@@ -108,6 +113,11 @@ const apiData: { [key: string]: APIDescription } ={
             ins: {
                 type: "string",
                 description: "The instance to delete"
+            },
+            job: {
+                type: "boolean",
+                optional: true,
+                description: "Run as a background job and return the job id right away, see /job/status and /job/wait"
             }
         }
     },
@@ -127,6 +137,37 @@ const apiData: { [key: string]: APIDescription } ={
         }
     },
 
+    "/pod/inspect-many": {
+        method: "GET",
+        description: "Get the information of many pods at once, admin gets all containers, other users get their own pods",
+        parameters: {
+            users: {
+                type: "string",
+                optional: true,
+                description: "Comma separated usernames to filter the pods (admin only)"
+            },
+            status: {
+                type: "string",
+                optional: true,
+                description: "Comma separated container status to filter the pods, e.g. running,exited"
+            },
+            image: {
+                type: "string",
+                optional: true,
+                description: "Image name to filter the pods, a name without tag matches all tags of the image"
+            },
+            fields: {
+                type: "string",
+                optional: true,
+                description: "Comma separated fields of each record, e.g. name,status,gpu_ids, all fields by default"
+            }
+        },
+        example: {
+            input: {status: "running", fields: "instance,status,gpu_ids"},
+            output: [{'instance': 'test', 'status': 'running', 'gpu_ids': [0, 1]}, {'instance': 'dev', 'status': 'running', 'gpu_ids': []}]
+        }
+    },
+
     "/pod/list": {
         method: "GET",
         description: "List all pods for the user",
@@ -161,6 +202,80 @@ const apiData: { [key: string]: APIDescription } ={
             }
         },
     },
+    "/pod/logs": {
+        method: "GET",
+        description: "Get the container log of a pod, the lifecycle actions (start, stop, restart) only return the last 100 lines",
+        parameters: {
+            ins: {
+                type: "string",
+                description: "The instance to get the log of"
+            },
+            tail: {
+                type: "number",
+                optional: true,
+                description: "Number of lines from the end, -1 for all, default 100"
+            },
+            since: {
+                type: "string",
+                optional: true,
+                description: "Only the log after this time, epoch seconds or a duration before now, e.g. 10m, 2h, 7d"
+            },
+            until: {
+                type: "string",
+                optional: true,
+                description: "Only the log before this time, same format as since"
+            },
+            max_bytes: {
+                type: "number",
+                optional: true,
+                description: "The log is cut to this many bytes from the end, at most 16MiB, default 1MiB"
+            },
+            timestamps: {
+                type: "boolean",
+                optional: true,
+                description: "Prefix each line with its timestamp, default false"
+            },
+            follow: {
+                type: "boolean",
+                optional: true,
+                description: "Stream the log as newline-delimited json frames {stream, data} until the container stops, default false"
+            }
+        },
+        example: {
+            input: {ins: "myins", tail: 2},
+            output: `{log: " * Starting OpenBSD Secure Shell server sshd\\n   ...done.\\n", truncated: false}`
+        }
+    },
+    "/pod/batch": {
+        method: "POST",
+        description: "Run lifecycle actions on many pods, the actions run concurrently and a failed item does not abort the others",
+        parameters: {
+            items: {
+                type: "string",
+                description: "Comma separated items in the form of action:ins, action is one of start, stop, restart, delete, at most 256 items"
+            },
+            concurrency: {
+                type: "number",
+                optional: true,
+                description: "Max actions running at the same time, at most 16, default 4"
+            },
+            logs: {
+                type: "boolean",
+                optional: true,
+                description: "Include the container logs after each action, default false"
+            }
+        },
+        example: {
+            input: {items: "stop:ins1,restart:ins2"},
+            output: `{
+    ok: 1, failed: 1,
+    results: [
+        {action: "stop", ins: "ins1", pod: "pd-user-ins1", ok: true, log: "Container pd-user-ins1 stop"},
+        {action: "restart", ins: "ins2", pod: "pd-user-ins2", ok: false, status: 404, error: "Container pd-user-ins2 not found"}
+    ]
+}`
+        }
+    },
     "/pod/restart": {
         method: "POST",
         description: "Restart a pod",
@@ -180,7 +295,8 @@ const apiData: { [key: string]: APIDescription } ={
         description: 
             "Execute a command in a pod, the command will be executed as root user using bash. " +
             "The default timeout is 30 seconds, long-running task will be terminated after the timeout. " +
-            "If you want to run a long-running task, please set the timeout to a larger value.", 
+            "If you want to run a long-running task, please set the timeout to a larger value. " +
+            "The number of concurrent commands of a user is limited by the server configuration.", 
         parameters: {
             ins: {
                 type: "string",
@@ -202,6 +318,34 @@ const apiData: { [key: string]: APIDescription } ={
         }
     }, 
 
+    "/pod/exec-stream": {
+        method: "POST",
+        description: 
+            "Execute a command in a pod and stream the output, same as /pod/exec but the response is " + 
+            "newline-delimited JSON frames sent as the command runs: {stream: 'stdout' | 'stderr', data: string}, " + 
+            "the last frame carries the exit code: {exit_code: number, error?: string}. " + 
+            "The command is executed without tty, so stdout and stderr are separated. ", 
+        parameters: {
+            ins: {
+                type: "string",
+                description: "The instance id of the pod to execute command"
+            }, 
+            cmd: {
+                type: "string",
+                description: "The command to execute"
+            }, 
+            timeout: {
+                type: "number",
+                description: "The timeout of the command in seconds, default is 30",
+                optional: true
+            }
+        },
+        example: {
+            input: {ins: "myins", cmd: "pwd"},
+            output: `{"stream": "stdout", "data": "/workspace\\n"}\n{"exit_code": 0}`
+        }
+    }, 
+
     "/pod/commit": {
         method: "POST",
         description: "Commit a pod to an image, the image will be saved as <pody-commit-prefix>:<username>[-<tag>]. " + 
@@ -221,6 +365,11 @@ const apiData: { [key: string]: APIDescription } ={
                 type: "string",
                 description: "The commit message, this will be used as the image comment", 
                 optional: true 
+            },
+            job: {
+                type: "boolean",
+                optional: true,
+                description: "Run as a background job and return the job id right away, see /job/status and /job/wait"
             }
         },
         example: {
@@ -295,10 +444,15 @@ const apiData: { [key: string]: APIDescription } ={
             }, 
             "t": {
                 type: "string",
-                description: "The start time of the process to include in the statistics, " +
+                description: "The time range of the statistics, only the usage consumed within the range is counted, " +
                 "should be like: 1y, 1w, 1d, 1h, 1s, or a timestamp in seconds. " +
                 "If not provided, will include all time ranges. ",
                 optional: true
+            }, 
+            "group_by": {
+                type: "string",
+                description: "How to group the CPU time, can be 'user' (default), 'pod', or 'day' (UTC date)",
+                optional: true
             }
         },
         example: {
@@ -323,9 +477,14 @@ const apiData: { [key: string]: APIDescription } ={
             }, 
             "t": {
                 type: "string",
-                description: "The start time of the process to include in the statistics, " +
+                description: "The time range of the statistics, only the usage consumed within the range is counted, " +
                 "should be like: 1y, 1w, 1d, 1h, 1s, or a timestamp in seconds. " +
-                "If not provided, will include all time ranges", 
+                "If not provided, will include all time ranges. ",
+                optional: true
+            }, 
+            "group_by": {
+                type: "string",
+                description: "How to group the GPU time, can be 'user' (default), 'pod', or 'day' (UTC date)",
                 optional: true
             }
         },
@@ -368,6 +527,52 @@ const apiData: { [key: string]: APIDescription } ={
         }
     },
 
+    "/host/daemon-stats": {
+        method: "GET",
+        description: "Get the run statistics of the periodic server tasks (admin only). last_lag is the delay of the last run after its scheduled time, skipped counts the runs skipped because the previous one was still running. Times are in seconds",
+        example: {
+            input: {},
+            output: {
+                "pid": 12345,
+                "time": 1718000000.0,
+                "tasks": {
+                    "enforce_gpu_quota": {
+                        "interval": 5, "runs": 1440, "errors": 0, "skipped": 0, "running": false,
+                        "last_start": 1717999998.1, "last_duration": 0.12, "last_lag": 0.001, "max_lag": 0.004, "last_error": ""
+                    }, 
+                    "record_resource_usage": {
+                        "interval": 60, "runs": 120, "errors": 0, "skipped": 1, "running": false,
+                        "last_start": 1717999985.3, "last_duration": 1.8, "last_lag": 0.001, "max_lag": 0.003, "last_error": ""
+                    }
+                }
+            }
+        }
+    }, 
+
+    "/host/gpu-enforcement": {
+        method: "GET",
+        description: "Get the latest GPU quota enforcement decisions, newest first (admin only). A container of a user over the GPU quota is warned, stopped after the grace period, and killed if it still uses GPUs; resolve means it is back within the quota or gone",
+        parameters: {
+            "user": {
+                type: "string",
+                description: "Only show the decisions of this user",
+                optional: true
+            },
+            "limit": {
+                type: "number",
+                description: "The maximum number of decisions to return, default 100",
+                optional: true
+            }
+        },
+        example: {
+            input: {user: "alice"},
+            output: [
+                {"time": 1718000035.2, "action": "stop", "container": "alice-exp", "username": "alice", "gpus": [0, 1, 2], "quota": 2, "reason": "user over GPU quota for 30s, 3 GPUs used, quota 2"},
+                {"time": 1718000005.1, "action": "warn", "container": "alice-exp", "username": "alice", "gpus": [0, 1, 2], "quota": 2, "reason": "user over GPU quota, 3 GPUs used, quota 2, stopping in 30s"}
+            ]
+        }
+    }, 
+
     "/host/spec": {
         method: "GET",
         description: "Get the specification of the node",
@@ -384,7 +589,7 @@ const apiData: { [key: string]: APIDescription } ={
 
     "/help": {
         method: "GET",
-        description: "Get the help for a endpoint",
+        description: "Get the help for a endpoint, without path the full route table is returned with an ETag, send it back in If-None-Match to get 304 if unchanged",
         parameters: {
             "path": {
                 type: "string",
@@ -403,9 +608,67 @@ const apiData: { [key: string]: APIDescription } ={
         } 
     },
 
+    "/job/status": {
+        method: "GET",
+        description: "Get the status of a job, status is one of queued, running, done, failed, " + 
+            "result is the response of the operation when done, error and error_code (HTTP status) when failed",
+        parameters: {
+            id: {
+                type: "string",
+                description: "The job id"
+            }
+        },
+        example: {
+            input: {id: "3f2c9a0d5b6e4d7f8a1b2c3d4e5f6a7b"},
+            output: {
+                'id': '3f2c9a0d5b6e4d7f8a1b2c3d4e5f6a7b', 'kind': 'commit', 'username': 'limengxun',
+                'params': {'ins': 'myins', 'tag': 'latest', 'msg': null}, 'status': 'done',
+                'result': {'image_name': 'pody-commit:limengxun-latest', 'log': '...'}, 'error': null, 'error_code': null,
+                'created': 1750000000.0, 'started': 1750000000.1, 'finished': 1750000042.5
+            }
+        }
+    },
+
+    "/job/wait": {
+        method: "GET",
+        description: "Wait until the job is finished or the timeout is reached, return the job status as /job/status",
+        parameters: {
+            id: {
+                type: "string",
+                description: "The job id"
+            },
+            timeout: {
+                type: "number",
+                optional: true,
+                description: "Seconds to wait, at most 300, default 30"
+            }
+        },
+    },
+
+    "/job/list": {
+        method: "GET",
+        description: "List the latest jobs of the user, of all users for admin",
+        parameters: {
+            limit: {
+                type: "number",
+                optional: true,
+                description: "Max number of jobs, default 20"
+            }
+        },
+    },
+
     "/version": {
         method: "GET",
         description: "Get the version of the API",
+    }, 
+
+    "/metrics": {
+        method: "GET",
+        description: "Get the metrics of the server and daemon processes in the Prometheus text format, e.g. request latency by route, docker API call latency, GPU sampling time, daemon task duration and SQLite time (admin only)",
+        example: {
+            input: {},
+            output: '# HELP pody_http_request_duration_seconds HTTP request latency by route template and status\n# TYPE pody_http_request_duration_seconds histogram\npody_http_request_duration_seconds_bucket{method="GET",route="/pod/list",status="200",le="0.005"} 12\n...'
+        }
     }
 }
 
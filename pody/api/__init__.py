@@ -1,9 +1,15 @@
 from __future__ import annotations
 import os
 import sys
+import json
+import time
+import hashlib
+import pathlib
 import requests, urllib.parse
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from typing import Any, Optional, Literal
+from urllib3.util.retry import Retry
+from typing import Any, Iterator, Optional, Literal
 
 if sys.version_info >= (3, 11):
     from typing import Self
@@ -42,14 +48,26 @@ def handle_request_error(response: requests.Response, ctx: Optional[dict] = None
         error_context=ctx,
     )
 
+CACHE_HOME = pathlib.Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))) / "pody"
+
 num_t = int | float
 class PodyAPI:
+    """
+    Client of the Pody API, requests share one keep-alive session with a connection pool,
+    - pool_size: max connections kept to the server
+    - retries: retries on connection errors and 502/503/504 (idempotent methods only)
+    - help_cache_ttl: seconds the cached route table is used without revalidation
+    The session is closed with `close` or when used as a context manager.
+    """
 
     def __init__(
         self, 
         api_base: Optional[str] = None, 
         username: Optional[str] = None,
         password: Optional[str] = None,
+        pool_size: int = 10,
+        retries: int = 3,
+        help_cache_ttl: float = 600,
     ):
         self.api_base: str = api_base or os.getenv("PODY_API_BASE", "")
         self.username: str = username or os.getenv("PODY_USERNAME", "")
@@ -57,10 +75,29 @@ class PodyAPI:
         if not self.api_base: raise ValueError("$PODY_API_BASE not set.")
         if not self.username: raise ValueError("$PODY_USERNAME not set.")
         if not self.password: raise ValueError("$PODY_PASSWORD not set.")
+        self.api_base = self.api_base.rstrip('/')
         self._config = {
             "timeout": None,
             "verify": None,
         }
+        self.help_cache_ttl = help_cache_ttl
+        self._routes: Optional[list[dict]] = None
+
+        self._session = requests.Session()
+        self._session.auth = HTTPBasicAuth(self.username, self.password)
+        retry = Retry(total=retries, backoff_factor=0.2, status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
     
     def config(
         self, 
@@ -83,15 +120,14 @@ class PodyAPI:
             else: url += "?" + urllib.parse.urlencode(search_params)
             headers: dict = kwargs.pop('headers', {})
             headers.update(extra_headers)
-            with requests.Session() as s:
-                response = s.request(
-                    method, url, headers=headers, auth=HTTPBasicAuth(self.username, self.password),
-                    timeout=self._config["timeout"], verify=self._config["verify"], **kwargs
-                    )
-                try:
-                    response.raise_for_status()
-                except requests.HTTPError:
-                    handle_request_error(response, {"METHOD": method, "URL": url, "PARAMS": search_params})
+            response = self._session.request(
+                method, url, headers=headers,
+                timeout=self._config["timeout"], verify=self._config["verify"], **kwargs
+                )
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                handle_request_error(response, {"METHOD": method, "URL": url, "PARAMS": search_params})
             return response
         return f
     
@@ -101,10 +137,83 @@ class PodyAPI:
     def post(self, path: str, search_params: dict = {}, extra_headers: dict = {}):
         return self._fetch_factory('POST', path, search_params, extra_headers)().json()
     
+    def _stream(self, method: Literal['GET', 'POST'], path: str, search_params: dict = {}, extra_headers: dict = {}) -> Iterator[dict]:
+        path = path[1:] if path.startswith('/') else path
+        url = f"{self.api_base}/{path}?" + urllib.parse.urlencode(search_params)
+        with self._session.request(
+            method, url, headers=extra_headers,
+            timeout=self._config["timeout"], verify=self._config["verify"], stream=True
+            ) as response:
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                handle_request_error(response, {"METHOD": method, "URL": url, "PARAMS": search_params})
+            for line in response.iter_lines():
+                if line: yield json.loads(line)
+
+    def get_stream(self, path: str, search_params: dict = {}, extra_headers: dict = {}) -> Iterator[dict]:
+        """ GET from a streaming endpoint, yield the newline-delimited json frames as they arrive """
+        return self._stream('GET', path, search_params, extra_headers)
+    
+    def post_stream(self, path: str, search_params: dict = {}, extra_headers: dict = {}) -> Iterator[dict]:
+        """ POST to a streaming endpoint, yield the newline-delimited json frames as they arrive """
+        return self._stream('POST', path, search_params, extra_headers)
+
+    @property
+    def _help_cache_path(self) -> pathlib.Path:
+        key = hashlib.sha1(f"{self.api_base}|{self.username}".encode()).hexdigest()[:16]
+        return CACHE_HOME / f"help-{key}.json"
+
+    def routes(self, revalidate: bool = False) -> list[dict]:
+        """
+        The route table of the server (`/help` without path), cached in memory and on disk,
+        the disk cache is keyed by the ETag of the server, which includes the server version.
+        It is used as is within `help_cache_ttl`, then revalidated with a conditional request.
+        """
+        if self._routes is not None and not revalidate:
+            return self._routes
+        cache_path = self._help_cache_path
+        try:
+            cached = json.loads(cache_path.read_text())
+        except (OSError, ValueError):
+            cached = None
+        if cached and not revalidate and time.time() - cached["time"] < self.help_cache_ttl:
+            self._routes = cached["routes"]
+            return self._routes
+
+        headers = {"If-None-Match": cached["etag"]} if cached else {}
+        response = self._fetch_factory('GET', '/help')(headers=headers)
+        if response.status_code == 304 and cached:
+            routes = cached["routes"]
+        else:
+            routes = response.json()
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps({"etag": response.headers.get("ETag", ""), "time": time.time(), "routes": routes}))
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass
+        self._routes = routes
+        return routes
+
+    def help(self, path: Optional[str] = None) -> list[dict]:
+        """ Help info of the path from the cached route table, same as `/help`, a path ending with / lists the sub-routes """
+        routes = self.routes()
+        if path is None:
+            return routes
+        path = '/' + path if not path.startswith('/') else path
+        path = path.split("?")[0]
+        return [r for r in routes if (path.endswith("/") and r["path"].startswith(path)) or r["path"] == path]
+    
     def fetch_auto(self, path: str, search_params: dict = {}, extra_headers: dict = {}):
         """ Perform an automatic GET or POST request based on the path.  """
         path = '/' + path if not path.startswith('/') else path
-        help_list = self.get('/help', {"path": path})
+        help_list = self.help(path)
+        if len(help_list) == 0:
+            # the cached table may be stale, e.g. the server was upgraded within the TTL
+            self.routes(revalidate=True)
+            help_list = self.help(path)
         if len(help_list) == 0: raise ValueError(f"Path not found: {path}")
         if len(help_list) > 1: raise ValueError(f"Ambiguous path: {path}")
 
@@ -114,4 +223,4 @@ class PodyAPI:
         match endpoint['methods'][0]:
             case 'GET': return self.get(path, search_params, extra_headers)
             case 'POST': return self.post(path, search_params, extra_headers)
-            case _: raise ValueError(f"Method not supported: {endpoint['methods']}")
\ No newline at end of file
+            case _: raise ValueError(f"Method not supported: {endpoint['methods']}")
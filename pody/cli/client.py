@@ -254,27 +254,126 @@ def connect(
     os.execvp("ssh", ssh_cmd)
     
 
+@app.command(
+    no_args_is_help=True, 
+    help = f"Execute a command in the instance and stream the output, e.g. {cli_command()} exec myins 'nvidia-smi'",
+    rich_help_panel="Utility"
+    )
+@handle_request_error()
+def exec(
+    ins: str = typer.Argument(help="Instance name to execute the command in"),
+    cmd: List[str] = typer.Argument(help="The command to execute, joined by space"),
+    timeout: Optional[int] = typer.Option(None, '-t', '--timeout', help="Timeout of the command in seconds"),
+    ):
+    if ins.startswith("ins:") or ins.startswith("ins="):
+        ins = ins[4:]
+    params: dict = {"ins": ins, "cmd": ' '.join(cmd)}
+    if timeout is not None: params["timeout"] = timeout
+    exit_code = -1
+    for frame in PodyAPI().post_stream("/pod/exec-stream", params):
+        if 'exit_code' in frame:
+            exit_code = frame['exit_code']
+            if frame.get('error'): console.print(f"[bold red]Error - {frame['error']}")
+            break
+        out = sys.stderr if frame['stream'] == 'stderr' else sys.stdout
+        out.write(frame['data'])
+        out.flush()
+    exit(exit_code if exit_code >= 0 else 1)
+
+@app.command(
+    no_args_is_help=True, 
+    help = f"Show the container log of the instance, e.g. {cli_command()} logs myins -n 50 -f",
+    rich_help_panel="Utility"
+    )
+@handle_request_error()
+def logs(
+    ins: str = typer.Argument(help="Instance name to show the log of"),
+    tail: int = typer.Option(100, '-n', '--tail', help="Number of lines from the end, -1 for all"),
+    follow: bool = typer.Option(False, '-f', '--follow', help="Keep streaming the log as it is written"),
+    since: Optional[str] = typer.Option(None, '--since', help="Only the log after this time, epoch seconds or a duration like 10m, 2h"),
+    until: Optional[str] = typer.Option(None, '--until', help="Only the log before this time, epoch seconds or a duration like 10m, 2h"),
+    timestamps: bool = typer.Option(False, '-t', '--timestamps', help="Show the timestamp of each line"),
+    ):
+    if ins.startswith("ins:") or ins.startswith("ins="):
+        ins = ins[4:]
+    params: dict = {"ins": ins, "tail": tail, "timestamps": timestamps}
+    if since: params["since"] = since
+    if until: params["until"] = until
+    api = PodyAPI()
+    if not follow:
+        res = api.get("/pod/logs", params)
+        if res['truncated']:
+            console.print("[yellow](log truncated, use --tail / --since to narrow it down)", highlight=False)
+        sys.stdout.write(res['log'])
+        return
+    try:
+        for frame in api.get_stream("/pod/logs", {**params, "follow": True}):
+            out = sys.stderr if frame['stream'] == 'stderr' else sys.stdout
+            out.write(frame['data'])
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+
+@app.command(
+    no_args_is_help=True, 
+    help = f"Run lifecycle actions on many pods in one request, e.g. {cli_command()} batch stop:pod1 restart:pod2, or {cli_command()} batch -a stop pod1 pod2",
+    rich_help_panel="Utility"
+    )
+@handle_request_error()
+def batch(
+    items: List[str] = typer.Argument(help="Items in the form of action:ins, action is one of start, stop, restart, delete"),
+    action: Optional[str] = typer.Option(None, '-a', '--action', help="Action for the items given as bare instance names"),
+    concurrency: int = typer.Option(4, '-c', '--concurrency', help="Max actions running at the same time on the server"),
+    logs: bool = typer.Option(False, '--logs', help="Include the container logs after each action"),
+    raw: bool = typer.Option(False, '--raw', help="Print the raw JSON response"),
+    ):
+    def to_item(it: str) -> str:
+        if ':' in it: return it
+        if action is None: raise ValueError(f"Invalid item: {it}, the format should be action:ins, or set --action")
+        return f"{action}:{it}"
+    params = {"items": ','.join(map(to_item, items)), "concurrency": concurrency, "logs": logs}
+    res = PodyAPI().post("/pod/batch", params)
+    if raw:
+        print(json.dumps(res))
+    else:
+        table = Table(title=None, show_header=True)
+        table.add_column("Action", style="magenta")
+        table.add_column("Pod", style="cyan")
+        table.add_column("Result")
+        for r in res['results']:
+            result = "[green]ok" if r['ok'] else f"[red]{r['status']} - {r['error']}"
+            table.add_row(r['action'], r.get('pod', r['ins']), result)
+        console.print(table)
+        if logs:
+            for r in res['results']:
+                if r['ok']: console.print(f"[bold]{r['pod']}[/bold]\n{r['log']}")
+        console.print(f"{res['ok']} succeeded, {res['failed']} failed")
+    if res['failed']: exit(1)
+
 class StatType(str, Enum):
     cputime = 'cputime'
     gputime = 'gputime'
+class StatGroupBy(str, Enum):
+    user = 'user'
+    pod = 'pod'
+    day = 'day'
 @app.command(rich_help_panel="Utility")
 @handle_request_error()
 def stat(
     resouce_type: StatType, 
-    time_limit = typer.Argument(None, help="Only consider statistics after this time, can be like: 1y, 1w, 1d, 1h...")
+    time_limit = typer.Argument(None, help="Only count the usage within this time, can be like: 1y, 1w, 1d, 1h..."), 
+    group_by: StatGroupBy = typer.Option(StatGroupBy.user, '-g', '--group-by', help="Group the statistics by user, pod or day"),
 ):
     """
     Display the statistics of the resource usage, e.g. CPU time or GPU time.
-
-    NOTE: The time limit indicates the time after which the processes are started, 
-    which means if a process runs for a long time, and you specify a time limit short, 
-    it may not be counted in the statistics.
     """
     dst = f"/stat/{resouce_type.value}"
-    r: dict[str, float] = PodyAPI().get(dst, {"t": time_limit} if time_limit else {})
+    params = {"group_by": group_by.value}
+    if time_limit: params["t"] = time_limit
+    r: dict[str, float] = PodyAPI().get(dst, params)
 
     table = Table(title=f"{resouce_type.value} statistics", show_header=True, show_lines=True)
-    table.add_column("User", style="cyan")
+    table.add_column(group_by.value.capitalize(), style="cyan")
     table.add_column("Time", style="green")
     table.add_column("Chart", style="magenta")
     max_val = max(r.values(), default=0)
@@ -287,11 +386,12 @@ def stat(
         d_sec = int(sec // 86400)
         return f"{d_sec}d {h_sec}h {m_sec}m {s_sec}s" if d_sec > 0 else f"{h_sec}h {m_sec}m {s_sec}s"
 
-    sorted_stat = sorted(r.items(), key=lambda x: x[1], reverse=True)
-    for user, value in sorted_stat:
+    if group_by == StatGroupBy.day: sorted_stat = sorted(r.items())
+    else: sorted_stat = sorted(r.items(), key=lambda x: x[1], reverse=True)
+    for key, value in sorted_stat:
         bar_length = int(value / max_val * MAX_BAR_LENGTH) if max_val > 0 else 0
         bar = '█' * bar_length + ' ' * (MAX_BAR_LENGTH - bar_length)
-        table.add_row(user, sec2str(value), bar)
+        table.add_row(key, sec2str(value), bar)
     console.print(table)
 
 @handle_request_error()
@@ -307,7 +407,7 @@ def help(
     api = PodyAPI()
     if not path is None and not path.startswith("/"):
         path = f"/{path}"
-    res = api.get("/help", {"path": path})
+    res = api.help(path)
     for r in res:
         table.add_row(r['path'], ', '.join(r['methods']), ', '.join([
             f"{p['name']}{'?' if p['optional'] else ''}" for p in r['params']
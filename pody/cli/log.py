@@ -1,10 +1,12 @@
 
-from typer import Typer
+from typer import Typer, Option
 from typing import Optional
-import rich
+from datetime import datetime
+import time
+from rich.console import Console
 import logging
 import sqlite3
-from pody.eng.log import eval_logline
+from pody.eng.log import DBLogRecord, query_log, delete_log_records, prune_log_db, setup_log_db
 
 def levelstr2int(levelstr: str) -> int:
     import sys
@@ -13,50 +15,127 @@ def levelstr2int(levelstr: str) -> int:
     else:
         return logging.getLevelNamesMapping()[levelstr.upper()]
 
+def parse_time(s: str) -> float:
+    """ epoch seconds, ISO date / datetime, or a duration before now, e.g. 30m, 2h, 7d """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if s[-1:] in units and s[:-1].replace('.', '', 1).isdigit():
+        return time.time() - float(s[:-1]) * units[s[-1]]
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.fromisoformat(s).timestamp()
+
+def open_log_db(db_file: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file, timeout=30)
+    # log files written by older versions are upgraded in place
+    setup_log_db(conn)
+    return conn
+
 app = Typer(no_args_is_help=True)
-console = rich.console.Console()
+console = Console()
+
+levelname_color = {
+    'DEBUG': 'blue',
+    'INFO': 'green',
+    'WARNING': 'yellow',
+    'ERROR': 'red',
+    'CRITICAL': 'bold red', 
+    'FATAL': 'bold red'
+}
+def print_log(log: DBLogRecord):
+    console.print(f"{log.created} [{levelname_color.get(log.levelname, 'default')}][{log.levelname}] [default]{log.message}", highlight=False)
 
 @app.command(
-    help = "Show log records, optionally filter by log level, if log level is specified, only show records with severity greater than or equal to the specified log level",
+    help = "Show log records, optionally filter by log level, if log level is specified, only show records with severity greater than or equal to the specified log level. "
+        "Time can be given as epoch seconds, ISO datetime, or duration before now (e.g. 30m, 2h, 7d). "
+        "Records are shown in pages of [limit] from the newest, use --before-id to show the previous page",
     no_args_is_help=True
 )
 def show(
     db_file: str, 
     level: Optional[str] = None, 
-    offset: int = 0,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    grep: Optional[str] = Option(None, help="Show records containing the text, whole words with the last word as prefix if full-text search is available"),
+    before_id: Optional[int] = None,
     limit: int = 1000
     ):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    if level is None:
-        cursor.execute("SELECT * FROM log ORDER BY created DESC LIMIT ? OFFSET ?", (limit, offset))
-    else:
-        level_int = levelstr2int(level)
-        cursor.execute("SELECT * FROM log WHERE level >= ? ORDER BY created DESC LIMIT ? OFFSET ?", (level_int, limit, offset))
-    levelname_color = {
-        'DEBUG': 'blue',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold red', 
-        'FATAL': 'bold red'
-    }
-    for row in cursor.fetchall()[::-1]:
-        log = eval_logline(row)
-        console.print(f"{log.created} [{levelname_color[log.levelname]}][{log.levelname}] [default]{log.message}")
+    conn = open_log_db(db_file)
+    first_id, n = None, 0
+    for log in query_log(
+        conn, 
+        level=levelstr2int(level) if level is not None else None,
+        since=parse_time(since) if since is not None else None,
+        until=parse_time(until) if until is not None else None,
+        grep=grep, before_id=before_id, limit=limit,
+        ):
+        if first_id is None: first_id = log.id
+        n += 1
+        print_log(log)
+    if n == limit and first_id is not None:
+        console.print(f"[dim]-- more records: --before-id {first_id}")
     conn.close()
 
 @app.command(
-    help="Delete old log records, keep the latest [keep] records, optionally filter by log level, if log level is specified, only delete records with the specified log level",
+    help = "Show the last [n] log records, and with -f, follow new records as they are written",
     no_args_is_help=True
 )
-def shrink(db_file: str, keep: int  = 1000, level: Optional[str] = None):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    if level is None:
-        cursor.execute("DELETE FROM log WHERE id NOT IN (SELECT id FROM log ORDER BY created DESC LIMIT ?)", (keep,))
+def tail(
+    db_file: str,
+    n: int = Option(20, "-n", help="Number of records to show"),
+    follow: bool = Option(False, "-f", "--follow", help="Follow new records"),
+    level: Optional[str] = None,
+    grep: Optional[str] = None,
+    interval: float = 0.5,
+    ):
+    conn = open_log_db(db_file)
+    level_int = levelstr2int(level) if level is not None else None
+    last_id = conn.execute("SELECT MAX(id) FROM log").fetchone()[0] or 0
+    for log in query_log(conn, level=level_int, grep=grep, limit=n):
+        print_log(log)
+    if not follow:
+        return conn.close()
+    data_version = None
+    try:
+        while True:
+            # changes by other connections bump data_version, no query while the log is idle
+            if (v := conn.execute("PRAGMA data_version").fetchone()[0]) != data_version:
+                data_version = v
+                top = conn.execute("SELECT MAX(id) FROM log").fetchone()[0] or 0
+                while True:
+                    page = list(query_log(conn, level=level_int, grep=grep, after_id=last_id, before_id=top + 1, limit=1000))
+                    for log in page: print_log(log)
+                    if len(page) < 1000: break
+                    last_id = page[-1].id
+                last_id = top
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+@app.command(
+    help="Delete old log records, keep the latest [keep] records, or the records of the last [days] days, optionally filter by log level, if log level is specified, only delete records with the specified log level",
+    no_args_is_help=True
+)
+def shrink(
+    db_file: str, 
+    keep: int  = 1000, 
+    level: Optional[str] = None, 
+    days: Optional[int] = Option(None, help="Keep the records of this many days including today, instead of the number of records"),
+    vacuum: bool = Option(False, help="Rebuild the database file afterwards, blocks writers until done"),
+    ):
+    conn = open_log_db(db_file)
+    if days is not None:
+        deleted = prune_log_db(conn, retention_days=days)
     else:
-        cursor.execute("DELETE FROM log WHERE levelname = ? and id NOT IN (SELECT id FROM log WHERE levelname = ? ORDER BY created DESC LIMIT ?)", (level.upper(), level.upper(), keep))
-    conn.commit()
-    conn.execute("VACUUM")
-    conn.close()
\ No newline at end of file
+        where, params = "1", ()
+        if level is not None:
+            where, params = "level = ?", (levelstr2int(level),)
+        row = conn.execute(f"SELECT id FROM log WHERE {where} ORDER BY id DESC LIMIT 1 OFFSET ?", (*params, keep - 1)).fetchone() if keep > 0 else (float('inf'),)
+        deleted = delete_log_records(conn, f"{where} AND id < ?", (*params, row[0])) if row is not None else 0
+        conn.executescript("PRAGMA incremental_vacuum")     # one page is freed per step, run to completion
+    if vacuum:
+        conn.execute("VACUUM")
+    console.print(f"{deleted} records deleted")
+    conn.close()
@@ -4,6 +4,7 @@ from typing import Optional
 from pody.eng.user import UserDatabase
 from pody.eng.quota import QuotaDatabase
 from ..eng.docker import ContainerAction, DockerController
+from ..eng.ports import PortAllocator
 
 app = typer.Typer(
     help = "Manage users in the system",
@@ -67,4 +68,5 @@ def purge(
     containers = c.list_docker_containers(filter_name=username + "-")
     for container in containers:
         c.container_action(container, ContainerAction.DELETE)
+        PortAllocator().release(container)
         print(f"Container [{container}] removed")
\ No newline at end of file
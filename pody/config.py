@@ -1,8 +1,14 @@
 import os
+import sys
+import time
 import toml
 import pathlib
-from dataclasses import dataclass
-from .eng.utils import expiry_cache
+import threading
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+if TYPE_CHECKING:
+    from .eng.ports import PortRanges
+    from .eng.nparse import PodNameParser, ImageMatcher
 
 """
 DATA_HOME structure:
@@ -15,17 +21,17 @@ DATA_HOME structure:
 DATA_HOME = pathlib.Path(os.environ.get('PODY_HOME', os.path.expanduser('~/.pody')))
 SRC_HOME = pathlib.Path(__file__).parent
 
-@dataclass
+@dataclass(frozen=True)
 class Config:
 
-    @dataclass
+    @dataclass(frozen=True)
     class RemoteUserProfile:
-        @dataclass
+        @dataclass(frozen=True)
         class RemoteUserProfileProvider:
             enabled: bool
             endpoint: str
             access_token: str
-        @dataclass
+        @dataclass(frozen=True)
         class RemoteUserProfileService:
             enabled: bool
             readonly: bool
@@ -34,7 +40,7 @@ class Config:
         provider: RemoteUserProfileProvider
         service: RemoteUserProfileService
 
-    @dataclass
+    @dataclass(frozen=True)
     class DefaultQuota:
         # ["" for string] and [-1 for integer] means no limit
         max_pods: int
@@ -47,25 +53,66 @@ class Config:
         commit_count: int
         commit_size_limit: str  # "20g"
 
-    @dataclass
+    @dataclass(frozen=True)
+    class ExecConfig:
+        max_workers: int        # size of the exec worker pool
+        max_per_user: int       # max concurrent exec of a user, -1 means no limit
+
+    @dataclass(frozen=True)
+    class DaemonConfig:
+        gpu_check_interval: float           # seconds between GPU quota checks
+        gpu_grace_period: float             # seconds from the warning to stopping a container over GPU quota
+        gpu_kill_after: float               # seconds from the stop signal to the kill signal
+        resource_record_interval: float     # seconds between resource usage records
+        jitter: float                       # max random delay of each run, seconds
+        warm_pool_interval: float           # seconds between refills of the warm pools
+
+    @dataclass(frozen=True)
+    class JobConfig:
+        max_workers: int        # size of the job worker pool
+        max_create: int         # max concurrent pod creations of the jobs
+        max_commit: int         # max concurrent commits of the jobs
+        max_delete: int         # max concurrent pod deletions of the jobs
+        retention_days: int     # days finished jobs are kept, -1 means no limit
+
+    @dataclass(frozen=True)
+    class LogConfig:
+        retention_days: int     # days of log records to keep, -1 means no limit
+        max_size: str           # max size of each log database, e.g. "1g", "" means no limit
+        access_log_sample: float    # fraction of successful requests printed to the console, errors are always printed
+
+    @dataclass(frozen=True)
     class ImageConfig:
-        name: str           # e.g. "ubuntu2204-cuda121:latest"
-        ports: list[int]    # e.g. [22, 80, 443]
+        name: str               # e.g. "ubuntu2204-cuda121:latest"
+        ports: tuple[int, ...]  # e.g. (22, 80, 443)
+        warm_pool: int = 0      # pre-created pods kept for this image, see `eng.warm_pool`
     
     name_prefix: str
-    available_ports: list[int | tuple[int, int]]
-    volume_mappings: list[str]
+    available_ports: tuple[int | tuple[int, int], ...]
+    volume_mappings: tuple[str, ...]
     network: str
     remote_user_profile: RemoteUserProfile
     default_quota: DefaultQuota
-    images: list[ImageConfig]
+    images: tuple[ImageConfig, ...]
     commit_name: str
-    commit_image_ports: list[int]
+    commit_image_ports: tuple[int, ...]
+    exec: ExecConfig
+    log: LogConfig
+    daemon: DaemonConfig
+    job: JobConfig
 
-@expiry_cache(seconds=5)
-def config():
+    # derived from the fields above, built once per load
+    port_ranges: "PortRanges" = field(repr=False, compare=False)
+    name_parser: "PodNameParser" = field(repr=False, compare=False)
+    image_matcher: "ImageMatcher" = field(repr=False, compare=False)
+
+CONFIG_PATH = DATA_HOME / "config.toml"
+
+def load_config(config_path: pathlib.Path = CONFIG_PATH) -> Config:
+    """ Read and validate the configuration file, create it from the template if not exists """
     # prevent circular import
-    from .eng.nparse import check_name_part
+    from .eng.nparse import check_name_part, PodNameParser, ImageMatcher
+    from .eng.ports import PortRanges
 
     def parse_ports(ports_str: str) -> list[int | tuple[int, int]]:
         ports: list[int | tuple[int, int]] = []
@@ -89,7 +136,6 @@ def config():
                 assert port >= 0 and port <= 65535, "Port must be between 0 and 65535"
         return ports
     
-    config_path = DATA_HOME / "config.toml"
     def create_default_config():
         nonlocal config_path
         template_config_file = pathlib.Path(__file__).parent / "config.default.toml"
@@ -97,7 +143,7 @@ def config():
             with config_path.open('w') as f2:
                 f2.write(f.read())
     
-    DATA_HOME.mkdir(exist_ok=True)
+    config_path.parent.mkdir(exist_ok=True)
     if not config_path.exists():
         create_default_config()
     
@@ -134,14 +180,95 @@ def config():
     if remote_user_profile.service.enabled and not remote_user_profile.service.access_token:
         raise ValueError("Remote user profile service is enabled but access token is not set")
 
+    # added in v0.4.2
+    exec_config = Config.ExecConfig(**{'max_workers': 16, 'max_per_user': 4, **loaded.get('exec', {})})
+    if exec_config.max_workers < 1:
+        raise ValueError("exec.max_workers should be a positive integer")
+
+    # added in v0.4.2
+    log_config = Config.LogConfig(**{'retention_days': 90, 'max_size': '', 'access_log_sample': 0.0, **loaded.get('log', {})})
+
+    daemon_config = Config.DaemonConfig(**{
+        'gpu_check_interval': 5, 'gpu_grace_period': 30, 'gpu_kill_after': 30, 
+        'resource_record_interval': 60, 'jitter': 5, 'warm_pool_interval': 30, 
+        **loaded.get('daemon', {})
+        })
+    if min(daemon_config.gpu_check_interval, daemon_config.resource_record_interval, daemon_config.warm_pool_interval) <= 0:
+        raise ValueError("daemon intervals should be positive")
+
+    job_config = Config.JobConfig(**{
+        'max_workers': 8, 'max_create': 4, 'max_commit': 2, 'max_delete': 4, 'retention_days': 7, 
+        **loaded.get('job', {})
+        })
+    if min(job_config.max_workers, job_config.max_create, job_config.max_commit, job_config.max_delete) < 1:
+        raise ValueError("job.max_* should be positive integers")
+
+    available_ports = tuple(parse_ports(loaded['available_ports']))
+    images = tuple(
+        Config.ImageConfig(name=i['name'], ports=tuple(i['ports']), warm_pool=i.get('warm_pool', 0))
+        for i in loaded['images']
+        )
+    if any(i.warm_pool < 0 for i in images):
+        raise ValueError("images.warm_pool should be a non-negative integer")
     return Config(
         name_prefix=name_prefix,
-        available_ports=parse_ports(loaded['available_ports']), 
-        volume_mappings=loaded['volume_mappings'],
+        available_ports=available_ports, 
+        volume_mappings=tuple(loaded['volume_mappings']),
         network=loaded.get('network', ""),
         default_quota=Config.DefaultQuota(**loaded['default_quota']),
-        images=[Config.ImageConfig(name=i['name'], ports=i['ports']) for i in loaded['images']], 
+        images=images, 
         commit_name=loaded.get('commit_name', 'pody-commit'),
-        commit_image_ports=loaded.get('commit_image_ports', [22]),
-        remote_user_profile=remote_user_profile
-        )
\ No newline at end of file
+        commit_image_ports=tuple(loaded.get('commit_image_ports', [22])),
+        remote_user_profile=remote_user_profile, 
+        exec=exec_config, 
+        log=log_config,
+        daemon=daemon_config,
+        job=job_config,
+        port_ranges=PortRanges(available_ports),
+        name_parser=PodNameParser(name_prefix),
+        image_matcher=ImageMatcher(images),
+        )
+
+class ConfigService:
+    """
+    Keep the loaded configuration until the file changes (mtime, inode or size),
+    the file is checked at most every `check_interval` seconds.
+    If the changed file is invalid, the previous configuration is kept until the next change.
+    """
+    def __init__(self, config_path: pathlib.Path = CONFIG_PATH, check_interval: float = 1.0):
+        self.config_path = config_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._config: Optional[Config] = None
+        self._file_key: Optional[tuple[int, int, int]] = None
+        self._next_check = 0.
+
+    def _stat_key(self) -> Optional[tuple[int, int, int]]:
+        try:
+            st = self.config_path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def get(self) -> Config:
+        if self._config is not None and time.monotonic() < self._next_check:
+            return self._config
+        with self._lock:
+            if self._config is not None and time.monotonic() < self._next_check:
+                return self._config
+            key = self._stat_key()
+            if self._config is None or key != self._file_key:
+                try:
+                    self._config = load_config(self.config_path)
+                except Exception as e:
+                    if self._config is None:
+                        raise
+                    print(f"Invalid configuration {self.config_path}, the previous one is kept: {e}", file=sys.stderr)
+                self._file_key = self._stat_key() if key is None else key
+            self._next_check = time.monotonic() + self.check_interval
+            return self._config
+
+__g_config_service = ConfigService()
+def config() -> Config:
+    """ The current configuration, an immutable snapshot that is replaced when the file changes """
+    return __g_config_service.get()
\ No newline at end of file
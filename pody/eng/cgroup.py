@@ -0,0 +1,115 @@
+"""
+Resolve host processes to docker containers through their cgroup.
+The container table is listed once per sweep, each process is then resolved
+with a read of `/proc/<pid>/cgroup` and a local dict lookup.
+"""
+import re, os
+from typing import Callable, Iterable, Optional
+
+# the full container id is a 64-char hex string,
+# cgroup v1:                        12:memory:/docker/<id>
+# cgroup v2 (systemd driver):       0::/system.slice/docker-<id>.scope
+# cgroup v1 (systemd driver):       1:name=systemd:/system.slice/docker-<id>.scope
+_CGROUP_CONTAINER_ID_RE = re.compile(r"(?:^|/)(?:docker-)?([0-9a-f]{64})(?:\.scope)?$")
+
+def container_id_from_cgroup(cgroup_info: str) -> Optional[str]:
+    """ Parse the content of `/proc/<pid>/cgroup`, return the full container id or None """
+    for line in cgroup_info.splitlines():
+        parts = line.split(':', 2)
+        if len(parts) != 3 or "docker" not in parts[2]:
+            continue
+        m = _CGROUP_CONTAINER_ID_RE.search(parts[2].strip())
+        if m:
+            return m.group(1)
+    return None
+
+def read_cgroup(pid: int, proc_root: str = "/proc") -> Optional[str]:
+    try:
+        with open(os.path.join(proc_root, str(pid), "cgroup"), "r") as f:
+            return f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+class ContainerPidResolver:
+    """
+    Map host PIDs to container names.
+    - list_containers: returns an iterable of (container_id, container_name),
+        called once on each `refresh()`
+    - get_container: optional fallback for ids that are not in the index
+        (e.g. containers created after the last refresh),
+        should return the container name or None
+    """
+    def __init__(
+        self,
+        list_containers: Callable[[], Iterable[tuple[str, str]]],
+        get_container: Optional[Callable[[str], Optional[str]]] = None,
+        proc_root: str = "/proc",
+        ):
+        self._list_containers = list_containers
+        self._get_container = get_container
+        self.proc_root = proc_root
+        self._index: dict[str, Optional[str]] = {}
+
+    def refresh(self):
+        self._index = {cid: name for cid, name in self._list_containers()}
+        return self
+
+    def resolve_id(self, container_id: str) -> Optional[str]:
+        if container_id in self._index:
+            return self._index[container_id]
+        name = self._get_container(container_id) if self._get_container else None
+        # also cache misses, so that a stale id only costs one lookup per sweep
+        self._index[container_id] = name
+        return name
+
+    def resolve(self, pid: int) -> Optional[str]:
+        """Return the container name if the process runs inside a container, otherwise return None."""
+        cgroup_info = read_cgroup(pid, self.proc_root)
+        if cgroup_info is None:
+            return None
+        container_id = container_id_from_cgroup(cgroup_info)
+        if container_id is None:
+            return None
+        return self.resolve_id(container_id)
+
+
+if __name__ == "__main__":
+    # benchmark with a synthetic /proc tree,
+    # compare the indexed resolver with per-pid container lookup
+    import tempfile, random, time, pathlib
+
+    N_PROC, N_CONTAINER, RTT = 8000, 200, 0.002     # RTT: simulated dockerd round trip (s)
+    containers = {os.urandom(32).hex(): f"pd-user{i}-ins" for i in range(N_CONTAINER)}
+    cids = list(containers.keys())
+    n_calls = 0
+
+    def list_containers():
+        global n_calls; n_calls += 1; time.sleep(RTT)
+        return list(containers.items())
+    def get_container(cid: str):
+        global n_calls; n_calls += 1; time.sleep(RTT)
+        return containers.get(cid)
+
+    with tempfile.TemporaryDirectory() as proc_root:
+        for pid in range(1, N_PROC + 1):
+            d = pathlib.Path(proc_root) / str(pid)
+            d.mkdir()
+            match random.random():
+                case r if r < 0.3: line = f"0::/system.slice/docker-{random.choice(cids)}.scope"
+                case r if r < 0.6: line = f"12:memory:/docker/{random.choice(cids)}"
+                case _: line = "0::/user.slice/user-1000.slice/session-1.scope"
+            (d / "cgroup").write_text(line + "\n")
+        pids = list(range(1, N_PROC + 1))
+
+        n_calls, t = 0, time.time()
+        r = ContainerPidResolver(list_containers, get_container, proc_root=proc_root).refresh()
+        n_found = sum(r.resolve(pid) is not None for pid in pids)
+        print(f"indexed:  {time.time() - t:.3f}s, {n_calls} docker calls, {n_found} in containers")
+
+        n_calls, t = 0, time.time()
+        n_found = 0
+        for pid in pids:
+            cgroup_info = read_cgroup(pid, proc_root)
+            if cgroup_info and (cid:=container_id_from_cgroup(cgroup_info)):
+                n_found += get_container(cid) is not None
+        print(f"per-pid:  {time.time() - t:.3f}s, {n_calls} docker calls, {n_found} in containers")
@@ -1,42 +1,106 @@
+"""
+Shared connections, one per database file per process,
+the schema setup runs once when the connection is opened.
+The connection is used by all threads of the process, statements are serialized by a lock.
+"""
 from abc import ABC, abstractmethod
-import sqlite3
-from contextlib import contextmanager
+import os, sqlite3, pathlib, threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Literal, Optional
+from .metrics import SQLITE_SECONDS
+
+_shared_conns: dict[tuple[int, str], tuple[sqlite3.Connection, threading.RLock]] = {}
+_shared_conns_lock = threading.Lock()
+
+def open_connection(path: str | pathlib.Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30, cached_statements=256)
+    if str(path) != ":memory:":
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+def shared_connection(
+    path: str | pathlib.Path,
+    setup: Optional[Callable[[sqlite3.Cursor], None]] = None
+    ) -> tuple[sqlite3.Connection, threading.RLock]:
+    """
+    Return the connection of the database file for this process and its lock,
+    - setup: schema creation / migration, called in an immediate transaction when the connection is opened
+    """
+    key = (os.getpid(), str(pathlib.Path(path).resolve()))
+    with _shared_conns_lock:
+        if key in _shared_conns:
+            return _shared_conns[key]
+        conn = open_connection(path)
+        if setup is not None:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                setup(cursor)
+            except Exception as e:
+                cursor.execute("ROLLBACK")
+                raise e
+            else:
+                conn.commit()
+            finally:
+                cursor.close()
+        _shared_conns[key] = (conn, threading.RLock())
+        return _shared_conns[key]
 
 class DatabaseAbstract(ABC):
 
+    # set by `open_shared`
+    _shared_lock: Optional[threading.RLock] = None
+    _db_name: Optional[str] = None
+
     @property
     @abstractmethod
     def conn(self) -> sqlite3.Connection:
         ...
 
+    def open_shared(self, path: str | pathlib.Path, setup: Optional[Callable[[sqlite3.Cursor], None]] = None) -> sqlite3.Connection:
+        conn, self._shared_lock = shared_connection(path, setup)
+        self._db_name = pathlib.Path(path).stem
+        return conn
+
+    def _locked(self):
+        return self._shared_lock if self._shared_lock is not None else nullcontext()
+
     def cursor(self):
         @contextmanager
         def _cursor():
-            cursor = self.conn.cursor()
-            try:
-                yield cursor
-            finally:
-                cursor.close()
+            with self._locked(), SQLITE_SECONDS.time(database=self._db_name or type(self).__name__, mode="read"):
+                cursor = self.conn.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
         return _cursor()
-    
-    def transaction(self):
+
+    def transaction(self, mode: Literal['DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'] = 'DEFERRED'):
+        """ IMMEDIATE takes the write lock at the beginning, for read-then-write across processes """
         @contextmanager
         def _transaction():
-            cursor = self.conn.cursor()
-            try:
-                cursor.execute("BEGIN")
-                yield cursor
-            except Exception as e:
-                cursor.execute("ROLLBACK")
-                raise e
-            else:
-                self.conn.commit()
-            finally:
-                cursor.close()
+            with self._locked(), SQLITE_SECONDS.time(database=self._db_name or type(self).__name__, mode="write"):
+                cursor = self.conn.cursor()
+                try:
+                    cursor.execute(f"BEGIN {mode}")
+                    yield cursor
+                except Exception as e:
+                    cursor.execute("ROLLBACK")
+                    raise e
+                else:
+                    self.conn.commit()
+                finally:
+                    cursor.close()
         return _transaction()
 
     def close(self):
-        self.conn.close()
+        # shared connections live with the process
+        if self._shared_lock is None:
+            self.conn.close()
 
     def __del__(self):
-        self.close()
\ No newline at end of file
+        self.close()
@@ -15,11 +15,14 @@ from typing import TYPE_CHECKING, Optional
 if TYPE_CHECKING:
     from docker.models.containers import _RestartPolicy
 
-import time, os
-from multiprocessing import Process, Queue
+import os
 from .errors import *
 from .log import get_logger
-from .utils import parse_storage_size
+from .metrics import timed, DOCKER_CALL_SECONDS
+from .cgroup import ContainerPidResolver, container_id_from_cgroup, read_cgroup
+
+# lines of the container log returned by create / lifecycle actions, see /pod/logs for the full log
+ACTION_LOG_TAIL = 100
 
 @dataclass
 class ContainerConfig:
@@ -74,6 +77,61 @@ def _get_image_name(image: docker.models.images.Image):
     image_name = image.tags[0] if image and image.tags else image.short_id if image.short_id else ""
     return image_name
 
+def container_info_from_attrs(attrs: dict, image_name: str) -> ContainerInfo:
+    """ Build the container info from the raw inspect result of a container """
+    host_config = attrs.get('HostConfig', {})
+    raw_gpu_ids = host_config.get('DeviceRequests')
+    if not raw_gpu_ids:
+        gpu_ids = []
+    elif (dev_ids := raw_gpu_ids[0].get('DeviceIDs')) is None:
+        gpu_ids = None
+    else:
+        gpu_ids = [int(id) for id in dev_ids]
+
+    network_settings = attrs.get('NetworkSettings', {})
+
+    port_mappings_dict = {}
+    for host_port, container_ports in (network_settings.get('Ports') or {}).items():
+        if container_ports:
+            for port in container_ports:
+                port_mappings_dict[port['HostPort']] = host_port.split('/')[0]
+
+    networks = []
+    for network_name, network_info in (network_settings.get('Networks') or {}).items():
+        if network_info.get('NetworkID'):
+            networks.append(network_name)
+
+    container_id = attrs.get('Id')
+    name = attrs.get('Name', '').lstrip('/')
+    return ContainerInfo(
+        container_id=container_id[:12] if container_id else None,
+        name=name if name else container_id if container_id else "unknown",
+        status=attrs.get('State', {}).get('Status', 'unknown'),
+        image=image_name,
+        port_mapping=[f"{host_port}:{container_port}" for host_port, container_port in port_mappings_dict.items()],
+        gpu_ids=gpu_ids, 
+        networks=networks,
+        memory_limit=host_config['Memory'] if host_config.get('Memory') else -1, 
+        shm_size=host_config['ShmSize'] if host_config.get('ShmSize') else -1, 
+    )
+
+def used_ports_from_attrs(attrs: dict) -> list[int]:
+    """
+    Host ports bound by a container, from the raw inspect result.
+    The bindings of the host config are kept while the container is created or exited,
+    the network settings only list the ports of a running container, including the ones docker picked.
+    """
+    used_ports: set[int] = set()
+    for port_dict in (
+        attrs.get('HostConfig', {}).get('PortBindings'), 
+        attrs.get('NetworkSettings', {}).get('Ports'), 
+        ):
+        for _, bindings in (port_dict or {}).items():
+            for binding in bindings or []:
+                if binding.get('HostPort'):     # empty for a port docker picks at start
+                    used_ports.add(int(binding['HostPort']))
+    return sorted(used_ports)
+
 
 class DockerController():
     """
@@ -86,7 +144,9 @@ class DockerController():
         self.client = docker.from_env(timeout = 600)
         self.logger = get_logger('engine')
 
-    def create_container(self, config: ContainerConfig) -> str:
+    @timed(DOCKER_CALL_SECONDS)
+    def create_container(self, config: ContainerConfig, start: bool = True) -> str:
+        """ Create the container and start it, with start=False it is left in the created state """
         def parse_mount(mount: str, create_source = True) -> Optional[docker.types.Mount]:
             mount_sp = mount.split(":")
             if len(mount_sp) < 2:
@@ -139,7 +199,8 @@ class DockerController():
                 raise IncorrectConfigError(f"Network {network} not found.")
         
         # https://docker-py.readthedocs.io/en/stable/containers.html
-        container = self.client.containers.run(
+        create = self.client.containers.run if start else self.client.containers.create
+        container = create(
             image=config.image_name,
             name=config.container_name,
             mounts=[m for vol in config.volumes if (m:=parse_mount(vol)) is not None],
@@ -150,7 +211,7 @@ class DockerController():
             memswap_limit=config.memory_limit,      # disable swap
             shm_size=config.shm_size,
             tty=config.tty, 
-            detach=config.detach,                   # type: ignore
+            **({"detach": config.detach} if start else {}),     # type: ignore
             network=parse_network(config.network),
             restart_policy=config.restart_policy, 
             auto_remove=config.auto_remove, 
@@ -158,8 +219,9 @@ class DockerController():
             storage_opt={"size": config.storage_size} if config.storage_size else None
         )   # type: ignore
         self.logger.info(f"Container {container.name} created")
-        return container.logs().decode()
+        return container.logs(tail=ACTION_LOG_TAIL).decode()
     
+    @timed(DOCKER_CALL_SECONDS)
     def container_action(
         self, container_name: str,
         action: ContainerAction,
@@ -182,8 +244,9 @@ class DockerController():
         if not after_action is None:
             container.exec_run(after_action, tty=True)
         self.logger.info(f"Container {container.name} {action.value}")
-        return container.logs().decode()
+        return container.logs(tail=ACTION_LOG_TAIL).decode()
     
+    @timed(DOCKER_CALL_SECONDS)
     def commit_container(
         self, container_name: str, image_name: str, tag: str, 
         author: Optional[str] = None, message: Optional[str] = None
@@ -201,63 +264,26 @@ class DockerController():
         self.logger.info(f"Container {container_name} committed to image {image_name}")
         return image_name
 
+    @timed(DOCKER_CALL_SECONDS)
     def inspect_container(self, container_id: str) -> ContainerInfo:
         container = self.client.containers.get(container_id)
-        raw_gpu_ids = container.attrs.get('HostConfig', {}).get('DeviceRequests')
-        dev_ids = raw_gpu_ids[0].get('DeviceIDs')
-        if dev_ids is None:
-            gpu_ids = None
-        else:
-            gpu_ids = [int(id) for id in raw_gpu_ids[0].get('DeviceIDs')] if raw_gpu_ids is not None and len(raw_gpu_ids) > 0 else []
-        
-        network_settings = container.attrs.get('NetworkSettings', {})
+        return container_info_from_attrs(
+            container.attrs, 
+            image_name=_get_image_name(container.image) if container.image else "unknown"
+            )
 
-        port_mappings_dict = {}
-        for host_port, container_ports in network_settings.get('Ports', {}).items():
-            if container_ports:
-                for port in container_ports:
-                    port_mappings_dict[port['HostPort']] = host_port.split('/')[0]
-        
-        networks = []
-        for network_name, network_info in network_settings.get('Networks', {}).items():
-            if network_info.get('NetworkID'):
-                networks.append(network_name)
-
-        container_info = ContainerInfo(
-            container_id=container.id[:12] if container.id else None,
-            name=container.name if container.name else container.id if container.id else "unknown",
-            status=container.status,
-            image=_get_image_name(container.image) if container.image else "unknown",
-            port_mapping=[f"{host_port}:{container_port}" for host_port, container_port in port_mappings_dict.items()],
-            gpu_ids=gpu_ids, 
-            networks=networks,
-            memory_limit=container.attrs['HostConfig']['Memory'] if container.attrs['HostConfig']['Memory'] else -1, 
-            shm_size=container.attrs['HostConfig']['ShmSize'] if container.attrs['HostConfig']['ShmSize'] else -1, 
-        )
-        return container_info
-
-    def inspect_container_size(self, container_id: str):
-        import subprocess
-        container = self.client.containers.get(container_id)
-        cname = container.name
-        cmd = r'docker ps -a --format="{{.Size}}" --size --filter=' + f'"name={cname}"'
-        res = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-        res = res.stdout.decode().split()
-        assert '(virtual' in res[1], "Error: cannot parse the size query result"
-        total = res[0]
-        virtual = res[2].replace('(virtual ', '').replace(')', '')
-        def parse_size(size_str: str) -> int:
-            """Parse size string like '1.2GB', '500MB', '2.5TB' into bytes."""
-            size_str = size_str.strip().lower()
-            if size_str[-1].isdigit():
-                return int(size_str)
-            if size_str[-1] == 'b' and size_str[-2].isdigit():
-                return int(size_str[:-1])
-            else:
-                size_str = size_str[:-1]
-                return parse_storage_size(size_str)
-        return ContainerSize(parse_size(total), parse_size(virtual))
+    @timed(DOCKER_CALL_SECONDS)
+    def inspect_container_size(self, container_name: str, batch_filter: Optional[str] = None, fresh: bool = False) -> ContainerSize:
+        """
+        Exact sizes in bytes from the docker API, see `ContainerSizeEngine.query`,
+        - fresh: skip the cache and query only this container, for quota checks
+        """
+        from .docker_size import get_size_engine
+        if fresh:
+            return get_size_engine().query_fresh(container_name)
+        return get_size_engine().query(container_name, batch_filter=batch_filter)
 
+    @timed(DOCKER_CALL_SECONDS)
     def check_container_raise(self, container_id: str):
         """ Check if the container exists and return the very basic information """
         try:
@@ -270,15 +296,18 @@ class DockerController():
             "status": container.status,
         }
 
+    @timed(DOCKER_CALL_SECONDS)
     def list_docker_containers(self, filter_name: str, all: bool = True) -> list[str]:
         containers = self.client.containers.list(all=all, filters={"name": filter_name})
         return [container.name for container in containers]
 
+    @timed(DOCKER_CALL_SECONDS)
     def list_docker_images(self):
         filters = None
         images = self.client.images.list(filters=filters)
         return [_get_image_name(image) for image in images]
     
+    @timed(DOCKER_CALL_SECONDS)
     def inspect_docker_image(self, image_name: str) -> Optional[dict]:
         """
         Return the same as `docker inspect <image_name>`
@@ -297,6 +326,7 @@ class DockerController():
         except docker.errors.NotFound:
             return None
     
+    @timed(DOCKER_CALL_SECONDS)
     def delete_docker_image(self, image_name: str):
         """
         Delete a Docker image by name.
@@ -308,77 +338,51 @@ class DockerController():
         except docker.errors.APIError as e:
             raise ValueError(f"Failed to delete image {image_name}: {e}")
 
+    @timed(DOCKER_CALL_SECONDS)
     def get_docker_used_ports(self):
         containers = self.client.containers.list(all=True)
         used_ports = []
         for container in containers:
-            port_dict = container.attrs['NetworkSettings']['Ports']
-            for host_port, container_ports in port_dict.items():
-                if container_ports:
-                    for port in container_ports:
-                        used_ports.append(int(port['HostPort']))
+            used_ports.extend(used_ports_from_attrs(container.attrs))
         return used_ports
 
+    @timed(DOCKER_CALL_SECONDS)
     def exec_container_bash(self, container_name: str, command: str, timeout: int = 30) -> tuple[int, str]:
-        self.check_container_raise(container_name)
-        start_time = time.time()
-        q = Queue()
-        proc = Process(target=_exec_container_bash_worker, args=(container_name, command, q), daemon=True)
-        proc.start()
-        while proc.is_alive():
-            time.sleep(0.01)
-            if time.time() - start_time > timeout:
-                proc.terminate()
-                return -1, "Timeout"
-        proc.join()
-        return q.get()
+        """ Run the command with bash on the shared exec engine, return (exit code, output) """
+        from .docker_exec import get_exec_engine
+        return get_exec_engine().exec(container_name, command, timeout=timeout)
 
+    @timed(DOCKER_CALL_SECONDS)
     def container_from_pid(self, host_pid: int) -> Optional[str]:
         """Return the container name if the process with given PID is running inside a Docker container, otherwise return None."""
-        try:
-            with open(f"/proc/{host_pid}/cgroup", "r") as f:
-                cgroup_info = f.read()
-        except FileNotFoundError:
+        cgroup_info = read_cgroup(host_pid)
+        if cgroup_info is None:
             return None     # Not running inside Docker
-
-        container_id = None
-        for line in cgroup_info.splitlines():
-            parts = line.split(':')
-            if len(parts) == 3 and "docker" in parts[2]:
-                # uses the format /docker/<container_id>
-                container_id = parts[2].split('/')[-1]
-                # some systems have a different format
-                if container_id.startswith("docker-") and container_id.endswith(".scope"):
-                    container_id = container_id[len("docker-"):-len(".scope")]
-                break
-
+        container_id = container_id_from_cgroup(cgroup_info)
         if not container_id:
-            return None  # Not running inside Docker
+            return None     # Not running inside Docker
+        return self._container_name_from_id(container_id)
+
+    def _container_name_from_id(self, container_id: str) -> Optional[str]:
         try:
             container = self.client.containers.get(container_id)
         except docker.errors.NotFound:
             return None
         return container.name
 
+    def _list_container_ids(self) -> list[tuple[str, str]]:
+        # low-level api, the high-level `containers.list` inspects each container again
+        return [
+            (c['Id'], c['Names'][0].lstrip('/') if c.get('Names') else c['Id'])
+            for c in self.client.api.containers(all=True)
+        ]
 
-def _exec_container_bash_worker(container_name, command: str, q: Queue):
-    client = docker.from_env()
-    def escape_command(command: str):
-        return command.replace('\\', '\\\\').replace('"', '\\"')
-    cmd = f'/bin/bash -c "{escape_command(command)}"'
-    try:
-        container = client.containers.get(container_name)
-        result = container.exec_run(cmd, tty=True)
-    except docker.errors.APIError as e:
-        q.put((-1, f"Docker API error: {e}"))
-        return
-    except Exception as e:
-        q.put((-1, f"Error: {e}"))
-        return
-    q.put((
-            result.exit_code,
-            result.output.decode('utf-8') if result.output else ""
-        ))
+    def pid_resolver(self) -> ContainerPidResolver:
+        """
+        Return a resolver that maps host PIDs to container names, 
+        the containers are listed once on each `refresh()` of the resolver.
+        """
+        return ContainerPidResolver(self._list_container_ids, self._container_name_from_id)
 
 if __name__ == "__main__":
     # client = docker.from_env()
@@ -0,0 +1,292 @@
+"""
+Async docker engine, talks to the docker daemon through a pooled async HTTP client,
+so that slow daemon calls (e.g. stop with its grace period) do not block the event loop.
+
+References:
+- https://docs.docker.com/reference/api/engine/
+"""
+import os, asyncio, struct
+from collections import deque
+from json import dumps as json_dumps
+from typing import AsyncIterator, Optional
+from urllib.parse import quote
+
+import httpx
+import docker.errors
+
+from .docker import ContainerAction, ACTION_LOG_TAIL
+from .log import get_logger
+from .metrics import timed, DOCKER_CALL_SECONDS
+
+def _docker_transport(limits: httpx.Limits) -> tuple[httpx.AsyncHTTPTransport, str]:
+    """ Return the transport and base url from $DOCKER_HOST, same as `docker.from_env` """
+    host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+    if host.startswith("unix://"):
+        return httpx.AsyncHTTPTransport(uds=host[len("unix://"):], limits=limits), "http://docker"
+    if host.startswith("tcp://"):
+        return httpx.AsyncHTTPTransport(limits=limits), "http://" + host[len("tcp://"):]
+    raise ValueError(f"Unsupported DOCKER_HOST: {host}")
+
+def demux_stream(raw: bytes) -> bytes:
+    """
+    Join the payload of a multiplexed stdout/stderr stream (non-tty containers),
+    each frame has a 8-byte header: [stream, 0, 0, 0, size (big-endian uint32)]
+    """
+    out = bytearray()
+    i = 0
+    while i + 8 <= len(raw):
+        size = struct.unpack(">I", raw[i+4:i+8])[0]
+        out += raw[i+8:i+8+size]
+        i += 8 + size
+    return bytes(out)
+
+class StreamDemuxer:
+    """ Incremental `demux_stream` for a multiplexed stream read in chunks, yields (stream, payload) """
+    STREAMS = {0: "stdout", 1: "stdout", 2: "stderr"}
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, chunk: bytes):
+        self._buf += chunk
+        while len(self._buf) >= 8:
+            size = struct.unpack(">I", self._buf[4:8])[0]
+            if len(self._buf) < 8 + size:
+                break
+            stream, payload = self.STREAMS.get(self._buf[0], "stdout"), bytes(self._buf[8:8+size])
+            del self._buf[:8+size]
+            yield stream, payload
+
+def _logs_params(tail: Optional[int], since: Optional[float], until: Optional[float], timestamps: bool) -> dict:
+    params = {"stdout": 1, "stderr": 1, "tail": "all" if tail is None or tail < 0 else str(tail)}
+    if since is not None: params["since"] = f"{since:.6f}"
+    if until is not None: params["until"] = f"{until:.6f}"
+    if timestamps: params["timestamps"] = 1
+    return params
+
+class AsyncDockerController:
+    """
+    Async counterpart of `DockerController` for the container lifecycle operations.
+    - max_connections: size of the connection pool to the docker socket
+    """
+    def __init__(
+        self,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        base_url: str = "http://docker",
+        max_connections: int = 32,
+        ):
+        if transport is None:
+            transport, base_url = _docker_transport(httpx.Limits(max_connections=max_connections))
+        self.client = httpx.AsyncClient(
+            transport=transport, base_url=base_url,
+            timeout=httpx.Timeout(600, connect=10),
+            )
+        self.logger = get_logger('engine')
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _request(
+        self, method: str, path: str,
+        params: Optional[dict] = None, json: Optional[dict] = None,
+        ok_status: tuple[int, ...] = (200, 201, 204, 304),
+        ) -> httpx.Response:
+        res = await self.client.request(method, path, params=params, json=json)
+        if res.status_code in ok_status:
+            return res
+        try: explanation = res.json().get('message', res.text)
+        except Exception: explanation = res.text
+        if res.status_code == 404:
+            raise docker.errors.NotFound(f"{res.status_code} Client Error for {method} {path}: {explanation}")
+        raise docker.errors.APIError(f"{res.status_code} Error for {method} {path}: {explanation}")
+
+    @timed(DOCKER_CALL_SECONDS)
+    async def inspect(self, container_name: str) -> dict:
+        return (await self._request("GET", f"/containers/{quote(container_name)}/json")).json()
+
+    @timed(DOCKER_CALL_SECONDS)
+    async def logs(
+        self, container_name: str, tty: Optional[bool] = None,
+        tail: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None,
+        timestamps: bool = False,
+        ) -> str:
+        """
+        The container log (stdout and stderr),
+        - tail: number of lines from the end, None or negative for all
+        - since / until: epoch seconds
+        """
+        if tty is None:
+            tty = (await self.inspect(container_name))['Config'].get('Tty', False)
+        res = await self._request(
+            "GET", f"/containers/{quote(container_name)}/logs",
+            params=_logs_params(tail, since, until, timestamps)
+            )
+        raw = res.content if tty else demux_stream(res.content)
+        return raw.decode(errors='replace')
+
+    async def _iter_logs(
+        self, container_name: str, tty: bool, params: dict, timeout: Optional[httpx.Timeout] = None,
+        ) -> AsyncIterator[tuple[str, bytes]]:
+        """ Yield (stream, data) of the log response as it is read """
+        async with self.client.stream(
+            "GET", f"/containers/{quote(container_name)}/logs", params=params,
+            **({"timeout": timeout} if timeout is not None else {}),
+            ) as res:
+            if res.status_code != 200:
+                await res.aread()
+                if res.status_code == 404:
+                    raise docker.errors.NotFound(f"404 Client Error for GET logs of {container_name}: {res.text}")
+                raise docker.errors.APIError(f"{res.status_code} Error for GET logs of {container_name}: {res.text}")
+            demuxer = StreamDemuxer()
+            async for chunk in res.aiter_bytes():
+                if tty:
+                    yield "stdout", chunk
+                else:
+                    for frame in demuxer.feed(chunk):
+                        yield frame
+
+    @timed(DOCKER_CALL_SECONDS)
+    async def logs_tail(
+        self, container_name: str, max_bytes: int,
+        tail: Optional[int] = None, since: Optional[float] = None, until: Optional[float] = None,
+        timestamps: bool = False,
+        ) -> tuple[bytes, bool]:
+        """
+        The last `max_bytes` of the container log (stdout and stderr) and whether the log was longer,
+        the log is read as a stream and only the last chunks that cover `max_bytes` are kept
+        """
+        tty = (await self.inspect(container_name))['Config'].get('Tty', False)
+        chunks: deque[bytes] = deque()
+        size = total = 0
+        async for _, data in self._iter_logs(container_name, tty, _logs_params(tail, since, until, timestamps)):
+            chunks.append(data)
+            size += len(data)
+            total += len(data)
+            while size - len(chunks[0]) >= max_bytes:
+                size -= len(chunks.popleft())
+        raw = b"".join(chunks)
+        return raw[-max_bytes:] if len(raw) > max_bytes else raw, total > max_bytes
+
+    async def follow_logs(
+        self, container_name: str,
+        tail: Optional[int] = None, since: Optional[float] = None, timestamps: bool = False,
+        ) -> AsyncIterator[tuple[str, bytes]]:
+        """ Yield (stream, data) of the container log as it is written, until the container stops """
+        tty = (await self.inspect(container_name))['Config'].get('Tty', False)
+        params = {**_logs_params(tail, since, None, timestamps), "follow": 1}
+        # no read timeout, the log may be idle for long
+        async for frame in self._iter_logs(container_name, tty, params, timeout=httpx.Timeout(None, connect=10)):
+            yield frame
+
+    @timed(DOCKER_CALL_SECONDS)
+    async def exec_run(self, container_name: str, cmd: str | list[str], tty: bool = True) -> tuple[int, str]:
+        res = await self._request("POST", f"/containers/{quote(container_name)}/exec", json={
+            "Cmd": cmd if isinstance(cmd, list) else ["/bin/sh", "-c", cmd],
+            "AttachStdout": True, "AttachStderr": True, "Tty": tty,
+        })
+        exec_id = res.json()['Id']
+        res = await self._request("POST", f"/exec/{exec_id}/start", json={"Detach": False, "Tty": tty})
+        output = res.content if tty else demux_stream(res.content)
+        exit_code = (await self._request("GET", f"/exec/{exec_id}/json")).json().get('ExitCode')
+        return exit_code if exit_code is not None else -1, output.decode(errors='replace')
+
+    @timed(DOCKER_CALL_SECONDS)
+    async def container_action(
+        self, container_name: str,
+        action: ContainerAction,
+        before_action: Optional[str] = None,
+        after_action: Optional[str] = None,
+        with_logs: bool = True,
+        ) -> str:
+        """ Return the container logs after the action, or a short status line if not with_logs """
+        attrs = await self.inspect(container_name)
+        cid = attrs['Id']
+        if not before_action is None:
+            await self.exec_run(cid, before_action, tty=True)
+        match action:
+            case ContainerAction.START: await self._request("POST", f"/containers/{cid}/start")
+            case ContainerAction.STOP: await self._request("POST", f"/containers/{cid}/stop")
+            case ContainerAction.RESTART: await self._request("POST", f"/containers/{cid}/restart")
+            case ContainerAction.KILL: await self._request("POST", f"/containers/{cid}/kill")
+            case ContainerAction.DELETE:
+                await self._request("DELETE", f"/containers/{cid}", params={"force": "true"})
+                self.logger.info(f"Container {container_name} deleted")
+                return f"Container {container_name} deleted"
+            case _: raise ValueError(f"Invalid action {action}")
+        if not after_action is None:
+            await self.exec_run(cid, after_action, tty=True)
+        self.logger.info(f"Container {container_name} {action.value}")
+        if not with_logs:
+            return f"Container {container_name} {action.value}"
+        return await self.logs(cid, tty=attrs['Config'].get('Tty', False), tail=ACTION_LOG_TAIL)
+
+
+__g_controller: Optional[AsyncDockerController] = None
+__g_controller_loop: Optional[asyncio.AbstractEventLoop] = None
+def get_async_docker() -> AsyncDockerController:
+    """ Return the async controller bound to the running event loop, the connection pool is shared """
+    global __g_controller, __g_controller_loop
+    loop = asyncio.get_running_loop()
+    if __g_controller is None or __g_controller_loop is not loop:
+        __g_controller = AsyncDockerController()
+        __g_controller_loop = loop
+    return __g_controller
+
+
+if __name__ == "__main__":
+    # load test against a stub docker daemon on a unix socket,
+    # one slow stop (5s grace) should not delay concurrent inspect requests
+    import tempfile, time, statistics
+
+    STOP_DELAY = 5
+
+    async def stub_daemon(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode().split("\r\n")
+                method, path, _ = request_line.split(" ")
+                headers = {k.lower(): v.strip() for k, v in (h.split(":", 1) for h in header_lines if ":" in h)}
+                if (n := int(headers.get("content-length", 0))): await reader.readexactly(n)
+                if path.endswith("/stop"):
+                    await asyncio.sleep(STOP_DELAY)
+                    status, body = 204, b""
+                elif path.endswith("/json"):
+                    status, body = 200, json_dumps({"Id": "c" * 64, "Config": {"Tty": not "/muxed/" in path}}).encode()
+                elif "/logs" in path:
+                    # 100k lines, multiplexed in 1000-line frames for the non-tty container
+                    lines = [b"".join(f"line {i}\n".encode() for i in range(k, k + 1000)) for k in range(0, 100_000, 1000)]
+                    status, body = 200, b"".join(
+                        (struct.pack(">BxxxI", 1, len(l)) + l) if "/muxed/" in path else l for l in lines
+                        )
+                else:
+                    status, body = 200, b"log line\n"
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            writer.close()
+
+    async def main():
+        with tempfile.TemporaryDirectory() as d:
+            sock = os.path.join(d, "docker.sock")
+            server = await asyncio.start_unix_server(stub_daemon, path=sock)
+            c = AsyncDockerController(transport=httpx.AsyncHTTPTransport(uds=sock, limits=httpx.Limits(max_connections=32)))
+
+            async def timed(coro):
+                t = time.time(); await coro; return time.time() - t
+            stop_task = asyncio.create_task(timed(c.container_action("slow", ContainerAction.STOP)))
+            await asyncio.sleep(0.1)
+            latencies = await asyncio.gather(*[timed(c.inspect(f"pod{i}")) for i in range(100)])
+            print(f"100 concurrent inspects during a {STOP_DELAY}s stop: "
+                  f"median {statistics.median(latencies)*1000:.1f}ms, max {max(latencies)*1000:.1f}ms")
+            print(f"stop finished in {await stop_task:.2f}s")
+
+            # the tail of a long log is read as a stream, the result is cut to max_bytes
+            for name in ("big", "muxed"):
+                raw, truncated = await c.logs_tail(name, max_bytes=1000)
+                assert truncated and len(raw) == 1000 and raw.endswith(b"line 99999\n"), (name, raw[-40:])
+                raw, truncated = await c.logs_tail(name, max_bytes=16 * 1024 * 1024)
+                assert not truncated and raw.startswith(b"line 0\n") and raw.count(b"\n") == 100_000
+            print("logs_tail: tail of a 100k-line log cut to max_bytes, tty and multiplexed")
+            await c.close()
+            server.close()
+    asyncio.run(main())
@@ -0,0 +1,299 @@
+"""
+Exec engine, runs commands in containers with the low-level exec API on a shared client.
+The output is read from the attached socket with a deadline, so the timeout is enforced
+on the socket instead of by polling a worker process.
+"""
+import os, time, codecs, socket, struct, asyncio, threading
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Iterator, Optional
+
+import docker
+import docker.errors
+
+from .errors import ContainerNotFoundError
+from .log import get_logger
+
+class ExecEngine:
+    """
+    - max_workers: size of the worker pool, execs beyond this are queued
+    - max_per_user: max concurrent execs of a single user, -1 for no limit
+    """
+    def __init__(
+        self,
+        client: Optional[docker.DockerClient] = None,
+        max_workers: int = 16,
+        max_per_user: int = -1,
+        ):
+        self.client = client if client is not None else docker.from_env(timeout=600)
+        self.max_per_user = max_per_user
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="docker-exec")
+        self.logger = get_logger('engine')
+        self._lock = threading.Lock()
+        self._user_running: dict[str, int] = {}
+
+    def _acquire(self, user: Optional[str]):
+        if user is None: return
+        with self._lock:
+            n = self._user_running.get(user, 0)
+            if self.max_per_user >= 0 and n >= self.max_per_user:
+                raise PermissionError(f"Too many concurrent exec (max {self.max_per_user}), please wait for the previous ones")
+            self._user_running[user] = n + 1
+
+    def _release(self, user: Optional[str]):
+        if user is None: return
+        with self._lock:
+            n = self._user_running.get(user, 0) - 1
+            if n > 0: self._user_running[user] = n
+            else: self._user_running.pop(user, None)
+
+    @staticmethod
+    def _read_chunks(sock, deadline: float) -> Iterator[bytes]:
+        """
+        Read the attached socket until EOF, raise TimeoutError at the deadline.
+        The first bytes of the output may have been read into the buffer of the response
+        together with the headers, so the buffered reader of the response is read, not the socket.
+        """
+        raw: socket.socket = getattr(sock, '_sock', sock)
+        try:
+            reader = sock._response.raw._fp.fp
+        except AttributeError:
+            reader = None       # e.g. a unix socket of the npipe / ssh transports, no response attached
+        read = reader.read1 if reader is not None else raw.recv
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError
+                raw.settimeout(remaining)
+                try:
+                    data = read(4096)
+                except socket.timeout:
+                    raise TimeoutError
+                if not data:
+                    return
+                yield data
+        finally:
+            sock.close()
+
+    def _start(self, container_name: str, command: str, tty: bool):
+        api = self.client.api
+        exec_id = api.exec_create(container_name, ["/bin/bash", "-c", command], tty=tty)['Id']
+        return exec_id, api.exec_start(exec_id, tty=tty, socket=True)
+
+    def _exit_code(self, exec_id: str) -> int:
+        exit_code = self.client.api.exec_inspect(exec_id).get('ExitCode')
+        return exit_code if exit_code is not None else -1
+
+    def run(self, container_name: str, command: str, timeout: float = 30) -> tuple[int, str]:
+        """ Run the command with bash in the calling thread, return (exit code, output) """
+        deadline = time.monotonic() + timeout
+        try:
+            exec_id, sock = self._start(container_name, command, tty=True)
+            output = b''.join(self._read_chunks(sock, deadline))
+            exit_code = self._exit_code(exec_id)
+        except TimeoutError:
+            return -1, "Timeout"
+        except docker.errors.NotFound:
+            raise ContainerNotFoundError(f"Container {container_name} not found")
+        except docker.errors.APIError as e:
+            return -1, f"Docker API error: {e}"
+        return exit_code, output.decode('utf-8', errors='replace')
+
+    def run_stream(
+        self, container_name: str, command: str,
+        on_output: Callable[[str, bytes], None],
+        timeout: float = 30,
+        ) -> int:
+        """
+        Run the command with bash in the calling thread without tty,
+        the payload of each frame of the multiplexed stream is passed to `on_output(stream, data)`
+        as it arrives, where stream is "stdout" or "stderr". Return the exit code.
+        A blocking `on_output` stops reading from the daemon, which gives backpressure.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            exec_id, sock = self._start(container_name, command, tty=False)
+            buf = b''
+            for chunk in self._read_chunks(sock, deadline):
+                # frame header: [stream, 0, 0, 0, size (big-endian uint32)]
+                buf += chunk
+                while len(buf) >= 8:
+                    size = struct.unpack(">I", buf[4:8])[0]
+                    if len(buf) < 8 + size:
+                        break
+                    on_output("stderr" if buf[0] == 2 else "stdout", buf[8:8+size])
+                    buf = buf[8+size:]
+            return self._exit_code(exec_id)
+        except docker.errors.NotFound:
+            raise ContainerNotFoundError(f"Container {container_name} not found")
+
+    def _submit(self, user: Optional[str], fn: Callable, *args, **kwargs) -> Future:
+        """ Run on the worker pool, the per-user limit is checked before queueing """
+        self._acquire(user)
+        try:
+            fut = self.pool.submit(fn, *args, **kwargs)
+        except Exception as e:
+            self._release(user)
+            raise e
+        fut.add_done_callback(lambda _: self._release(user))
+        return fut
+
+    def submit(self, container_name: str, command: str, timeout: float = 30, user: Optional[str] = None) -> Future[tuple[int, str]]:
+        return self._submit(user, self.run, container_name, command, timeout)
+
+    def submit_stream(
+        self, container_name: str, command: str,
+        on_output: Callable[[str, bytes], None],
+        timeout: float = 30, user: Optional[str] = None
+        ) -> Future[int]:
+        return self._submit(user, self.run_stream, container_name, command, on_output, timeout)
+
+    def stream_frames(
+        self, container_name: str, command: str,
+        timeout: float = 30, user: Optional[str] = None
+        ) -> AsyncGenerator[dict, None]:
+        """
+        Frames of the output as it arrives: {"stream": "stdout" | "stderr", "data": ...},
+        the last frame is the trailer: {"exit_code": ..., "error"?: ...}.
+        The exec is submitted right away (the per-user limit raises here), it runs while the frames are iterated,
+        a slow reader blocks the worker, and the exec is aborted if the iteration stops early.
+        Called from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        frames: asyncio.Queue[dict] = asyncio.Queue(maxsize=64)
+        closed = threading.Event()
+        decoders = {s: codecs.getincrementaldecoder('utf-8')(errors='replace') for s in ("stdout", "stderr")}
+
+        def on_output(stream: str, data: bytes):
+            # runs in the exec worker, blocks while the queue is full (i.e. the client reads slowly)
+            fut = asyncio.run_coroutine_threadsafe(frames.put({"stream": stream, "data": decoders[stream].decode(data)}), loop)
+            while True:
+                try: return fut.result(timeout=1)
+                except concurrent.futures.TimeoutError:
+                    if closed.is_set():
+                        fut.cancel()
+                        raise ConnectionAbortedError("Client disconnected")
+
+        exec_done = asyncio.wrap_future(self.submit_stream(container_name, command, on_output, timeout=timeout, user=user))
+
+        async def iter_frames():
+            try:
+                while True:
+                    next_frame = asyncio.ensure_future(frames.get())
+                    await asyncio.wait({next_frame, exec_done}, return_when=asyncio.FIRST_COMPLETED)
+                    if next_frame.done():
+                        yield next_frame.result()
+                        continue
+                    next_frame.cancel()
+                    break
+                while not frames.empty():
+                    yield frames.get_nowait()
+                # the exec is done, emit a multi-byte character cut at the end of the output as U+FFFD
+                for stream, decoder in decoders.items():
+                    if (text := decoder.decode(b"", final=True)):
+                        yield {"stream": stream, "data": text}
+                try: trailer = {"exit_code": exec_done.result()}
+                except TimeoutError: trailer = {"exit_code": -1, "error": "Timeout"}
+                except Exception as e: trailer = {"exit_code": -1, "error": str(e)}
+                yield trailer
+            finally:
+                closed.set()
+        return iter_frames()
+
+    def exec(self, container_name: str, command: str, timeout: float = 30, user: Optional[str] = None) -> tuple[int, str]:
+        return self.submit(container_name, command, timeout, user).result()
+
+__g_engine: Optional[ExecEngine] = None
+__g_engine_pid: Optional[int] = None
+__g_engine_lock = threading.Lock()
+def get_exec_engine() -> ExecEngine:
+    """ Return the process-wide exec engine, the limits are read from the `exec` section of the configuration """
+    from ..config import config
+    global __g_engine, __g_engine_pid
+    with __g_engine_lock:
+        if __g_engine is None or __g_engine_pid != os.getpid():
+            cfg = config().exec
+            __g_engine = ExecEngine(max_workers=cfg.max_workers, max_per_user=cfg.max_per_user)
+            __g_engine_pid = os.getpid()
+        __g_engine.max_per_user = config().exec.max_per_user
+        return __g_engine
+
+
+if __name__ == "__main__":
+    # exec/s throughput against a stub docker daemon on a unix socket,
+    # compare with one process and one client per exec (the previous path)
+    import tempfile, json, socketserver, multiprocessing
+
+    N_EXEC = 200
+
+    class StubDaemon(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                request_line = self.rfile.readline().decode()
+                if not request_line: return
+                method, path, _ = request_line.split(" ")
+                headers = {}
+                while (line := self.rfile.readline().decode().strip()):
+                    k, v = line.split(":", 1); headers[k.lower()] = v.strip()
+                payload = self.rfile.read(n) if (n := int(headers.get("content-length", 0))) else b""
+                path = path.split("?")[0]
+                if path.endswith("/start"):
+                    # hijacked stream, the output follows and the connection is closed at exit
+                    if json.loads(payload).get("Tty"):
+                        output = b"hello\r\n"
+                    else:
+                        output = b"".join(struct.pack(">BxxxI", fd, len(data)) + data for fd, data in ((1, b"hello\n"), (2, b"oops\n")))
+                    self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/vnd.docker.raw-stream\r\n\r\n")
+                    time.sleep(0.001)
+                    self.wfile.write(output)
+                    return
+                if path.endswith("/version"): body = {"ApiVersion": "1.43"}
+                elif "/containers/" in path and path.endswith("/json"): body = {"Id": "c" * 64, "Name": "/pod"}
+                elif path.endswith("/exec"): body = {"Id": "e" * 64}
+                else: body = {"ExitCode": 0, "Running": False}
+                data = json.dumps(body).encode()
+                self.wfile.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+
+    class StubServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    def per_process_worker(q):
+        client = docker.from_env()
+        r = client.containers.get("pod").exec_run('/bin/bash -c "echo hello"', tty=True)
+        q.put((r.exit_code, r.output.decode()))
+
+    def per_process_exec() -> tuple[int, str]:
+        q = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=per_process_worker, args=(q,), daemon=True)
+        proc.start()
+        while proc.is_alive(): time.sleep(0.01)
+        proc.join()
+        return q.get()
+
+    with tempfile.TemporaryDirectory() as d:
+        sock_path = os.path.join(d, "docker.sock")
+        server = StubServer(sock_path, StubDaemon)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        os.environ["DOCKER_HOST"] = f"unix://{sock_path}"
+
+        t = time.time()
+        for _ in range(N_EXEC // 10): r = per_process_exec()
+        print(f"per-process: {N_EXEC // 10 / (time.time() - t):.1f} exec/s, {r}")
+
+        engine = ExecEngine(docker.from_env(), max_workers=16)
+        t = time.time()
+        futs = [engine.submit("pod", "echo hello", timeout=5) for _ in range(N_EXEC)]
+        results = [f.result() for f in futs]
+        print(f"engine:      {N_EXEC / (time.time() - t):.1f} exec/s, {results[-1]}")
+        n_lost = sum(r != (0, "hello\r\n") for r in results)
+        assert n_lost == 0, f"{n_lost} of {N_EXEC} execs lost output"
+
+        # the frames of /pod/exec-stream from the multiplexed stream, the trailer last
+        async def collect() -> list[dict]:
+            return [f async for f in engine.stream_frames("pod", "echo hello; echo oops >&2", timeout=5)]
+        frames = asyncio.run(collect())
+        print(f"stream:      {frames}")
+        assert frames == [{"stream": "stdout", "data": "hello\n"}, {"stream": "stderr", "data": "oops\n"}, {"exit_code": 0}]
+        server.shutdown()
@@ -0,0 +1,411 @@
+"""
+In-process state cache of docker containers and images.
+The cache is built from a full listing, then kept current by the docker events stream,
+so that list / inspect queries are served from memory.
+The image catalog (see `ImageCatalog`) is rebuilt lazily when the images or the config change.
+"""
+import time, os, threading
+from typing import Any, Callable, Iterable, Optional
+
+import docker
+import docker.errors
+
+from .docker import ContainerInfo, container_info_from_attrs, used_ports_from_attrs
+from .errors import ContainerNotFoundError
+from .log import get_logger
+from .nparse import ImageCatalog
+from ..config import config
+
+# (since, until) -> decoded event dicts
+EventSource = Callable[[float, float], Iterable[dict]]
+
+# container actions that may change the inspect result of the container
+_CONTAINER_REFRESH_ACTIONS = {
+    "create", "start", "restart", "die", "stop", "kill", "oom",
+    "pause", "unpause", "rename", "update",
+}
+_CONTAINER_REMOVE_ACTIONS = {"destroy"}
+_IMAGE_REFRESH_ACTIONS = {"tag", "untag", "delete", "pull", "load", "import"}
+
+def _image_name_from_summary(summary: dict) -> str:
+    # same as `_get_image_name` of the docker engine, for the low-level image summary
+    tags = [t for t in (summary.get('RepoTags') or []) if t != '<none>:<none>']
+    if tags:
+        return tags[0]
+    image_id: str = summary.get('Id', '')
+    return image_id[:len("sha256:") + 10] if image_id.startswith("sha256:") else image_id[:10]
+
+class DockerStateCache:
+    """
+    Container / image state of the docker daemon,
+    - client: the docker client, used for the full listing and for refreshing single containers
+    - events: the event source, defaults to the docker events stream of the client
+    - reconcile_interval: the event stream is re-opened and the state is fully re-listed
+        after this many seconds, as a fallback for missed events
+    """
+    def __init__(
+        self,
+        client: Optional[docker.DockerClient] = None,
+        events: Optional[EventSource] = None,
+        reconcile_interval: float = 600,
+        ):
+        self.client = client if client is not None else docker.from_env(timeout=600)
+        self._events = events if events is not None else self._docker_events
+        self.reconcile_interval = reconcile_interval
+        self.logger = get_logger('engine')
+
+        self._lock = threading.RLock()
+        self._containers: dict[str, dict] = {}      # full id -> inspect attrs
+        self._names: dict[str, str] = {}            # name -> full id
+        self._images: dict[str, str] = {}           # image id -> image name
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self.version = 0                            # increased on every change
+        self.images_version = 0                     # increased on every image change
+        self._catalog: Optional[ImageCatalog] = None
+        self._catalog_version = -1
+        self.last_reconcile = 0.
+
+    def _docker_events(self, since: float, until: float) -> Iterable[dict]:
+        return self.client.api.events(
+            since=since, until=until, decode=True,
+            filters={"type": ["container", "image"]}
+            )
+
+    # ====== lifecycle ======
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="docker-state")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        backoff = 1.
+        while not self._stop.is_set():
+            since = time.time()
+            try:
+                self.reconcile()
+                self._ready.set()
+                for event in self._events(since, since + self.reconcile_interval):
+                    self.apply_event(event)
+                    if self._stop.is_set(): return
+                backoff = 1.
+            except Exception as e:
+                self.logger.error(f"Docker event stream dropped, re-listing in {backoff:.0f}s: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+    # ====== updates ======
+    def reconcile(self):
+        """ Re-build the state from a full listing """
+        api = self.client.api
+        containers: dict[str, dict] = {}
+        for c in api.containers(all=True):
+            try:
+                containers[c['Id']] = api.inspect_container(c['Id'])
+            except docker.errors.NotFound:
+                continue
+        images = {im['Id']: _image_name_from_summary(im) for im in api.images()}
+        with self._lock:
+            self._containers = containers
+            self._names = {attrs['Name'].lstrip('/'): cid for cid, attrs in containers.items()}
+            self._images = images
+            self.version += 1
+            self.images_version += 1
+        self.last_reconcile = time.time()
+
+    def refresh_container(self, name_or_id: str):
+        """ Re-inspect a single container, remove it from the cache if it no longer exists """
+        try:
+            attrs = self.client.api.inspect_container(name_or_id)
+        except docker.errors.NotFound:
+            self.forget_container(name_or_id)
+            return
+        with self._lock:
+            old = self._containers.get(attrs['Id'])
+            if old is not None:
+                self._names.pop(old['Name'].lstrip('/'), None)
+            self._containers[attrs['Id']] = attrs
+            self._names[attrs['Name'].lstrip('/')] = attrs['Id']
+            self.version += 1
+
+    def forget_container(self, name_or_id: str):
+        with self._lock:
+            cid = self._resolve_id(name_or_id)
+            if cid is None: return
+            attrs = self._containers.pop(cid)
+            self._names.pop(attrs['Name'].lstrip('/'), None)
+            self.version += 1
+
+    def refresh_images(self):
+        images = {im['Id']: _image_name_from_summary(im) for im in self.client.api.images()}
+        with self._lock:
+            self._images = images
+            self.version += 1
+            self.images_version += 1
+
+    def apply_event(self, event: dict):
+        ev_type = event.get('Type')
+        # some actions carry arguments, e.g. "exec_start: bash"
+        action = event.get('Action', event.get('status', '')).split(':')[0]
+        actor_id = event.get('Actor', {}).get('ID') or event.get('id')
+        if not actor_id:
+            return
+        if ev_type == 'container':
+            if action in _CONTAINER_REMOVE_ACTIONS:
+                self.forget_container(actor_id)
+            elif action in _CONTAINER_REFRESH_ACTIONS:
+                self.refresh_container(actor_id)
+        elif ev_type == 'image':
+            if action in _IMAGE_REFRESH_ACTIONS:
+                self.refresh_images()
+
+    # ====== queries ======
+    def _resolve_id(self, name_or_id: str) -> Optional[str]:
+        if name_or_id in self._containers:
+            return name_or_id
+        if name_or_id in self._names:
+            return self._names[name_or_id]
+        if len(name_or_id) >= 12:
+            # short id
+            for cid in self._containers:
+                if cid.startswith(name_or_id):
+                    return cid
+        return None
+
+    def get_container(self, name_or_id: str) -> Optional[dict]:
+        """ Return the inspect attrs of the container, or None """
+        with self._lock:
+            cid = self._resolve_id(name_or_id)
+            return self._containers[cid] if cid is not None else None
+
+    def check_container_raise(self, name_or_id: str) -> dict[str, Any]:
+        if (attrs := self.get_container(name_or_id)) is None:
+            raise ContainerNotFoundError(f"Container {name_or_id} not found")
+        return {"name": attrs['Name'].lstrip('/'), "status": attrs['State']['Status']}
+
+    def inspect_container(self, name_or_id: str) -> ContainerInfo:
+        if (attrs := self.get_container(name_or_id)) is None:
+            raise ContainerNotFoundError(f"Container {name_or_id} not found")
+        return container_info_from_attrs(attrs, self.image_name(attrs.get('Image', '')))
+
+    def inspect_containers(self, filter_name: str = "") -> list[ContainerInfo]:
+        """ Info of the containers whose names contain `filter_name`, from one snapshot of the cache """
+        with self._lock:
+            snapshot = [
+                (attrs, self._images.get(attrs.get('Image', ''), "unknown"))
+                for name, cid in self._names.items() if filter_name in name
+                for attrs in (self._containers[cid],)
+            ]
+        return [container_info_from_attrs(attrs, image_name) for attrs, image_name in snapshot]
+
+    def list_containers(self, filter_name: str = "") -> list[str]:
+        """ Container names containing `filter_name`, same as the docker name filter """
+        with self._lock:
+            return [name for name in self._names if filter_name in name]
+
+    def list_container_attrs(self) -> list[dict]:
+        with self._lock:
+            return list(self._containers.values())
+
+    def used_ports(self) -> list[int]:
+        with self._lock:
+            return [p for attrs in self._containers.values() for p in used_ports_from_attrs(attrs)]
+
+    def used_port_owners(self) -> dict[int, str]:
+        """ Host port -> name of the container that binds it """
+        with self._lock:
+            return {
+                p: attrs['Name'].lstrip('/')
+                for attrs in self._containers.values() for p in used_ports_from_attrs(attrs)
+            }
+
+    def image_name(self, image_id: str) -> str:
+        with self._lock:
+            return self._images.get(image_id, "unknown")
+
+    def list_images(self) -> list[str]:
+        with self._lock:
+            return list(self._images.values())
+
+    def image_catalog(self) -> ImageCatalog:
+        """ The catalog of the current images and config, rebuilt on the first query after a change """
+        conf = config()
+        with self._lock:
+            if self._catalog is None or self._catalog.config is not conf or self._catalog_version != self.images_version:
+                self._catalog = ImageCatalog(conf, self._images.values())
+                self._catalog_version = self.images_version
+            return self._catalog
+
+
+__g_state: Optional[DockerStateCache] = None
+__g_state_pid: Optional[int] = None
+__g_state_lock = threading.Lock()
+def get_docker_state(wait_ready: Optional[float] = 30) -> DockerStateCache:
+    """
+    Return the process-wide docker state cache, started on first use,
+    - wait_ready: seconds to wait for the first listing, after which it is listed synchronously to surface the error,
+        None to return right away, e.g. to start the cache at server startup
+    """
+    global __g_state, __g_state_pid
+    with __g_state_lock:
+        if __g_state is None or __g_state_pid != os.getpid():
+            __g_state = DockerStateCache().start()
+            __g_state_pid = os.getpid()
+        state = __g_state
+    if wait_ready is not None and not state.wait_ready(wait_ready):
+        # the event thread is not able to list the state, query synchronously to surface the error
+        state.reconcile()
+    return state
+
+
+if __name__ == "__main__":
+    # the cache against a fake daemon and event source: lifecycle and image events are applied,
+    # a dropped stream is followed by a re-list, and no event is lost across re-subscriptions
+    import uuid, random
+
+    class FakeDaemon:
+        """ The low-level api used by the cache, and an event source with the semantics of `since` / `until` """
+        def __init__(self):
+            self.api = self
+            self.lock = threading.Lock()
+            self.attrs: dict[str, dict] = {}    # id -> inspect attrs
+            self.image_tags: dict[str, list[str]] = {"sha256:" + "a" * 64: ["base:latest"]}
+            self.events: list[dict] = []
+            self.windows: list[tuple[float, float]] = []    # subscriptions (since, until)
+            self.drop = threading.Event()
+            self.n_list = 0
+
+        def _emit(self, ev_type: str, action: str, actor_id: str):
+            self.events.append({"Type": ev_type, "Action": action, "Actor": {"ID": actor_id}, "time": time.time(), "seq": len(self.events)})
+
+        def create(self, name: str) -> str:
+            with self.lock:
+                cid = uuid.uuid4().hex * 2
+                self.attrs[cid] = {
+                    "Id": cid, "Name": f"/{name}", "Image": next(iter(self.image_tags)),
+                    "State": {"Status": "created"}, "HostConfig": {}, "NetworkSettings": {},
+                }
+                self._emit("container", "create", cid)
+                return cid
+
+        def set_status(self, cid: str, action: str, status: str):
+            with self.lock:
+                self.attrs[cid]["State"]["Status"] = status
+                self._emit("container", action, cid)
+
+        def destroy(self, cid: str):
+            with self.lock:
+                del self.attrs[cid]
+                self._emit("container", "destroy", cid)
+
+        def tag(self, image_id: str, tag: str, remove: bool = False):
+            with self.lock:
+                tags = self.image_tags.setdefault(image_id, [])
+                if remove: tags.remove(tag)
+                else: tags.append(tag)
+                self._emit("image", "untag" if remove else "tag", image_id)
+
+        # ====== api ======
+        def containers(self, all: bool = True) -> list[dict]:
+            with self.lock:
+                self.n_list += 1
+                return [{"Id": cid} for cid in self.attrs]
+
+        def inspect_container(self, name_or_id: str) -> dict:
+            with self.lock:
+                for cid, attrs in self.attrs.items():
+                    if name_or_id in (cid, attrs["Name"].lstrip("/")):
+                        return {**attrs, "State": dict(attrs["State"])}
+            raise docker.errors.NotFound(f"No such container: {name_or_id}")
+
+        def images(self) -> list[dict]:
+            with self.lock:
+                return [{"Id": i, "RepoTags": tags or ["<none>:<none>"]} for i, tags in self.image_tags.items()]
+
+        def event_source(self, since: float, until: float) -> Iterable[dict]:
+            self.windows.append((since, until))
+            seen = 0
+            while True:
+                if self.drop.is_set():
+                    self.drop.clear()
+                    raise ConnectionError("event stream dropped")
+                done = time.time() >= until     # the events before `until` are all sent before the stream ends
+                with self.lock:
+                    batch, seen = self.events[seen:], len(self.events)
+                yield from (e for e in batch if since <= e["time"] < until)
+                if done: return
+                time.sleep(0.005)
+
+    daemon = FakeDaemon()
+    cache = DockerStateCache(client=daemon, events=daemon.event_source, reconcile_interval=0.5)     # type: ignore
+    applied: set[int] = set()
+    _apply_event = cache.apply_event
+    def apply_event(event: dict):
+        applied.add(event["seq"])
+        _apply_event(event)
+    cache.apply_event = apply_event     # type: ignore
+    cache.start()
+    assert cache.wait_ready(5)
+
+    def wait_until(pred: Callable[[], bool], what: str, timeout: float = 3):
+        t = time.time()
+        while not pred():
+            assert time.time() - t < timeout, f"timeout waiting for: {what}"
+            time.sleep(0.01)
+        print(f"ok  {what} ({(time.time() - t) * 1000:.0f}ms)")
+
+    status = lambda name: (a := cache.get_container(name)) and a["State"]["Status"]
+    cid = daemon.create("pd-alice-a")
+    wait_until(lambda: status("pd-alice-a") == "created", "create applied")
+    daemon.set_status(cid, "start", "running")
+    wait_until(lambda: status("pd-alice-a") == "running", "start applied")
+    daemon.set_status(cid, "die", "exited")
+    wait_until(lambda: status("pd-alice-a") == "exited", "die applied")
+    daemon.destroy(cid)
+    wait_until(lambda: cache.get_container("pd-alice-a") is None, "destroy applied")
+    image_id = next(iter(daemon.image_tags))
+    daemon.tag(image_id, "base:v2")
+    daemon.tag(image_id, "base:latest", remove=True)
+    wait_until(lambda: cache.list_images() == ["base:v2"], "tag and untag applied")
+
+    n_list = daemon.n_list
+    daemon.drop.set()
+    cid = daemon.create("pd-bob-a")      # while the stream is down
+    wait_until(lambda: daemon.n_list > n_list and status("pd-bob-a") == "created", "re-listed after the stream dropped")
+
+    # changes across several re-subscriptions (interval 0.5s), each event within a subscription is applied
+    t_start = time.time()
+    names: dict[str, str] = {}
+    while time.time() - t_start < 3:
+        live = [c for c in daemon.attrs if c in names]
+        op = random.random()
+        if op < 0.3 or not live:
+            name = f"pd-u{len(names)}-a"
+            names[daemon.create(name)] = name
+        elif op < 0.8:
+            c = random.choice(live)
+            daemon.set_status(c, *random.choice([("start", "running"), ("die", "exited"), ("pause", "paused")]))
+        else:
+            daemon.destroy(random.choice(live))
+        time.sleep(random.uniform(0, 0.01))
+    truth = lambda: {a["Name"].lstrip("/"): a["State"]["Status"] for a in daemon.attrs.values()}
+    cached = lambda: {a["Name"].lstrip("/"): a["State"]["Status"] for a in cache.list_container_attrs()}
+    wait_until(lambda: cached() == truth(), "cache equals the daemon after the changes")
+    in_window = [e["seq"] for e in daemon.events if e["time"] >= t_start and any(s <= e["time"] < u for s, u in daemon.windows)]
+    lost = set(in_window) - applied
+    print(f"{len(in_window)} events over {sum(1 for s, _ in daemon.windows if s >= t_start)} subscriptions, {len(lost)} lost")
+    assert not lost
+    cache.stop()
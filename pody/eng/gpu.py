@@ -1,6 +1,8 @@
-from typing import Optional
+from typing import Any, Optional
+import os, time, threading
 import dataclasses
 from .errors import InvalidInputError
+from .metrics import NVML_SAMPLE_SECONDS
 import pynvml
 
 @dataclasses.dataclass
@@ -17,29 +19,7 @@ def list_processes_on_gpus(gpu_ids: list[int]) -> dict[int, list[GPUProcessInfo]
     Query the process running on the specified GPUs.
     return a dictionary with GPU ID as key and a list of process IDs as value.
     """
-    pynvml.nvmlInit()
-    try:
-        processes = {}
-        for gpu_id in gpu_ids:
-            try:
-                handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_id)
-            except pynvml.NVMLError as e:
-                if "invalid argument" in str(e).lower():
-                    raise InvalidInputError(f"GPU ID {gpu_id} is invalid")
-                raise e
-            info = pynvml.nvmlDeviceGetComputeRunningProcesses(handle)
-            processes[gpu_id] = [
-                GPUProcessInfo(
-                    pid=proc.pid,
-                    gpu_id=gpu_id,
-                    gpu_memory_used=proc.usedGpuMemory,
-                ) for proc in info
-            ]
-    except Exception as e:
-        raise e
-    finally:
-        pynvml.nvmlShutdown()
-    return processes
+    return get_gpu_sampler().snapshot().processes_on(gpu_ids)
 
 @dataclasses.dataclass()
 class GPUDevice:
@@ -54,43 +34,205 @@ class GPUDevice:
 
     def memory_util(self) -> float:
         return self.memory_used / self.memory_total
-    
+
     def power_util(self) -> float:
         return self.power_usage / self.power_limit
 
 class GPUHandler:
-    def __init__(self):
-        pynvml.nvmlInit()
-    
+    """
+    Wrapper of a NVML session, device handles are cached for the lifetime of the handler.
+    - nvml: the NVML binding, `pynvml` by default, can be replaced by `FakeNVML` for testing
+    """
+    def __init__(self, nvml: Any = pynvml):
+        self.nvml = nvml
+        self.nvml.nvmlInit()
+        self._handles: dict[int, Any] = {}
+        self._device_count: Optional[int] = None
+
     def __del__(self):
-        pynvml.nvmlShutdown()
-    
+        self.nvml.nvmlShutdown()
+
     def device_count(self) -> int:
-        return pynvml.nvmlDeviceGetCount()
-    
+        if self._device_count is None:
+            self._device_count = self.nvml.nvmlDeviceGetCount()
+        return self._device_count
+
+    def handle(self, idx: int):
+        if idx in self._handles:
+            return self._handles[idx]
+        if not 0 <= idx < self.device_count():
+            raise InvalidInputError(f"GPU ID {idx} is invalid")
+        try:
+            handle = self.nvml.nvmlDeviceGetHandleByIndex(idx)
+        except self.nvml.NVMLError as e:
+            if "invalid argument" in str(e).lower():
+                raise InvalidInputError(f"GPU ID {idx} is invalid")
+            raise e
+        self._handles[idx] = handle
+        return handle
+
     def all_devices(self) -> list[GPUDevice]:
         return [gpu_device for i in range(self.device_count()) if (gpu_device := self.query_device(i)) is not None]
-    
+
     def query_device(self, idx: int) -> Optional[GPUDevice]:
+        nvml = self.nvml
         try:
-            handle = pynvml.nvmlDeviceGetHandleByIndex(idx)
-            info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-            power = pynvml.nvmlDeviceGetPowerUsage(handle)
-            limit = pynvml.nvmlDeviceGetPowerManagementLimit(handle)
-            temperature = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
-            util = pynvml.nvmlDeviceGetUtilizationRates(handle)
+            handle = self.handle(idx)
+            info = nvml.nvmlDeviceGetMemoryInfo(handle)
+            power = nvml.nvmlDeviceGetPowerUsage(handle)
+            limit = nvml.nvmlDeviceGetPowerManagementLimit(handle)
+            temperature = nvml.nvmlDeviceGetTemperature(handle, nvml.NVML_TEMPERATURE_GPU)
+            util = nvml.nvmlDeviceGetUtilizationRates(handle)
             return GPUDevice(
                 idx=idx,
-                uid=pynvml.nvmlDeviceGetUUID(handle),
+                uid=nvml.nvmlDeviceGetUUID(handle),
                 memory_used=info.used,      # type: ignore
                 memory_total=info.total,    # type: ignore
                 power_usage=power / 1000,
                 power_limit=limit / 1000,
-                temperature=temperature, 
+                temperature=temperature,
                 util=util.gpu               # type: ignore
             )
-        except pynvml.NVMLError:
+        except nvml.NVMLError:
             return None
 
+    def query_processes(self, idx: int) -> list[GPUProcessInfo]:
+        info = self.nvml.nvmlDeviceGetComputeRunningProcesses(self.handle(idx))
+        return [
+            GPUProcessInfo(
+                pid=proc.pid,
+                gpu_id=idx,
+                gpu_memory_used=proc.usedGpuMemory,
+            ) for proc in info
+        ]
+
+@dataclasses.dataclass
+class GPUSnapshot:
+    time: float
+    devices: list[GPUDevice]
+    processes: dict[int, list[GPUProcessInfo]]
+
+    def device_count(self) -> int:
+        return len(self.processes)
+
+    def processes_on(self, gpu_ids: Optional[list[int]] = None) -> dict[int, list[GPUProcessInfo]]:
+        if gpu_ids is None:
+            return dict(self.processes)
+        for gpu_id in gpu_ids:
+            if not gpu_id in self.processes:
+                raise InvalidInputError(f"GPU ID {gpu_id} is invalid")
+        return {gpu_id: self.processes[gpu_id] for gpu_id in gpu_ids}
+
+class GPUSampler:
+    """
+    Sample devices and processes of all GPUs in one batch,
+    the snapshot is reused until it is older than `max_age` seconds.
+    """
+    def __init__(self, handler: Optional[GPUHandler] = None, max_age: float = 1.0):
+        self._handler = handler
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot: Optional[GPUSnapshot] = None
+
+    @property
+    def handler(self) -> GPUHandler:
+        if self._handler is None:
+            self._handler = GPUHandler()
+        return self._handler
+
+    def device_count(self) -> int:
+        return self.handler.device_count()
+
+    def snapshot(self, max_age: Optional[float] = None) -> GPUSnapshot:
+        if max_age is None:
+            max_age = self.max_age
+        with self._lock:
+            if self._snapshot is None or time.time() - self._snapshot.time > max_age:
+                self._snapshot = self._sample()
+            return self._snapshot
+
+    def _sample(self) -> GPUSnapshot:
+        handler = self.handler
+        with NVML_SAMPLE_SECONDS.time():
+            n_devices = handler.device_count()
+            return GPUSnapshot(
+                time=time.time(),
+                devices=handler.all_devices(),
+                processes={i: handler.query_processes(i) for i in range(n_devices)},
+            )
+
+__g_sampler: Optional[GPUSampler] = None
+__g_sampler_pid: Optional[int] = None
+__g_sampler_lock = threading.Lock()
+def get_gpu_sampler() -> GPUSampler:
+    """ Return the process-wide GPU sampler, which keeps the NVML session initialized """
+    global __g_sampler, __g_sampler_pid
+    with __g_sampler_lock:
+        # NVML session should not be shared with forked processes
+        if __g_sampler is None or __g_sampler_pid != os.getpid():
+            __g_sampler = GPUSampler()
+            __g_sampler_pid = os.getpid()
+        return __g_sampler
+
+
+class FakeNVML:
+    """
+    An in-memory stand-in of the `pynvml` binding, for running the GPU engine without GPUs.
+    Only the functions used by `GPUHandler` are implemented.
+    """
+    NVMLError = pynvml.NVMLError
+    NVML_TEMPERATURE_GPU = pynvml.NVML_TEMPERATURE_GPU
+
+    @dataclasses.dataclass
+    class Device:
+        uid: str
+        memory_total: int = 80 * 1024**3
+        memory_used: int = 0
+        power_usage: int = 60_000           # mW
+        power_limit: int = 300_000          # mW
+        temperature: int = 40
+        util: int = 0
+        processes: list[tuple[int, int]] = dataclasses.field(default_factory=list)     # (pid, used memory)
+
+    def __init__(self, n_devices: int = 8):
+        self.devices = [FakeNVML.Device(uid=f"GPU-fake-{i}") for i in range(n_devices)]
+        self.n_init = 0
+        self.n_calls = 0
+
+    def _dev(self, handle) -> "FakeNVML.Device":
+        self.n_calls += 1
+        return self.devices[handle]
+
+    def nvmlInit(self): self.n_init += 1
+    def nvmlShutdown(self): self.n_init -= 1
+    def nvmlDeviceGetCount(self):
+        self.n_calls += 1
+        return len(self.devices)
+    def nvmlDeviceGetHandleByIndex(self, idx: int):
+        self.n_calls += 1
+        if not 0 <= idx < len(self.devices):
+            raise pynvml.NVMLError(pynvml.NVML_ERROR_INVALID_ARGUMENT)
+        return idx
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        d = self._dev(handle)
+        return type("c_nvmlMemory_t", (), {"used": d.memory_used, "total": d.memory_total})()
+    def nvmlDeviceGetPowerUsage(self, handle): return self._dev(handle).power_usage
+    def nvmlDeviceGetPowerManagementLimit(self, handle): return self._dev(handle).power_limit
+    def nvmlDeviceGetTemperature(self, handle, _): return self._dev(handle).temperature
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        return type("c_nvmlUtilization_t", (), {"gpu": self._dev(handle).util, "memory": 0})()
+    def nvmlDeviceGetUUID(self, handle): return self._dev(handle).uid
+    def nvmlDeviceGetComputeRunningProcesses(self, handle):
+        return [
+            type("c_nvmlProcessInfo_t", (), {"pid": pid, "usedGpuMemory": mem})()
+            for pid, mem in self._dev(handle).processes
+        ]
+
 if __name__ == "__main__":
-    print(list_processes_on_gpus([0, 1]))
\ No newline at end of file
+    nvml = FakeNVML(n_devices=8)
+    nvml.devices[0].processes.append((1234, 1024**3))
+    sampler = GPUSampler(GPUHandler(nvml))
+    for _ in range(100):
+        snapshot = sampler.snapshot()
+    print(snapshot.processes_on([0, 1]))
+    print(f"NVML sessions: {nvml.n_init}, NVML calls for 100 snapshots: {nvml.n_calls}")
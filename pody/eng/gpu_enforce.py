@@ -0,0 +1,212 @@
+"""
+GPU quota enforcement.
+The GPUs used by a user are the union of the GPUs used by the processes of all of their containers,
+a container is the unit of enforcement: when a user is over `gpu_count`, the newest containers
+that do not fit are warned, stopped (SIGTERM) after a grace period, and killed (SIGKILL)
+if they still hold GPUs after another period.
+The decision logic (`decide`) only depends on the usage snapshot and the enforcement state.
+"""
+import time, dataclasses
+from typing import Callable, Literal, Optional
+
+import docker.errors
+
+from .docker import DockerController
+from .resmon import ProcessIter, ResourceMonitorDatabase
+from .nparse import split_name_component
+from .log import get_logger
+
+@dataclasses.dataclass(frozen=True)
+class ContainerGPUUsage:
+    container: str
+    username: str
+    gpus: frozenset[int]
+    tenure: float       # seconds since the earliest GPU process of the container started
+
+EnforceAction = Literal['warn', 'stop', 'kill', 'resolve']
+
+@dataclasses.dataclass
+class Decision:
+    action: EnforceAction
+    container: str
+    username: str
+    gpus: list[int]     # GPUs used by the user
+    quota: int
+    reason: str
+
+@dataclasses.dataclass
+class EnforcementState:
+    """ Containers under enforcement, container name -> time of the warning / of the last stop or kill signal """
+    warned: dict[str, float] = dataclasses.field(default_factory=dict)
+    stopped: dict[str, float] = dataclasses.field(default_factory=dict)
+
+def over_quota_containers(usages: list[ContainerGPUUsage], quota: int) -> list[ContainerGPUUsage]:
+    """ Containers of one user to remove, the oldest containers are kept as long as the union of their GPUs fits """
+    kept: set[int] = set()
+    over = []
+    for u in sorted(usages, key=lambda u: -u.tenure):
+        if len(kept | u.gpus) <= quota:
+            kept |= u.gpus
+        else:
+            over.append(u)
+    return over
+
+def decide(
+    usages: list[ContainerGPUUsage],
+    quotas: dict[str, int],
+    state: EnforcementState,
+    now: float,
+    grace: float,
+    kill_after: float,
+    ) -> list[Decision]:
+    """
+    Decide the actions for a usage snapshot, the state is updated in place.
+    - quotas: username -> gpu_count, -1 or missing means no limit
+    - grace: seconds from the warning to the stop signal
+    - kill_after: seconds from the stop signal to the kill signal, repeated while the container holds GPUs
+    """
+    by_user: dict[str, list[ContainerGPUUsage]] = {}
+    for u in usages:
+        by_user.setdefault(u.username, []).append(u)
+
+    decisions: list[Decision] = []
+    over_names: set[str] = set()
+    for username, user_usages in sorted(by_user.items()):
+        quota = quotas.get(username, -1)
+        if quota < 0:
+            continue
+        used = sorted(set().union(*(u.gpus for u in user_usages)))
+        for u in over_quota_containers(user_usages, quota):
+            over_names.add(u.container)
+            def make(action: EnforceAction, reason: str):
+                decisions.append(Decision(action, u.container, username, used, quota, reason))
+            if u.container in state.stopped:
+                if now - state.stopped[u.container] >= kill_after:
+                    state.stopped[u.container] = now
+                    make('kill', f"still holding GPUs {kill_after:.0f}s after the stop signal")
+            elif u.container in state.warned:
+                if now - state.warned[u.container] >= grace:
+                    state.stopped[u.container] = now
+                    make('stop', f"user over GPU quota for {grace:.0f}s, {len(used)} GPUs used, quota {quota}")
+            else:
+                state.warned[u.container] = now
+                make('warn', f"user over GPU quota, {len(used)} GPUs used, quota {quota}, stopping in {grace:.0f}s")
+
+    usage_by_name = {u.container: u for u in usages}
+    for name in sorted(set(state.warned) - over_names):
+        u = usage_by_name.get(name)
+        decisions.append(Decision(
+            'resolve', name, u.username if u else "", sorted(u.gpus) if u else [], quotas.get(u.username, -1) if u else -1,
+            "within GPU quota" if u else "no GPU process",
+        ))
+        state.warned.pop(name, None)
+        state.stopped.pop(name, None)
+    return decisions
+
+def leave_info(docker_con: DockerController, container_name: str, info: str, level: str = "info"):
+    """ Leave a message in the container under /log/pody """
+    info = info.replace("'", "")
+    curr_time_str = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+    logdir = "/log/pody"
+    fname = f"{curr_time_str}.{level}.log"
+    docker_con.exec_container_bash(container_name, f"mkdir -p {logdir} && echo '{info}' > {logdir}/{fname}")
+
+class GPUEnforcer:
+    """
+    Poll the GPU processes, decide and act, the enforcement state is kept between polls.
+    - quota_of: username -> gpu_count
+    - is_user: whether the username belongs to a registered user
+    """
+    def __init__(
+        self,
+        process_iter: ProcessIter,
+        quota_of: Callable[[str], int],
+        is_user: Callable[[str], bool],
+        docker_con: DockerController,
+        resmon_db: Optional[ResourceMonitorDatabase] = None,
+        grace: float = 30,
+        kill_after: float = 30,
+        ):
+        self.process_iter = process_iter
+        self.quota_of = quota_of
+        self.is_user = is_user
+        self.docker_con = docker_con
+        self.resmon_db = resmon_db
+        self.grace = grace
+        self.kill_after = kill_after
+        self.state = EnforcementState()
+        self.logger = get_logger('daemon')
+
+    def snapshot(self) -> list[ContainerGPUUsage]:
+        gpus: dict[str, set[int]] = {}
+        tenure: dict[str, float] = {}
+        for p, _ in self.process_iter.gpu_process():
+            gpus.setdefault(p.container_name, set()).add(p.gproc.gpu_id)    # type: ignore
+            tenure[p.container_name] = max(tenure.get(p.container_name, 0), p.cproc.uptime)
+        usages = []
+        valid_user: dict[str, bool] = {}
+        for name in gpus:
+            name_sp = split_name_component(name, check=True)
+            if not name_sp:
+                continue
+            username = name_sp['username']
+            if username not in valid_user:
+                valid_user[username] = self.is_user(username)
+            if valid_user[username]:
+                usages.append(ContainerGPUUsage(name, username, frozenset(gpus[name]), tenure[name]))
+        return usages
+
+    def _act(self, d: Decision):
+        try:
+            match d.action:
+                case 'warn':
+                    leave_info(self.docker_con, d.container, f"GPU quota exceeded, the container will be stopped in {self.grace:.0f}s. {d.reason}.", "critical")
+                case 'stop':
+                    leave_info(self.docker_con, d.container, f"Container stopped due to GPU quota exceeded. {d.reason}.", "critical")
+                    self.docker_con.client.api.kill(d.container, signal="SIGTERM")
+                case 'kill':
+                    self.docker_con.client.api.kill(d.container, signal="SIGKILL")
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            self.logger.error(f"GPU enforcement [{d.action}] on {d.container} failed: {e}")
+
+    def poll(self, now: Optional[float] = None) -> list[Decision]:
+        usages = self.snapshot()
+        quotas = {username: self.quota_of(username) for username in {u.username for u in usages}}
+        decisions = decide(usages, quotas, self.state, time.time() if now is None else now, self.grace, self.kill_after)
+        for d in decisions:
+            log = self.logger.info if d.action == 'resolve' else self.logger.warning
+            log(f"GPU enforcement [{d.action}] {d.container} of {d.username}: {d.reason}")
+            self._act(d)
+        if decisions and self.resmon_db is not None:
+            self.resmon_db.record_enforcement(decisions)
+        return decisions
+
+
+if __name__ == "__main__":
+    # simulated snapshots of a user with GPU quota 2 on an 8-GPU box, polled every 5s
+    def usage(name: str, gpus: set[int], tenure: float):
+        return ContainerGPUUsage(name, "alice", frozenset(gpus), tenure)
+
+    state = EnforcementState()
+    quotas = {"alice": 2, "bob": -1}
+    timeline = [
+        (0, [usage("pd-alice-a", {0, 1}, 3600)]),
+        (5, [usage("pd-alice-a", {0, 1}, 3605), usage("pd-alice-b", {2}, 1)]),       # over: b is newest
+        (20, [usage("pd-alice-a", {0, 1}, 3620), usage("pd-alice-b", {2}, 16)]),
+        (35, [usage("pd-alice-a", {0, 1}, 3635), usage("pd-alice-b", {2}, 31)]),     # grace passed: stop b
+        (70, [usage("pd-alice-a", {0, 1}, 3670), usage("pd-alice-b", {2}, 66)]),     # SIGTERM ignored: kill b
+        (75, [usage("pd-alice-a", {0, 1}, 3675)]),                                   # b gone
+        (80, [usage("pd-alice-a", {0, 1}, 3680), usage("pd-alice-c", {1}, 2)]),      # c shares GPU 1, within quota
+        (85, [usage("pd-alice-a", {0, 1, 2, 3}, 3685)]),                             # one container over by itself
+    ]
+    for t, usages in timeline:
+        for d in decide(usages, quotas, state, now=t, grace=30, kill_after=30):
+            print(f"t={t:3d}s {d.action:7s} {d.container:10s} gpus={d.gpus} quota={d.quota} ({d.reason})")
+
+    n = 10_000
+    big = [ContainerGPUUsage(f"pd-u{i % 50}-c{i}", f"u{i % 50}", frozenset({i % 8}), i) for i in range(n)]
+    t = time.perf_counter()
+    decide(big, {f"u{i}": 2 for i in range(50)}, EnforcementState(), now=0, grace=30, kill_after=30)
+    print(f"decide on {n} containers: {(time.perf_counter() - t) * 1000:.1f}ms")
@@ -0,0 +1,328 @@
+"""
+Persistent job queue for slow pod operations (create, commit, delete).
+Jobs are recorded in DATA_HOME/jobs.db and run on a bounded worker pool,
+with a concurrency limit per job kind to protect the docker daemon.
+A job belongs to the process that queued it (the `pid` and `pid_start` columns, as pids are reused,
+e.g. the server is often pid 1 in a container), queued jobs of a stopped process are adopted by the next process that starts,
+jobs that were running in a stopped process are marked failed, as they may be half done.
+"""
+import os, json, time, uuid, sqlite3, threading, dataclasses
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Literal, Optional
+
+import psutil
+
+from .db import DatabaseAbstract
+from .log import get_logger
+from ..config import DATA_HOME
+
+JobStatus = Literal['queued', 'running', 'done', 'failed']
+
+class JobError(Exception):
+    """ Failure of a job with the HTTP status of the equivalent request """
+    def __init__(self, message: str, code: int = 500):
+        super().__init__(message)
+        self.code = code
+
+@dataclasses.dataclass
+class JobRecord:
+    id: str
+    kind: str
+    username: str
+    params: dict
+    status: JobStatus
+    result: Any
+    error: Optional[str]
+    error_code: Optional[int]
+    created: float
+    started: Optional[float]
+    finished: Optional[float]
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+JobHandler = Callable[[JobRecord], Any]     # job -> JSON-serializable result
+
+def _process_start(pid: int) -> Optional[float]:
+    """ Start time of the process, identifies it together with the pid, None if it does not exist """
+    try:
+        return round(psutil.Process(pid).create_time(), 2)
+    except psutil.NoSuchProcess:
+        return None
+
+def _json_default(o):
+    return dataclasses.asdict(o) if dataclasses.is_dataclass(o) and not isinstance(o, type) else str(o)
+
+class JobDatabase(DatabaseAbstract):
+    COLUMNS = "id, kind, username, params, status, result, error, error_code, created, started, finished"
+
+    @property
+    def conn(self): return self._conn
+    def __init__(self):
+        DATA_HOME.mkdir(exist_ok=True)
+        self._conn = self.open_shared(DATA_HOME / "jobs.db", self.__setup)
+
+    @staticmethod
+    def __setup(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                username TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                error_code INTEGER,
+                pid INTEGER,
+                pid_start REAL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            );
+            """
+        )
+        # added after the table, the pid alone is ambiguous after a restart
+        cursor.execute("PRAGMA table_info(job)")
+        if 'pid_start' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE job ADD COLUMN pid_start REAL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_status ON job (status)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_username_created ON job (username, created)")
+
+    @staticmethod
+    def _record(row: tuple) -> JobRecord:
+        id, kind, username, params, status, result, error, error_code, created, started, finished = row
+        return JobRecord(
+            id, kind, username, json.loads(params), status,
+            json.loads(result) if result is not None else None,
+            error, error_code, created, started, finished,
+        )
+
+    def create(self, kind: str, username: str, params: dict) -> JobRecord:
+        record = JobRecord(uuid.uuid4().hex, kind, username, params, 'queued', None, None, None, time.time(), None, None)
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO job (id, kind, username, params, status, pid, pid_start, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (record.id, kind, username, json.dumps(params), record.status, os.getpid(), _process_start(os.getpid()), record.created)
+            )
+        return record
+
+    def claim(self, job_id: str) -> bool:
+        """ Mark the queued job running in this process, False if it is not queued anymore """
+        with self.transaction() as cursor:
+            r = cursor.execute(
+                "UPDATE job SET status = 'running', pid = ?, pid_start = ?, started = ? WHERE id = ? AND status = 'queued'",
+                (os.getpid(), _process_start(os.getpid()), time.time(), job_id)
+            )
+            return r.rowcount == 1
+
+    def finish(self, job_id: str, result: Any = None, error: Optional[str] = None, error_code: Optional[int] = None):
+        with self.transaction() as cursor:
+            cursor.execute(
+                "UPDATE job SET status = ?, result = ?, error = ?, error_code = ?, finished = ? WHERE id = ?",
+                (
+                    'failed' if error is not None else 'done',
+                    json.dumps(result, default=_json_default) if error is None else None,
+                    error, error_code, time.time(), job_id,
+                )
+            )
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self.cursor() as cursor:
+            cursor.execute(f"SELECT {self.COLUMNS} FROM job WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+        return self._record(row) if row else None
+
+    def list_jobs(self, username: Optional[str] = None, limit: int = 20) -> list[JobRecord]:
+        """ Latest jobs first, of all users if username is None """
+        with self.cursor() as cursor:
+            if username is None:
+                cursor.execute(f"SELECT {self.COLUMNS} FROM job ORDER BY created DESC LIMIT ?", (limit,))
+            else:
+                cursor.execute(f"SELECT {self.COLUMNS} FROM job WHERE username = ? ORDER BY created DESC LIMIT ?", (username, limit))
+            return [self._record(row) for row in cursor.fetchall()]
+
+    def recover(self) -> list[JobRecord]:
+        """
+        Adopt the queued jobs of stopped processes, return them to be run by this process,
+        running jobs of stopped processes are marked failed
+        """
+        with self.transaction(mode='IMMEDIATE') as cursor:
+            def is_orphan(pid: Optional[int], pid_start: Optional[float]) -> bool:
+                if pid is None: return True
+                if pid_start is None:
+                    # recorded before pid_start, this process is new at startup even if it got the same pid
+                    return pid == os.getpid() or not psutil.pid_exists(pid)
+                return _process_start(pid) != pid_start
+            cursor.execute("SELECT id, status, pid, pid_start FROM job WHERE status IN ('queued', 'running')")
+            orphans = [(id, status) for id, status, pid, pid_start in cursor.fetchall() if is_orphan(pid, pid_start)]
+            cursor.executemany(
+                "UPDATE job SET status = 'failed', error = ?, error_code = 500, finished = ? WHERE id = ?",
+                [("Interrupted, the server stopped while the job was running", time.time(), id) for id, status in orphans if status == 'running']
+            )
+            adopted = [id for id, status in orphans if status == 'queued']
+            cursor.executemany(
+                "UPDATE job SET pid = ?, pid_start = ? WHERE id = ?",
+                [(os.getpid(), _process_start(os.getpid()), id) for id in adopted]
+            )
+            cursor.execute(
+                f"SELECT {self.COLUMNS} FROM job WHERE id IN ({','.join('?' * len(adopted))}) ORDER BY created", adopted
+            )
+            return [self._record(row) for row in cursor.fetchall()]
+
+    def prune(self, retention_days: int) -> int:
+        if retention_days < 0: return 0
+        with self.transaction() as cursor:
+            r = cursor.execute(
+                "DELETE FROM job WHERE status IN ('done', 'failed') AND finished < ?",
+                (time.time() - retention_days * 86400,)
+            )
+            return r.rowcount
+
+# kind -> handler, registered by the modules that define the operations
+_job_handlers: dict[str, JobHandler] = {}
+def register_job_handler(kind: str, handler: JobHandler):
+    _job_handlers[kind] = handler
+
+class JobEngine:
+    """
+    Run jobs on a worker pool, jobs beyond the limit of their kind wait in a queue of the kind,
+    so that a burst of one kind does not hold the workers needed by the others.
+    - max_workers: size of the worker pool
+    - limit_of: kind -> max concurrent jobs of the kind in this process
+    """
+    def __init__(
+        self,
+        db: Optional[JobDatabase] = None,
+        max_workers: int = 8,
+        limit_of: Callable[[str], int] = lambda _: 4,
+        handlers: Optional[dict[str, JobHandler]] = None,
+        ):
+        self.db = db if db is not None else JobDatabase()
+        self.limit_of = limit_of
+        self.handlers = handlers if handlers is not None else _job_handlers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pody-job")
+        self.logger = get_logger('engine')
+        self._lock = threading.Lock()
+        self._pending: dict[str, deque[str]] = {}
+        self._running: dict[str, int] = {}
+
+    def submit(self, kind: str, username: str, params: dict) -> JobRecord:
+        if not kind in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        record = self.db.create(kind, username, params)
+        self._enqueue(kind, record.id)
+        self.logger.debug(f"Job {record.id} [{kind}] queued for {username}")
+        return record
+
+    def recover(self) -> int:
+        """ Resume the queued jobs left by stopped processes, called at server startup """
+        records = self.db.recover()
+        for record in records:
+            self._enqueue(record.kind, record.id)
+        if records:
+            self.logger.info(f"{len(records)} queued jobs resumed")
+        return len(records)
+
+    def _enqueue(self, kind: str, job_id: str):
+        with self._lock:
+            self._pending.setdefault(kind, deque()).append(job_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            for kind, pending in self._pending.items():
+                while pending and self._running.get(kind, 0) < max(1, self.limit_of(kind)):
+                    self._running[kind] = self._running.get(kind, 0) + 1
+                    self.pool.submit(self._run, kind, pending.popleft())
+
+    def _run(self, kind: str, job_id: str):
+        try:
+            if not self.db.claim(job_id):
+                return
+            record = self.db.get(job_id)
+            assert record is not None
+            try:
+                result = self.handlers[kind](record)
+            except JobError as e:
+                self.db.finish(job_id, error=str(e), error_code=e.code)
+            except Exception as e:
+                self.logger.exception(f"Job {job_id} [{kind}] failed: {e}")
+                self.db.finish(job_id, error=f"{type(e).__name__}: {e}", error_code=500)
+            else:
+                self.db.finish(job_id, result=result)
+                self.logger.info(f"Job {job_id} [{kind}] done")
+        except Exception as e:
+            self.logger.exception(f"Job {job_id} [{kind}] could not be run: {e}")
+        finally:
+            with self._lock:
+                self._running[kind] -= 1
+            self._dispatch()
+
+    def pending(self) -> dict[str, int]:
+        with self._lock:
+            return {kind: len(q) for kind, q in self._pending.items()}
+
+__g_engine: Optional[JobEngine] = None
+__g_engine_pid: Optional[int] = None
+__g_engine_lock = threading.Lock()
+def get_job_engine() -> JobEngine:
+    """ Return the process-wide job engine, the limits are read from the `job` section of the configuration """
+    from ..config import config
+    global __g_engine, __g_engine_pid
+    with __g_engine_lock:
+        if __g_engine is None or __g_engine_pid != os.getpid():
+            __g_engine = JobEngine(
+                max_workers=config().job.max_workers,
+                limit_of=lambda kind: getattr(config().job, f"max_{kind}", config().job.max_workers),
+            )
+            __g_engine_pid = os.getpid()
+        return __g_engine
+
+def recover_jobs():
+    """ Prune old jobs and resume the queued jobs of stopped processes, called at server startup """
+    from ..config import config
+    engine = get_job_engine()
+    engine.db.prune(config().job.retention_days)
+    engine.recover()
+
+
+if __name__ == "__main__":
+    # a burst of slow commits should not delay creates, and the limit of each kind holds
+    import random
+    peak: dict[str, int] = {}
+    running: dict[str, int] = {}
+    peak_lock = threading.Lock()
+    def make_handler(kind: str, duration: float):
+        def handler(job: JobRecord):
+            params = job.params
+            with peak_lock:
+                running[kind] = running.get(kind, 0) + 1
+                peak[kind] = max(peak.get(kind, 0), running[kind])
+            time.sleep(duration * random.uniform(0.5, 1.5))
+            with peak_lock:
+                running[kind] -= 1
+            if params.get("fail"): raise JobError("Simulated failure", 409)
+            return {"ok": params["i"]}
+        return handler
+
+    limits = {"commit": 2, "create": 4}
+    engine = JobEngine(
+        max_workers=8, limit_of=lambda kind: limits[kind],
+        handlers={"commit": make_handler("commit", 1.0), "create": make_handler("create", 0.1)},
+    )
+    t = time.time()
+    commits = [engine.submit("commit", "bench", {"i": i}) for i in range(8)]
+    creates = [engine.submit("create", "bench", {"i": i, "fail": i == 3}) for i in range(20)]
+    def wait_all(records: list[JobRecord]) -> float:
+        while not all(engine.db.get(r.id).is_finished for r in records):     # type: ignore
+            time.sleep(0.02)
+        return time.time() - t
+    print(f"20 creates finished in {wait_all(creates):.2f}s behind a burst of 8 slow commits")
+    print(f"8 commits finished in {wait_all(commits):.2f}s")
+    print(f"peak concurrency {peak}, limits {limits}")
+    failed = engine.db.get(creates[3].id)
+    print(f"failed job: status={failed.status} code={failed.error_code} error={failed.error}")   # type: ignore
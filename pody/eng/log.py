@@ -1,7 +1,7 @@
 from ..config import DATA_HOME
-from typing import TypeVar, Callable, Literal, Optional
-from concurrent.futures import ThreadPoolExecutor
-import time
+from .db import open_connection
+from typing import Any, Iterator, TypeVar, Callable, Literal, Optional
+import os, time, atexit, threading, collections, traceback
 import sqlite3
 from functools import wraps
 import dataclasses
@@ -38,41 +38,150 @@ class BCOLORS:
     LIGHTMAGENTA = '\033[95m'
     LIGHTCYAN = '\033[96m'
 
-_thread_pool = ThreadPoolExecutor(max_workers=2)
-def thread_wrap(func):
-    def wrapper(*args, **kwargs):
-        _thread_pool.submit(func, *args, **kwargs)
-    return wrapper
+class LogPipeline:
+    """
+    Records of all loggers of the process go through one bounded queue to a single writer thread,
+    which runs the handlers, so the caller only pays for creating the record,
+    and records are handled in the order they are logged.
+    - max_size: records above this are dropped (below WARNING) or wait for the writer (WARNING and above)
+    - flush_interval: buffered handlers are flushed at least this often, in seconds
+    """
+    def __init__(self, max_size: int = 65536, flush_interval: float = 1.0, block_timeout: float = 1.0):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        # deque append / popleft are atomic, producers never take a lock
+        self._queue: collections.deque[tuple[Optional[logging.Logger], Any]] = collections.deque()
+        self._wakeup = threading.Event()
+        self._handlers: set[logging.Handler] = set()
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        self.handled = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # forked child, the records of the parent are handled by the parent
+            self._queue.clear()
+            self._wakeup = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, logger: logging.Logger, record: logging.LogRecord):
+        self._ensure_writer()
+        if self._stopped:
+            logging.Logger.callHandlers(logger, record)
+            return
+        if len(self._queue) >= self.max_size:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            self.blocked += 1
+            deadline = time.monotonic() + self.block_timeout
+            while len(self._queue) >= self.max_size and time.monotonic() < deadline:
+                self._wakeup.set()
+                time.sleep(0.001)
+        self._queue.append((logger, record))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _flush_handlers(self):
+        for handler in list(self._handlers):
+            try:
+                handler.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            while self._queue:
+                logger, item = self._queue.popleft()
+                if logger is None:
+                    # flush marker, all records before it are handled
+                    self._flush_handlers()
+                    item.set()
+                    continue
+                self._handlers.update(logger.handlers)
+                try:
+                    logging.Logger.callHandlers(logger, item)
+                except Exception:
+                    traceback.print_exc()
+                self.handled += 1
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_handlers()
+                last_flush = time.monotonic()
+
+    def flush(self, timeout: float = 5):
+        """ Wait until the records queued before the call are handled and written """
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.append((None, done))
+        self._wakeup.set()
+        done.wait(timeout)
+
+    def stop(self):
+        """ Handle the remaining records, later records are handled in the calling thread """
+        self.flush()
+        self._stopped = True
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": len(self._queue),
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+        }
+
+_pipeline = LogPipeline()
+atexit.register(_pipeline.stop)
+
+def get_log_pipeline() -> LogPipeline:
+    return _pipeline
 
 class BaseLogger(logging.Logger):
     def finalize(self):
-        for handler in self.handlers:
+        _pipeline.flush()
+        for handler in self.handlers[:]:
             handler.flush()
             handler.close()
             self.removeHandler(handler)
-    
-    @thread_wrap
-    def debug(self, *args, **kwargs): super().debug(*args, **kwargs)
-    @thread_wrap
-    def info(self, *args, **kwargs): super().info(*args, **kwargs)
-    @thread_wrap
-    def warning(self, *args, **kwargs): super().warning(*args, **kwargs)
-    @thread_wrap
-    def error(self, *args, **kwargs): super().error(*args, **kwargs)
-    @thread_wrap
-    def critical(self, *args, **kwargs): super().critical(*args, **kwargs)
-    @thread_wrap
-    def exception(self, *args, **kwargs): super().exception(*args, **kwargs)
-
-class SQLiteFileHandler(logging.FileHandler):
-    def __init__(self, filename, *args, **kwargs):
-        super().__init__(filename, *args, **kwargs)
-        self._db_file = filename
-        self._buffer: list[logging.LogRecord] = []
-        self._buffer_size = 100
-        self._flush_interval = 10
-        self._last_flush = time.time()
-        conn = sqlite3.connect(self._db_file, check_same_thread=False)
+
+    def callHandlers(self, record: logging.LogRecord):
+        # format the message now, the arguments may change before the writer handles the record
+        record.msg = record.getMessage()
+        record.args = None
+        _pipeline.put(self, record)
+
+# Log database layout:
+# - `log` table, rows are partitioned by `day` (days since the epoch, UTC), which is the unit of retention
+# - indexes on `created_epoch`, `level` and `day`, pagination is by `id` (keyset)
+# - `log_fts`, full-text index of the messages if the SQLite build has FTS5
+LOG_DB_VERSION = 1
+
+def log_day(epoch: float) -> int:
+    return int(epoch // 86400)
+
+def setup_log_db(conn: sqlite3.Connection):
+    """ Create or upgrade the log database schema """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log'").fetchone() is None:
+        # pages of pruned partitions are given back by incremental vacuum,
+        # the setting takes effect by a vacuum of the still empty file (the header is written when switching to WAL)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -81,55 +190,208 @@ class SQLiteFileHandler(logging.FileHandler):
                 name TEXT,
                 levelname VARCHAR(16),
                 level INTEGER,
-                message TEXT
+                message TEXT,
+                day INTEGER
             )
         ''')
+        if conn.execute("PRAGMA user_version").fetchone()[0] < LOG_DB_VERSION:
+            if 'day' not in {row[1] for row in conn.execute("PRAGMA table_info(log)")}:
+                # log files written before v0.4.2
+                conn.execute("ALTER TABLE log ADD COLUMN day INTEGER")
+                conn.execute("UPDATE log SET day = CAST(created_epoch / 86400 AS INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_log_created_epoch ON log (created_epoch)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_log_level ON log (level)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_log_day ON log (day)")
+            try:
+                conn.execute("CREATE VIRTUAL TABLE log_fts USING fts5(message, content='log', content_rowid='id')")
+            except sqlite3.OperationalError:
+                pass    # no FTS5, message search falls back to LIKE
+            else:
+                conn.execute('''
+                    CREATE TRIGGER log_fts_insert AFTER INSERT ON log BEGIN
+                        INSERT INTO log_fts (rowid, message) VALUES (new.id, new.message);
+                    END
+                ''')
+                conn.execute('''
+                    CREATE TRIGGER log_fts_delete AFTER DELETE ON log BEGIN
+                        INSERT INTO log_fts (log_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                    END
+                ''')
+                conn.execute("INSERT INTO log_fts (log_fts) VALUES ('rebuild')")
+            conn.execute(f"PRAGMA user_version = {LOG_DB_VERSION}")
+    except Exception as e:
+        conn.rollback()
+        raise e
+    else:
         conn.commit()
-        conn.close()
-    
-    def flush(self): 
-        def format_time(self, record: logging.LogRecord):
+
+def log_has_fts(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'log_fts'").fetchone() is not None
+
+def delete_log_records(conn: sqlite3.Connection, where: str, params: tuple = (), batch_size: int = 5000) -> int:
+    """ Delete in small transactions, so that writers of other processes are not blocked for long """
+    deleted = 0
+    while True:
+        with conn:
+            n = conn.execute(
+                f"DELETE FROM log WHERE id IN (SELECT id FROM log WHERE {where} LIMIT ?)", (*params, batch_size)
+            ).rowcount
+        deleted += n
+        if n < batch_size:
+            return deleted
+
+def prune_log_db(conn: sqlite3.Connection, retention_days: int = -1, max_size: int = -1) -> int:
+    """
+    Drop whole days of records, return the number of deleted records.
+    - retention_days: keep this many days including today, -1 for no limit
+    - max_size: drop the oldest days until the data is below this many bytes, today is always kept, -1 for no limit
+    """
+    today = log_day(time.time())
+    deleted = 0
+    if retention_days > 0:
+        deleted += delete_log_records(conn, "day < ?", (today - retention_days + 1,))
+    if max_size > 0:
+        def used_size() -> int:
+            page_size, page_count, freelist_count = (
+                conn.execute(f"PRAGMA {p}").fetchone()[0] for p in ("page_size", "page_count", "freelist_count")
+            )
+            return page_size * (page_count - freelist_count)
+        while used_size() > max_size:
+            oldest = conn.execute("SELECT MIN(day) FROM log").fetchone()[0]
+            if oldest is None or oldest >= today:
+                break
+            deleted += delete_log_records(conn, "day <= ?", (oldest,))
+    if deleted:
+        conn.executescript("PRAGMA incremental_vacuum")     # one page is freed per step, run to completion
+    return deleted
+
+@dataclasses.dataclass
+class DBLogRecord:
+    id: int
+    created: str
+    created_epoch: float
+    name: str
+    levelname: str
+    level: int
+    message: str
+
+LOG_COLUMNS = "id, created, created_epoch, name, levelname, level, message"
+
+def eval_logline(row: sqlite3.Row):
+    return DBLogRecord(*row)
+
+def query_log(
+    conn: sqlite3.Connection,
+    level: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    grep: Optional[str] = None,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = 1000,
+    ) -> Iterator[DBLogRecord]:
+    """
+    Iterate over the records matching the filters in id order.
+    With `after_id` the oldest `limit` records after it are returned,
+    otherwise the newest `limit` records (before `before_id` if given).
+    - level: minimum level
+    - since, until: time range (epoch seconds)
+    - grep: text in the message
+    """
+    where, params = ["1"], []
+    if level is not None: where.append("level >= ?"); params.append(level)
+    if since is not None: where.append("created_epoch >= ?"); params.append(since)
+    if until is not None: where.append("created_epoch < ?"); params.append(until)
+    if before_id is not None: where.append("id < ?"); params.append(before_id)
+    if after_id is not None: where.append("id > ?"); params.append(after_id)
+    if grep:
+        if log_has_fts(conn):
+            where.append("id IN (SELECT rowid FROM log_fts WHERE log_fts MATCH ?)")
+            params.append('"' + grep.replace('"', '""') + '"*')     # phrase, the last word as prefix
+        else:
+            where.append("message LIKE ? ESCAPE '\\'")
+            params.append('%' + grep.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    cond = " AND ".join(where)
+    if after_id is None:
+        # find the first id of the page, then read the page forwards
+        row = conn.execute(f"SELECT id FROM log WHERE {cond} ORDER BY id DESC LIMIT 1 OFFSET ?", (*params, limit - 1)).fetchone()
+        if row is not None:
+            cond += " AND id >= ?"; params.append(row[0])
+    for row in conn.execute(f"SELECT {LOG_COLUMNS} FROM log WHERE {cond} ORDER BY id ASC LIMIT ?", (*params, limit)):
+        yield DBLogRecord(*row)
+
+class SQLiteFileHandler(logging.Handler):
+    """
+    Buffer records and insert them in batches through a persistent WAL connection,
+    the batch is written when it reaches `buffer_size` or on the periodic flush of the pipeline.
+    Old records are pruned every `prune_interval` seconds by the `log` section of the configuration.
+    """
+    def __init__(self, filename, buffer_size: int = 512, prune_interval: float = 3600):
+        super().__init__()
+        self._db_file = filename
+        self._buffer: list[logging.LogRecord] = []
+        self._buffer_size = buffer_size
+        self._prune_interval = prune_interval
+        self._last_prune = 0.
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        setup_log_db(self._connection())
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = open_connection(self._db_file)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _maybe_prune(self):
+        if time.time() - self._last_prune < self._prune_interval:
+            return
+        self._last_prune = time.time()
+        from ..config import config
+        from .utils import parse_storage_size
+        cfg = config().log
+        prune_log_db(
+            self._connection(),
+            retention_days=cfg.retention_days,
+            max_size=parse_storage_size(cfg.max_size) if cfg.max_size else -1,
+        )
+
+    def flush(self):
+        def format_time(record: logging.LogRecord):
             """ Create a time stamp """
             return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
         self.acquire()
         try:
-            conn = sqlite3.connect(self._db_file, check_same_thread=False)
-            conn.executemany('''
-                INSERT INTO log (created, created_epoch, name, levelname, level, message)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', [
-                (format_time(self, record), record.created, record.name, record.levelname, record.levelno, record.getMessage())
-                for record in self._buffer
-            ])
-            conn.commit()
-            conn.close()
+            if not self._buffer:
+                return
+            with self._connection() as conn:
+                conn.executemany('''
+                    INSERT INTO log (created, created_epoch, name, levelname, level, message, day)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (format_time(record), record.created, record.name, record.levelname, record.levelno, record.getMessage(), log_day(record.created))
+                    for record in self._buffer
+                ])
             self._buffer.clear()
-            self._last_flush = time.time()
+            self._maybe_prune()
         finally:
             self.release()
 
     def emit(self, record: logging.LogRecord):
         self._buffer.append(record)
-        if len(self._buffer) > self._buffer_size or time.time() - self._last_flush > self._flush_interval:
-            self.flush()
-    
+        if len(self._buffer) >= self._buffer_size:
+            try:
+                self.flush()
+            except Exception:
+                self.handleError(record)
+
     def close(self):
         self.flush()
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
         return super().close()
 
-def eval_logline(row: sqlite3.Row):
-    @dataclasses.dataclass
-    class DBLogRecord:
-        id: int
-        created: str
-        created_epoch: float
-        name: str
-        levelname: str
-        level: int
-        message: str
-    return DBLogRecord(*row)
-
-
 _fh_T = Literal['rotate', 'simple', 'daily', 'sqlite']
 __g_logger_dict: dict[str, BaseLogger] = {}
 def get_logger(
@@ -186,7 +448,8 @@ def get_logger(
     return logger
 
 def clear_handlers(logger: logging.Logger):
-    for handler in logger.handlers:
+    _pipeline.flush()
+    for handler in logger.handlers[:]:
         handler.flush()
         handler.close()
         logger.removeHandler(handler)
@@ -227,4 +490,41 @@ def log_access(
 
 __ALL__ = [
     'get_logger', 'log_access'
-]
\ No newline at end of file
+]
+
+
+if __name__ == "__main__":
+    # records/s seen by the caller and until they are in the database,
+    # with the previous per-call thread pool submit and per-batch reconnect as reference
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    N_RECORD = 50_000
+
+    class ReconnectHandler(SQLiteFileHandler):
+        def flush(self):
+            super().flush()
+            if self._conn is not None:
+                self._conn.close(); self._conn = None
+
+    with tempfile.TemporaryDirectory() as d:
+        pool = ThreadPoolExecutor(max_workers=2)
+        ref = logging.Logger("reference")
+        ref.addHandler(ReconnectHandler(pathlib.Path(d) / "reference.log.db", buffer_size=100))
+        t = time.time()
+        for i in range(N_RECORD): pool.submit(ref.debug, f"request {i}")
+        t_call = time.time() - t
+        pool.shutdown(wait=True); ref.handlers[0].flush()
+        print(f"thread pool: {N_RECORD / t_call:.0f} records/s for the caller, {N_RECORD / (time.time() - t):.0f} records/s written")
+
+        logger = get_logger("bench", log_home=pathlib.Path(d), term_level='CRITICAL', global_instance=False)
+        t = time.time()
+        for i in range(N_RECORD): logger.debug(f"request {i}")
+        t_call = time.time() - t
+        _pipeline.flush(timeout=60)
+        print(f"pipeline:    {N_RECORD / t_call:.0f} records/s for the caller, {N_RECORD / (time.time() - t):.0f} records/s written, {_pipeline.stats()}")
+
+        conn = sqlite3.connect(pathlib.Path(d) / "bench.log.db")
+        messages = [m for m, in conn.execute("SELECT message FROM log ORDER BY id")]
+        assert messages == [f"request {i}" for i in range(N_RECORD)], "records are out of order"
+        conn.close()
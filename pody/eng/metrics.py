@@ -0,0 +1,252 @@
+"""
+In-process metrics, counters and histograms rendered in the Prometheus text format.
+An observation is a dict lookup and a few increments under the lock of the metric.
+Every process (server workers, daemon workers) dumps its metrics to DATA_HOME/metrics
+every few seconds, the server merges the dumps of all live processes into its output.
+
+References:
+- https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import os, json, time, bisect, threading, inspect
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Optional, TypeVar
+
+import psutil
+
+from ..config import DATA_HOME
+
+METRICS_HOME = DATA_HOME / "metrics"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metric:
+    type = "untyped"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(l, "")) for l in self.labelnames)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(k), v if not isinstance(v, list) else [list(v[0]), v[1], v[2]]] for k, v in self._values.items()]
+        return {"type": self.type, "help": self.help, "labels": list(self.labelnames), "values": values}
+
+class Counter(Metric):
+    type = "counter"
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount   # type: ignore
+
+class Gauge(Metric):
+    type = "gauge"
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """ Value of each label set is [bucket counts (non-cumulative, +Inf last), sum, count] """
+    type = "histogram"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [[0] * (len(self.buckets) + 1), 0., 0]
+            v[0][i] += 1        # type: ignore
+            v[1] += value       # type: ignore
+            v[2] += 1           # type: ignore
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+def merge_snapshots(snapshots: list[dict[str, dict]]) -> dict[str, dict]:
+    """ Sum the values of the same metric and labels across processes """
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, m in snapshot.items():
+            target = merged.setdefault(name, {**m, "values": {}})
+            for key, value in m["values"]:
+                key = tuple(key)
+                prev = target["values"].get(key)
+                if prev is None:
+                    target["values"][key] = value
+                elif m["type"] == "histogram":
+                    if len(prev[0]) == len(value[0]):
+                        target["values"][key] = [[a + b for a, b in zip(prev[0], value[0])], prev[1] + value[1], prev[2] + value[2]]
+                else:
+                    target["values"][key] = prev + value
+    return merged
+
+def render(snapshot: dict[str, dict]) -> str:
+    """ Prometheus text exposition format (version 0.0.4) """
+    def fmt_labels(names, values, extra: Optional[tuple[str, str]] = None) -> str:
+        pairs = [(n, v) for n, v in zip(names, values)] + ([extra] if extra else [])
+        if not pairs: return ""
+        esc = lambda s: str(s).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in pairs) + "}"
+    def fmt_float(v: float) -> str:
+        return "+Inf" if v == float("inf") else repr(float(v))
+
+    lines = []
+    for name in sorted(snapshot):
+        m = snapshot[name]
+        values = m["values"].items() if isinstance(m["values"], dict) else ((tuple(k), v) for k, v in m["values"])
+        lines.append(f"# HELP {name} {m['help']}")
+        lines.append(f"# TYPE {name} {m['type']}")
+        for key, value in sorted(values):
+            if m["type"] == "histogram":
+                counts, total, count = value
+                acc = 0
+                for le, n in zip([*m["buckets"], float("inf")], counts):
+                    acc += n
+                    lines.append(f"{name}_bucket{fmt_labels(m['labels'], key, ('le', fmt_float(le)))} {acc}")
+                lines.append(f"{name}_sum{fmt_labels(m['labels'], key)} {fmt_float(total)}")
+                lines.append(f"{name}_count{fmt_labels(m['labels'], key)} {count}")
+            else:
+                lines.append(f"{name}{fmt_labels(m['labels'], key)} {fmt_float(value)}")
+    return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pody_http_request_duration_seconds", "HTTP request latency by route template and status",
+    ("method", "route", "status"),
+))  # type: ignore
+DOCKER_CALL_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pody_docker_call_duration_seconds", "Docker API call latency by controller method",
+    ("method",),
+))  # type: ignore
+NVML_SAMPLE_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pody_nvml_sample_duration_seconds", "Time to sample the devices and processes of all GPUs",
+))  # type: ignore
+DAEMON_TASK_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pody_daemon_task_duration_seconds", "Duration of daemon tasks by task and result",
+    ("task", "result"), buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+))  # type: ignore
+SQLITE_SECONDS: Histogram = REGISTRY.register(Histogram(
+    "pody_sqlite_duration_seconds", "Time SQLite connections are held, by database and access mode",
+    ("database", "mode"),
+))  # type: ignore
+LOG_RECORDS: Gauge = REGISTRY.register(Gauge(
+    "pody_log_records", "Records of the log pipeline by state, totals since the process started",
+    ("state",),
+))  # type: ignore
+
+FUNCTION_T = TypeVar('FUNCTION_T', bound=Callable)
+def timed(histogram: Histogram, **labels):
+    """ Observe the duration of each call, the `method` label defaults to the function name """
+    def decorator(fn: FUNCTION_T) -> FUNCTION_T:
+        _labels = {"method": fn.__name__, **labels} if "method" in histogram.labelnames else labels
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**_labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper    # type: ignore
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**_labels):
+                return fn(*args, **kwargs)
+        return wrapper              # type: ignore
+    return decorator
+
+def _update_process_gauges():
+    from .log import get_log_pipeline
+    for state, n in get_log_pipeline().stats().items():
+        LOG_RECORDS.set(n, state=state)
+
+def dump_metrics():
+    """ Write the metrics of this process to METRICS_HOME/<pid>.json """
+    _update_process_gauges()
+    METRICS_HOME.mkdir(parents=True, exist_ok=True)
+    path = METRICS_HOME / f"{os.getpid()}.json"
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(REGISTRY.snapshot()))
+    os.replace(tmp, path)
+
+def collect_metrics() -> str:
+    """ Render the metrics of this process and the latest dumps of other live processes """
+    _update_process_gauges()
+    snapshots = [REGISTRY.snapshot()]
+    if METRICS_HOME.exists():
+        for f in METRICS_HOME.glob("*.json"):
+            pid = int(f.stem) if f.stem.isdigit() else -1
+            if pid == os.getpid():
+                continue
+            if not psutil.pid_exists(pid):
+                f.unlink(missing_ok=True)
+                continue
+            try:
+                snapshots.append(json.loads(f.read_text()))
+            except (OSError, ValueError):
+                continue
+    return render(merge_snapshots(snapshots))
+
+__g_dumper_pid: Optional[int] = None
+__g_dumper_lock = threading.Lock()
+def start_metrics_dumper(interval: float = 5):
+    """ Dump the metrics of this process periodically in a background thread, once per process """
+    global __g_dumper_pid
+    with __g_dumper_lock:
+        if __g_dumper_pid == os.getpid():
+            return
+        __g_dumper_pid = os.getpid()
+    def _run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump_metrics()
+            except Exception:
+                pass
+    threading.Thread(target=_run, name="metrics-dumper", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # cost of an observation, and the rendered output of a small registry
+    N_OBSERVE = 1_000_000
+    h = Histogram("bench_seconds", "benchmark", ("route", "status"))
+    t = time.perf_counter()
+    for i in range(N_OBSERVE): h.observe(0.003, route="/pod/list", status="200")
+    print(f"{(time.perf_counter() - t) / N_OBSERVE * 1e9:.0f} ns per observation")
+
+    c = Counter("bench_total", "benchmark", ("route",))
+    c.inc(route="/pod/list"); c.inc(2, route='/pod/"x"')
+    other_process = {"bench_total": c.snapshot()}
+    print(render(merge_snapshots([{"bench_seconds": h.snapshot(), "bench_total": c.snapshot()}, other_process])))
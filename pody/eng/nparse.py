@@ -3,7 +3,7 @@ Name parse for containers.
 This module provides functions to validate and manipulate container/image names.
 """
 from __future__ import annotations
-from typing import TypedDict, Optional, overload, Literal, TYPE_CHECKING
+from typing import Iterable, TypedDict, Optional, overload, Literal, TYPE_CHECKING
 
 from .errors import *
 from ..config import config, Config
@@ -36,6 +36,45 @@ class InsNameComponentU(TypedDict):
     prefix: Optional[str]
     username: str
     instance: str
+class PodNameParser:
+    """ Container names of the configured name prefix: [prefix-]username-instance """
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def split(self, ins_name: str, check: bool = True) -> Optional[InsNameComponentX]:
+        ins_name_sp = ins_name.split('-')
+        if len(ins_name_sp) == 1:
+            if check:
+                return None
+            return {
+                "prefix": None,
+                "username": None,
+                "instance": ins_name
+            }
+        if len(ins_name_sp) == 2:
+            if check and self.prefix:
+                return None
+            return {
+                "prefix": None,
+                "username": ins_name_sp[0],
+                "instance": ins_name_sp[1]
+            }
+        if len(ins_name_sp) == 3:
+            if check and (not self.prefix or ins_name_sp[0] != self.prefix):
+                return None
+            return {
+                "prefix": ins_name_sp[0],
+                "username": ins_name_sp[1],
+                "instance": ins_name_sp[2]
+            }
+        return None
+
+    def format(self, username: str, instance: str) -> str:
+        return f"{self.prefix}-{username}-{instance}" if self.prefix else f"{username}-{instance}"
+
+    def user_prefix(self, username: str) -> str:
+        return f"{self.prefix}-{username}-" if self.prefix else f"{username}-"
+
 @overload
 def split_name_component(ins_name: str, check: Literal[True] = True) -> Optional[InsNameComponentU]: ...
 @overload
@@ -49,36 +88,7 @@ def split_name_component(ins_name: str, check:bool = True) -> Optional[InsNameCo
         This does not guarantee the validity of the username and instance name
     return None if the name is invalid
     """
-    if not '-' in ins_name:
-        if check:
-            return None
-        return {
-            "prefix": None,
-            "username": None,
-            "instance": ins_name
-        }
-    ins_name_sp = ins_name.split('-')
-    if len(ins_name_sp) == 2:
-        if check and config().name_prefix:
-            return None
-        return {
-            "prefix": None,
-            "username": ins_name_sp[0],
-            "instance": ins_name_sp[1]
-        }
-    if len(ins_name_sp) == 3:
-        if check:
-            if config().name_prefix and not ins_name_sp[0] == config().name_prefix:
-                return None
-            elif not config().name_prefix:
-                return None
-        return {
-            "prefix": ins_name_sp[0],
-            "username": ins_name_sp[1],
-            "instance": ins_name_sp[2]
-        }
-    return None
-    
+    return config().name_parser.split(ins_name, check)     # type: ignore
 
 def eval_name_raise(ins: str, user: UserRecord) -> str:
     """ 
@@ -86,10 +96,8 @@ def eval_name_raise(ins: str, user: UserRecord) -> str:
     raise error if the name is invalid or the user does not have permission 
     """
     conf = config()
-    res = split_name_component(ins, check=False)
-
-    def fmt_name(username:str, instance:str):
-        return f"{username}-{instance}" if not conf.name_prefix else f"{conf.name_prefix}-{username}-{instance}"
+    res = conf.name_parser.split(ins, check=False)
+    fmt_name = conf.name_parser.format
 
     if res is None:
         raise InvalidInputError(f"Invalid pod name: {ins}")
@@ -109,50 +117,79 @@ def eval_name_raise(ins: str, user: UserRecord) -> str:
         return fmt_name(res["username"], res["instance"])
 
 def get_user_pod_prefix(username: str):
-    ins_prefix = config().name_prefix
-    return f"{ins_prefix}-{username}-" if ins_prefix else f"{username}-"
+    return config().name_parser.user_prefix(username)
 
-
-class ImageFilter:
-    def __init__(self, config: Config, raw_images: list[str], username: Optional[str] = None):
-        self.raw_images = raw_images
+class ImageMatcher:
+    """
+    Find the image config of an image name (name:tag), 
+    a config name without tag matches all tags of the image, the first matching config wins.
+    """
+    def __init__(self, image_configs: Iterable[Config.ImageConfig]):
+        self._by_name: dict[str, tuple[int, Config.ImageConfig]] = {}
+        self._by_repo: dict[str, tuple[int, Config.ImageConfig]] = {}     # configs without tag
+        for i, im_c in enumerate(image_configs):
+            self._by_name.setdefault(im_c.name, (i, im_c))
+            if not ':' in im_c.name:
+                self._by_repo.setdefault(im_c.name, (i, im_c))
+
+    def match(self, image: str) -> Optional[Config.ImageConfig]:
+        candidates = [self._by_name.get(image)]
+        if ':' in image:
+            candidates.append(self._by_repo.get(image.split(':', 1)[0]))
+        found = [c for c in candidates if c is not None]
+        return min(found, key=lambda c: c[0])[1] if found else None
+
+
+class ImageCatalog:
+    """
+    Index of the available images for a config snapshot, built once per image list / config change,
+    - configured: available images allowed by the config, image -> image config
+    - user images: commit images `commit_name:username[-tag]`, indexed by username
+    Lookups are O(1), listing the images of a user is O(configured + user images).
+    """
+    def __init__(self, config: Config, raw_images: Iterable[str]):
         self.config = config
-        self.image_configs = config.images
-        self.username = username
-
-    def query_config(self, q_image: str, allow_user_image = True) -> Optional[Config.ImageConfig]:
-        """ Return the image config if the config name matches the query and the image is available """
-        if not q_image in self.raw_images:
-            return None
-        
-        for im_c in self.image_configs:
-            if im_c.name == q_image or (not ':' in im_c.name and q_image.startswith(im_c.name + ':')):
-                return im_c
-
-        if allow_user_image and self.has_user_image(q_image):
-            return Config.ImageConfig(
-                name=q_image,
-                ports=self.config.commit_image_ports,
-            )
-
-        return None
-    
-    def has_user_image(self, q_image: str) -> bool:
-        assert self.username is not None, "Username must be set for querying user images"
-        return bool(self.username) and q_image in self.raw_images and \
-            (
-                q_image == f"{self.config.commit_name}:{self.username}" or \
-                q_image.startswith(f"{self.config.commit_name}:{self.username}-")
-            )
-
-    def iter(self, allow_user_image: bool = True):
-        """ 
-        Iterate over valid image names, 
-        filtering out those not in the config or not user images 
+        self.images = frozenset(raw_images)
+        self.configured: dict[str, Config.ImageConfig] = {}
+        self._owner: dict[str, str] = {}                # user image -> username
+        self._user_images: dict[str, list[str]] = {}    # username -> user images
+        commit_prefix = f"{config.commit_name}:"
+        for image in sorted(self.images):
+            if (im_c := config.image_matcher.match(image)) is not None:
+                self.configured[image] = im_c
+            if image.startswith(commit_prefix):
+                # usernames cannot contain '-', the tag is either `username` or `username-xxx`
+                username = image[len(commit_prefix):].split('-', 1)[0]
+                if username:
+                    self._owner[image] = username
+                    self._user_images.setdefault(username, []).append(image)
+
+    def __contains__(self, image: str):
+        return image in self.images
+
+    def has_user_image(self, image: str, username: str) -> bool:
+        return bool(username) and self._owner.get(image) == username
+
+    def user_images(self, username: str) -> list[str]:
+        """ Commit images of the user, sorted by name """
+        return self._user_images.get(username, [])
+
+    def query_config(self, image: str, username: Optional[str] = None) -> Optional[Config.ImageConfig]:
+        """
+        Return the image config if the image is available and allowed by the config, 
+        or if it is a commit image of the user (when username is given)
         """
-        for image in self.raw_images:
-            if self.query_config(image, allow_user_image=allow_user_image):
-                yield image
+        if (im_c := self.configured.get(image)) is not None:
+            return im_c
+        if username and self.has_user_image(image, username):
+            return Config.ImageConfig(name=image, ports=self.config.commit_image_ports)
+        return None
+
+    def iter(self, username: Optional[str] = None):
+        """ Iterate over the configured images, and the commit images of the user if username is given """
+        yield from self.configured
+        if username:
+            yield from (im for im in self.user_images(username) if not im in self.configured)
 
 class ImageNameTran:
     def __init__(self, user_commit_name: str):
@@ -175,4 +212,27 @@ class ImageNameTran:
     def expand_if_user_commit(self, image_abbr: str) -> str:
         """ Expand the image name if it is a user commit image.  """
         if ":" in image_abbr: return image_abbr
-        return f"{self.prefix}:{image_abbr}"
\ No newline at end of file
+        return f"{self.prefix}:{image_abbr}"
+
+if __name__ == "__main__":
+    # catalog build and lookups on a host with many commit images, vs. scanning the image list per request
+    import time, dataclasses
+    images = tuple(Config.ImageConfig(name=f"base{i}", ports=(22,)) for i in range(50))
+    conf = dataclasses.replace(config(), images=images, image_matcher=ImageMatcher(images))
+    raw = [f"base{i}:v{j}" for i in range(60) for j in range(10)] + \
+        [f"{conf.commit_name}:u{i}-t{j}" for i in range(500) for j in range(10)]
+
+    t = time.perf_counter()
+    catalog = ImageCatalog(conf, raw)
+    print(f"catalog of {len(raw)} images built in {(time.perf_counter() - t) * 1000:.1f}ms, "
+          f"{len(catalog.configured)} configured, {len(catalog.user_images('u7'))} images of u7")
+
+    N = 10_000
+    t = time.perf_counter()
+    for _ in range(N): catalog.query_config(f"{conf.commit_name}:u7-t3", "u7"); len(catalog.user_images("u7"))
+    print(f"catalog lookup + commit count: {(time.perf_counter() - t) / N * 1e6:.2f}us")
+
+    t = time.perf_counter()
+    for _ in range(10):
+        sum(1 for im in raw if im.startswith(f"{conf.commit_name}:u7-") or im == f"{conf.commit_name}:u7")
+    print(f"commit count by scanning the image list: {(time.perf_counter() - t) / 10 * 1e6:.2f}us")
@@ -0,0 +1,183 @@
+"""
+Host port allocation for pods.
+The available ports are kept as an interval set, the allocated ports are recorded
+in a reservation table, so that concurrent creates (also across server workers) never
+pick the same port.
+"""
+import time, random, bisect, sqlite3
+from typing import Iterable, Optional
+from .db import DatabaseAbstract
+from .log import get_logger
+from ..config import DATA_HOME
+
+class PortRanges:
+    """ A sorted set of disjoint port intervals, supports O(log n) indexing by position """
+    def __init__(self, ports: Iterable[int | tuple[int, int]]):
+        intervals = sorted((p, p) if isinstance(p, int) else (p[0], p[1]) for p in ports)
+        merged: list[tuple[int, int]] = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.intervals = merged
+        self._starts = [s for s, _ in merged]
+        self._offsets: list[int] = []           # number of ports before each interval
+        n = 0
+        for start, end in merged:
+            self._offsets.append(n)
+            n += end - start + 1
+        self._size = n
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, port: int):
+        i = bisect.bisect_right(self._starts, port) - 1
+        return i >= 0 and port <= self.intervals[i][1]
+
+    def __iter__(self):
+        for start, end in self.intervals:
+            yield from range(start, end + 1)
+
+    def nth(self, idx: int) -> int:
+        if not 0 <= idx < self._size:
+            raise IndexError(idx)
+        i = bisect.bisect_right(self._offsets, idx) - 1
+        return self.intervals[i][0] + idx - self._offsets[i]
+
+class PortAllocator(DatabaseAbstract):
+    """
+    Allocate host ports from a persistent reservation table.
+    Ports are picked by random probing, which is O(1) amortized as long as the
+    port ranges are not nearly exhausted, and falls back to a scan otherwise.
+    """
+    N_PROBE = 32
+
+    @property
+    def conn(self): return self._conn
+    def __init__(self):
+        self.logger = get_logger('engine')
+        DATA_HOME.mkdir(exist_ok=True)
+        self._conn = self.open_shared(DATA_HOME / "ports.db", self.__setup)
+
+    @staticmethod
+    def __setup(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS port_reservation (
+                port INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            """
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_port_reservation_owner ON port_reservation (owner)")
+
+    def allocate(
+        self, owner: str, n: int, available: PortRanges,
+        exclude: Optional[set[int]] = None
+        ) -> list[int]:
+        """
+        Reserve n ports for the owner (container name),
+        - exclude: ports that are known to be in use but may not be reserved, e.g. by other containers
+        Raise PermissionError if there are not enough available ports.
+        """
+        exclude = exclude or set()
+        if n == 0:
+            return []
+        # immediate transaction takes the write lock, so that the probe and insert are atomic across processes
+        with self.transaction(mode='IMMEDIATE') as cursor:
+            def is_free(port: int) -> bool:
+                if port in exclude or port in picked:
+                    return False
+                cursor.execute("SELECT 1 FROM port_reservation WHERE port = ?", (port,))
+                return cursor.fetchone() is None
+
+            picked: list[int] = []
+            for _ in range(self.N_PROBE * n):
+                if len(picked) == n or len(available) == 0: break
+                port = available.nth(random.randrange(len(available)))
+                if is_free(port):
+                    picked.append(port)
+
+            if len(picked) < n:
+                # nearly exhausted, scan the remaining ports
+                cursor.execute("SELECT port FROM port_reservation")
+                reserved = {row[0] for row in cursor.fetchall()}
+                candidates = [p for p in available if not (p in reserved or p in exclude or p in picked)]
+                if len(candidates) < n - len(picked):
+                    raise PermissionError("No available port")
+                picked.extend(random.sample(candidates, n - len(picked)))
+
+            now = time.time()
+            cursor.executemany(
+                "INSERT INTO port_reservation (port, owner, created) VALUES (?, ?, ?)",
+                [(port, owner, now) for port in picked]
+            )
+        self.logger.debug(f"Ports {picked} reserved for {owner}")
+        return picked
+
+    def release(self, owner: str):
+        with self.transaction() as cursor:
+            r = cursor.execute("DELETE FROM port_reservation WHERE owner = ?", (owner,))
+            if r.rowcount:
+                self.logger.debug(f"{r.rowcount} ports released for {owner}")
+
+    def transfer(self, owner: str, new_owner: str):
+        """ Move the reservations to another owner, e.g. when the container is renamed """
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE port_reservation SET owner = ? WHERE owner = ?", (new_owner, owner))
+
+    def reserved_by(self, owner: str) -> set[int]:
+        with self.cursor() as cursor:
+            cursor.execute("SELECT port FROM port_reservation WHERE owner = ?", (owner,))
+            return {row[0] for row in cursor.fetchall()}
+
+    def list_reservations(self) -> dict[int, str]:
+        with self.cursor() as cursor:
+            cursor.execute("SELECT port, owner FROM port_reservation")
+            return {port: owner for port, owner in cursor.fetchall()}
+
+    def reconcile(self, used_ports: dict[int, str], grace: float = 300):
+        """
+        Sync the reservation table with the docker state,
+        - used_ports: the host ports bound by existing containers, port -> container name
+        - grace: reservations without a container are kept for this many seconds (creates in flight)
+        """
+        owners = set(used_ports.values())
+        with self.transaction(mode='IMMEDIATE') as cursor:
+            cursor.execute("SELECT port, owner, created FROM port_reservation")
+            stale = [
+                (port,) for port, owner, created in cursor.fetchall()
+                if owner not in owners and time.time() - created > grace
+            ]
+            cursor.executemany("DELETE FROM port_reservation WHERE port = ?", stale)
+            cursor.executemany(
+                "INSERT OR REPLACE INTO port_reservation (port, owner, created) VALUES (?, ?, ?)",
+                [(port, owner, time.time()) for port, owner in used_ports.items()]
+            )
+        self.logger.info(f"Port reservations reconciled, {len(stale)} stale released, {len(used_ports)} in use")
+
+
+def reconcile_port_reservations():
+    """ Sync the reservation table with the docker state cache, called at server startup """
+    from .docker_state import get_docker_state
+    PortAllocator().reconcile(get_docker_state().used_port_owners())
+
+
+if __name__ == "__main__":
+    # concurrent allocation from several processes, no port should be picked twice
+    import multiprocessing
+    ranges = PortRanges([(20000, 20999), 30000, (30001, 30099)])
+    def worker(i: int) -> list[int]:
+        allocator = PortAllocator()
+        return [p for j in range(50) for p in allocator.allocate(f"bench-{i}-{j}", 2, ranges)]
+    t = time.time()
+    with multiprocessing.Pool(8) as pool:
+        allocated = [p for ports in pool.map(worker, range(8)) for p in ports]
+    print(f"{len(allocated)} ports allocated in {time.time() - t:.2f}s, {len(set(allocated))} unique")
+    allocator = PortAllocator()
+    for i in range(8):
+        for j in range(50): allocator.release(f"bench-{i}-{j}")
+    print(f"{len(allocator.list_reservations())} reservations left")
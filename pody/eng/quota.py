@@ -58,40 +58,38 @@ class QuotaDatabase(DatabaseAbstract):
         self.logger = get_logger('engine')
 
         DATA_HOME.mkdir(exist_ok=True)
-        self._conn = sqlite3.connect(DATA_HOME / "quota.db", check_same_thread=False)
+        self._conn = self.open_shared(DATA_HOME / "quota.db", self.__setup)
 
-        with self.transaction() as cursor:
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS quota (
-                    username TEXT PRIMARY KEY,
-                    max_pods INTEGER NOT NULL DEFAULT -1,
-                    gpu_count INTEGER NOT NULL DEFAULT -1,
-                    gpus TEXT NOT NULL DEFAULT '',
-                    memory_limit INTEGER NOT NULL DEFAULT -1,
-                    storage_size INTEGER NOT NULL DEFAULT -1,
-                    shm_size INTEGER NOT NULL DEFAULT -1, 
-                    commit_count INTEGER NOT NULL DEFAULT -1, 
-                    commit_size_limit INTEGER NOT NULL DEFAULT -1, 
-                    tmpfs_size INTEGER NOT NULL DEFAULT -1
-                );
-                """
-            )
-
-        self.__maybe_upgrade()
+    def __setup(self, cursor: sqlite3.Cursor):
+        """ Schema setup, runs once per process """
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS quota (
+                username TEXT PRIMARY KEY,
+                max_pods INTEGER NOT NULL DEFAULT -1,
+                gpu_count INTEGER NOT NULL DEFAULT -1,
+                gpus TEXT NOT NULL DEFAULT '',
+                memory_limit INTEGER NOT NULL DEFAULT -1,
+                storage_size INTEGER NOT NULL DEFAULT -1,
+                shm_size INTEGER NOT NULL DEFAULT -1, 
+                commit_count INTEGER NOT NULL DEFAULT -1, 
+                commit_size_limit INTEGER NOT NULL DEFAULT -1, 
+                tmpfs_size INTEGER NOT NULL DEFAULT -1
+            );
+            """
+        )
+        self.__maybe_upgrade(cursor)
     
-    def __maybe_upgrade(self):
+    def __maybe_upgrade(self, cursor: sqlite3.Cursor):
         def add_tmpfs_size():
-            with self.cursor() as cursor:
-                cursor.execute("PRAGMA table_info(quota)")
-                columns = [col[1] for col in cursor.fetchall()]
-                if "tmpfs_size" in columns:
-                    return
-            with self.transaction() as cursor:
-                cursor.execute(
-                    "ALTER TABLE quota ADD COLUMN tmpfs_size INTEGER NOT NULL DEFAULT 0"
-                )
-                self.logger.info("Quota database upgraded to latest version")
+            cursor.execute("PRAGMA table_info(quota)")
+            columns = [col[1] for col in cursor.fetchall()]
+            if "tmpfs_size" in columns:
+                return
+            cursor.execute(
+                "ALTER TABLE quota ADD COLUMN tmpfs_size INTEGER NOT NULL DEFAULT 0"
+            )
+            self.logger.info("Quota database upgraded to latest version")
         add_tmpfs_size()            # TODO: remove in 0.5.0
     
     def delete_quota(self, usrname: str):
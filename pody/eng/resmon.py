@@ -2,16 +2,18 @@
 Resource monitoring utilities (High-level docker and GPU process monitoring)
 """
 import psutil, time, sqlite3, time
-from typing import Iterator, Callable, Optional, Generic, TypeVar
+from typing import TYPE_CHECKING, Iterable, Iterator, Callable, Literal, Optional, Generic, TypeVar
 import dataclasses
 from ..config import DATA_HOME
 from .user import UserDatabase
-from .db import DatabaseAbstract
+from .db import DatabaseAbstract, open_connection
 from .log import get_logger
-from .gpu import GPUHandler, list_processes_on_gpus, GPUProcessInfo
+from .gpu import GPUProcessInfo, GPUSampler, get_gpu_sampler
 from .docker import DockerController
 from .errors import ProcessUnavailableError
 from .nparse import split_name_component
+if TYPE_CHECKING:
+    from .gpu_enforce import Decision
 
 @dataclasses.dataclass
 class ProcessInfo:
@@ -19,6 +21,7 @@ class ProcessInfo:
     cmd: str
     cgroup: str
     uptime: float
+    start_time: float   # creation time of the process (epoch), identifies the process together with pid
     cputime: float      # CPU time in seconds
     memory_used: int    # in bytes
 
@@ -39,11 +42,13 @@ def query_process(pid: int) -> ProcessInfo:
         raise ProcessUnavailableError(f"Process {pid} not found") from e
     
     cputimes = proc.cpu_times()
+    create_time = proc.create_time()
     return ProcessInfo(
         pid=pid,
         cmd=" ".join(proc.cmdline()),
         cgroup=_cgroup_from_pid(pid),
-        uptime=time.time() - proc.create_time(),
+        uptime=time.time() - create_time,
+        start_time=round(create_time, 2),
         cputime=cputimes.user + cputimes.system, 
         memory_used=proc.memory_info().rss, 
     )
@@ -75,19 +80,22 @@ class ProcessIter(Generic[T]):
     def __init__(self, 
         filter_fn: Callable[[ContainerProcessInfo], FilterReturn[T]] \
             = lambda _: ProcessIter.FilterReturn(is_valid=True), 
-        docker_only: bool = True
+        docker_only: bool = True, 
+        gpu_sampler: Optional[GPUSampler] = None, 
         ):
         self.logger = get_logger("resmon")
         self.filter_fn = filter_fn
         self.docker_only = docker_only
         self.docker_con = DockerController()
-        self.gpu_handler = GPUHandler()
+        self.gpu_sampler = gpu_sampler if gpu_sampler is not None else get_gpu_sampler()
+        self.pid_resolver = self.docker_con.pid_resolver()
     
     def all_process(self) -> Iterator[tuple[ContainerProcessInfo, T]]:
+        self.pid_resolver.refresh()
         for proc in psutil.process_iter(['pid']):
             pid = proc.info['pid']
             try:
-                if not (name:=self.docker_con.container_from_pid(pid)):
+                if not (name:=self.pid_resolver.resolve(pid)):
                     if self.docker_only: continue
                     else: name = ""
                 p = ContainerProcessInfo(
@@ -106,15 +114,13 @@ class ProcessIter(Generic[T]):
                 continue
     
     def gpu_process(self, gpu_ids: Optional[list[int]] = None) -> Iterator[tuple[ContainerProcessInfo, T]]:
-        if gpu_ids is None:
-            gpu_ids = list(range(self.gpu_handler.device_count()))
-
-        gpu_procs = list_processes_on_gpus(gpu_ids)
+        gpu_procs = self.gpu_sampler.snapshot().processes_on(gpu_ids)
+        self.pid_resolver.refresh()
         for _, procs in gpu_procs.items():
             for proc in procs:
                 pid = proc.pid
                 try:
-                    if not (name := self.docker_con.container_from_pid(pid)):
+                    if not (name := self.pid_resolver.resolve(pid)):
                         if self.docker_only: continue
                         else: name = ""
                     cproc = query_process(pid)
@@ -134,112 +140,319 @@ class ProcessIter(Generic[T]):
                     continue
 
 
+HOUR = 3600
+DAY = 24 * HOUR
+
+def split_interval(t0: float, t1: float, bucket_size: int) -> list[tuple[int, float]]:
+    """ Split the interval [t0, t1] into buckets of the given size, return (bucket start, fraction of the interval) """
+    if t1 <= t0:
+        return [(int(t1 - t1 % bucket_size), 1.)]
+    res = []
+    b = int(t0 - t0 % bucket_size)
+    while b < t1:
+        overlap = min(t1, b + bucket_size) - max(t0, b)
+        if overlap > 0: res.append((b, overlap / (t1 - t0)))
+        b += bucket_size
+    return res
+
+StatGroupBy = Literal['user', 'pod', 'day']
+
 class ResourceMonitorDatabase(DatabaseAbstract):
+    """
+    Resource usage of user processes, one row per process, identified by (boot_id, pid, start_time).
+    Schema versions (PRAGMA user_version):
+    - 0: no unique index, rows were replaced by (boot_id, pid) on every update
+    - 1: unique index on (boot_id, pid, start_time), rows are upserted
+
+    The usage is also accumulated into hourly and daily rollup tables (UTC buckets), 
+    each sweep attributes the CPU / GPU time consumed since the previous observation of a process 
+    to the buckets of that interval, the statistics queries are answered from the rollups.
+    """
     def __init__(self, in_memory: bool = False):
         self.user_db = UserDatabase()
         self.logger = get_logger("resmon")
         self.boot_id = str(psutil.boot_time())
-        db_path = ":memory:" if in_memory else f"{DATA_HOME}/resmon.db"
-        self._conn = sqlite3.connect(db_path)
+        if in_memory:
+            self._conn = open_connection(":memory:")
+            with self.transaction(mode='IMMEDIATE') as cur:
+                self._setup(cur)
+        else:
+            self._conn = self.open_shared(DATA_HOME / "resmon.db", self._setup)
 
-        with self.transaction() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS resource_usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    boot_id TEXT NOT NULL,
-                    pid INTEGER NOT NULL,
-                    start_time REAL NOT NULL,
+    def _setup(self, cur: sqlite3.Cursor):
+        """ Schema setup, runs once per process """
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS resource_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                boot_id TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                start_time REAL NOT NULL,
+                username TEXT NOT NULL,
+                container_id TEXT NOT NULL,
+                cmd TEXT NOT NULL,
+                uptime REAL NOT NULL,
+                cputime REAL NOT NULL,
+                ngpus INTEGER NOT NULL
+            )
+        """)
+        # at most one row per (boot_id, pid) in schema 0, so the index can always be created
+        cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_resource_usage_proc
+            ON resource_usage (boot_id, pid, start_time)
+        """)
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage_rollup_hour'")
+        need_backfill = cur.fetchone() is None
+        for table in ("usage_rollup_hour", "usage_rollup_day"):
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket INTEGER NOT NULL,
                     username TEXT NOT NULL,
                     container_id TEXT NOT NULL,
-                    cmd TEXT NOT NULL,
-                    uptime REAL NOT NULL,
                     cputime REAL NOT NULL,
-                    ngpus INTEGER NOT NULL
+                    gputime REAL NOT NULL,
+                    PRIMARY KEY (bucket, username, container_id)
                 )
             """)
+        if need_backfill:
+            self._backfill_rollups(cur)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS gpu_enforcement (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time REAL NOT NULL,
+                action TEXT NOT NULL,
+                container TEXT NOT NULL,
+                username TEXT NOT NULL,
+                gpus TEXT NOT NULL,
+                quota INTEGER NOT NULL,
+                reason TEXT NOT NULL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_enforcement_time ON gpu_enforcement (time)")
+
+    def _backfill_rollups(self, cur: sqlite3.Cursor):
+        """ Build the rollups from the raw records, the usage of each process is spread evenly over its lifetime """
+        t = time.time()
+        acc: dict[tuple[int, int, str, str], list[float]] = {}
+        for start_time, uptime, username, container_id, cputime, ngpus in cur.execute(
+            "SELECT start_time, uptime, username, container_id, cputime, ngpus FROM resource_usage"
+            ).fetchall():
+            self._accumulate(acc, start_time, start_time + uptime, username, container_id, cputime, ngpus * uptime)
+        self._write_rollups(cur, acc)
+        self.logger.info(f"Resource usage rollups built from history in {time.time() - t:.1f}s")
+
+    @staticmethod
+    def _accumulate(
+        acc: dict[tuple[int, int, str, str], list[float]], 
+        t0: float, t1: float, username: str, container_id: str, cputime: float, gputime: float
+        ):
+        if cputime <= 0 and gputime <= 0:
+            return
+        for size in (HOUR, DAY):
+            for bucket, frac in split_interval(t0, t1, size):
+                v = acc.setdefault((size, bucket, username, container_id), [0., 0.])
+                v[0] += cputime * frac
+                v[1] += gputime * frac
+
+    @staticmethod
+    def _write_rollups(cur: sqlite3.Cursor, acc: dict[tuple[int, int, str, str], list[float]]):
+        for size, table in ((HOUR, "usage_rollup_hour"), (DAY, "usage_rollup_day")):
+            cur.executemany(f"""
+                INSERT INTO {table} (bucket, username, container_id, cputime, gputime)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, username, container_id) DO UPDATE SET
+                    cputime = cputime + excluded.cputime,
+                    gputime = gputime + excluded.gputime
+            """, [(b, u, c, v[0], v[1]) for (s, b, u, c), v in acc.items() if s == size])
 
     @property
     def conn(self) -> sqlite3.Connection:
         return self._conn
     
     def update(self, pinfo_iter: Iterator[ContainerProcessInfo]):
+        """
+        Record a sweep of processes, the iterator may yield a process more than once 
+        (e.g. chained CPU and GPU process iterators), the number of GPUs is counted by the entries with GPU info.
+        """
+        is_valid_user: dict[str, bool] = {}     # looked up once per sweep
+        rows: dict[tuple[int, float], list] = {}
+        for pinfo in pinfo_iter:
+            name_sp = split_name_component(pinfo.container_name, check=True)
+            if not name_sp:
+                # not a user process, skip
+                continue
 
-        with self.transaction() as cur:
-            proc_gpu_count: dict[int, int] = {}
-            for pinfo in pinfo_iter:
-                name_sp = split_name_component(pinfo.container_name, check=True)
-                if not name_sp:
-                    # not a user process, skip
-                    continue
-
-                username = name_sp['username']
-                user = self.user_db.get_user(username)
-                if user.userid == 0:  
-                    # user not found, skip
-                    continue
+            username = name_sp['username']
+            if username not in is_valid_user:
+                is_valid_user[username] = self.user_db.get_user(username).userid != 0
+            if not is_valid_user[username]:
+                # user not found, skip
+                continue
 
-                pid = pinfo.cproc.pid
-                if pinfo.gproc:
-                    proc_gpu_count[pid] = proc_gpu_count.get(pid, 0) + 1
-                
-                ngpus = proc_gpu_count.get(pid, 0)
+            key = (pinfo.cproc.pid, pinfo.cproc.start_time)
+            if key not in rows:
+                rows[key] = [
+                    self.boot_id, pinfo.cproc.pid, pinfo.cproc.start_time, username, pinfo.container_name, 
+                    pinfo.cproc.cmd, pinfo.cproc.uptime, pinfo.cproc.cputime, 0
+                ]
+            if pinfo.gproc:
+                rows[key][-1] += 1
 
-                # remove old records for this process
+        with self.transaction() as cur:
+            # previous observations of the processes, start time of schema 0 rows may be off by a few ms
+            prev: dict[int, list[tuple[float, float, float]]] = {}
+            pids = list({pid for pid, _ in rows})
+            for i in range(0, len(pids), 500):
+                chunk = pids[i:i+500]
                 cur.execute("""
+                    SELECT pid, start_time, uptime, cputime FROM resource_usage
+                    WHERE boot_id = ? AND pid IN ({})
+                """.format(','.join('?' for _ in chunk)), (self.boot_id, *chunk))
+                for pid, start_time, uptime, cputime in cur.fetchall():
+                    prev.setdefault(pid, []).append((start_time, uptime, cputime))
+
+            acc: dict[tuple[int, int, str, str], list[float]] = {}
+            for (pid, start_time), row in rows.items():
+                uptime, cputime, ngpus = row[6], row[7], row[8]
+                last = min(
+                    (p for p in prev.get(pid, []) if abs(p[0] - start_time) < 1), 
+                    key=lambda p: abs(p[0] - start_time), default=None
+                    )
+                last_uptime, last_cputime = (last[1], last[2]) if last else (0., 0.)
+                self._accumulate(
+                    acc, start_time + last_uptime, start_time + uptime, row[3], row[4], 
+                    max(cputime - last_cputime, 0.), ngpus * max(uptime - last_uptime, 0.)
+                    )
+            self._write_rollups(cur, acc)
+
+            cur.execute("PRAGMA user_version")
+            if cur.fetchone()[0] < 1:
+                # rows of schema 0 have a start time derived from the uptime, 
+                # drop them for live processes so they are not counted twice
+                cur.executemany("""
                     DELETE FROM resource_usage
-                    WHERE boot_id = ? AND pid = ?
-                """, (self.boot_id, pid))
+                    WHERE boot_id = ? AND pid = ? AND start_time != ? AND ABS(start_time - ?) < 1
+                """, [(self.boot_id, pid, start_time, start_time) for pid, start_time in rows])
+                cur.execute("PRAGMA user_version = 1")
 
-                now_time = time.time()
-                start_time = now_time - pinfo.cproc.uptime
-                cur.execute("""
-                    INSERT INTO resource_usage (boot_id, pid, start_time,
-                    username, container_id, cmd, uptime, cputime, ngpus)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    self.boot_id,
-                    pid,
-                    start_time, 
-                    username,
-                    pinfo.container_name,
-                    pinfo.cproc.cmd,
-                    pinfo.cproc.uptime,
-                    pinfo.cproc.cputime,
-                    ngpus
-                ))
+            cur.executemany("""
+                INSERT INTO resource_usage (boot_id, pid, start_time,
+                username, container_id, cmd, uptime, cputime, ngpus)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (boot_id, pid, start_time) DO UPDATE SET
+                    username = excluded.username,
+                    container_id = excluded.container_id,
+                    cmd = excluded.cmd,
+                    uptime = excluded.uptime,
+                    cputime = excluded.cputime,
+                    ngpus = excluded.ngpus
+            """, list(rows.values()))
     
-    def query_cputime(self, *username: str, after: float = 0) -> dict[str, float]:
+    def _query_rollup(
+        self, column: Literal['cputime', 'gputime'], username: tuple[str, ...], 
+        after: float, group_by: StatGroupBy
+        ) -> dict[str, float]:
+        """
+        Usage consumed after the given time, full days are read from the daily rollups, 
+        the rest from the hourly rollups, where the first hour is prorated.
+        """
         if not username:
-            username = [user.name for user in self.user_db.list_users() if user.userid != 0] # type: ignore
+            username = tuple(user.name for user in self.user_db.list_users() if user.userid != 0)
+        key = {
+            'user': "username", 
+            'pod': "container_id", 
+            'day': f"strftime('%Y-%m-%d', bucket - bucket % {DAY}, 'unixepoch')",
+        }[group_by]
+        first_day = -(-int(after) // DAY) * DAY      # the first full day in the range
+        user_cond = "username IN ({})".format(','.join('?' for _ in username))
+        res: dict[str, float] = {}
         with self.cursor() as cur:
-            cur.execute("""
-                SELECT username, SUM(cputime) FROM resource_usage
-                WHERE start_time > ? AND cputime > 1 AND username IN ({})
-                GROUP BY username
-            """.format(','.join('?' for _ in username)), (after, *username))
-            result = cur.fetchall()
-            return {row[0]: row[1] for row in result}
-    
-    def query_gputime(self, *username: str, after: float = 0) -> dict[str, float]:
-        if not username:
-            username = [user.name for user in self.user_db.list_users() if user.userid != 0] # type: ignore
+            cur.execute(f"""
+                SELECT {key}, SUM({column}) FROM usage_rollup_day
+                WHERE bucket >= ? AND {user_cond} GROUP BY 1
+            """, (first_day, *username))
+            for k, v in cur.fetchall():
+                res[k] = res.get(k, 0) + v
+            cur.execute(f"""
+                SELECT {key}, SUM({column} * MIN(1.0, (bucket + {HOUR} - ?) / {HOUR}.0)) FROM usage_rollup_hour
+                WHERE bucket > ? AND bucket < ? AND {user_cond} GROUP BY 1
+            """, (after, after - HOUR, first_day, *username))
+            for k, v in cur.fetchall():
+                res[k] = res.get(k, 0) + v
+        return {k: v for k, v in res.items() if v > 0}
+
+    def record_enforcement(self, decisions: Iterable["Decision"]):
+        """ Record the decisions of the GPU quota enforcement """
+        now = time.time()
+        with self.transaction() as cur:
+            cur.executemany(
+                "INSERT INTO gpu_enforcement (time, action, container, username, gpus, quota, reason) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(now, d.action, d.container, d.username, ",".join(map(str, d.gpus)), d.quota, d.reason) for d in decisions]
+            )
+
+    def query_enforcement(self, after: float = 0, username: Optional[str] = None, limit: int = 100) -> list[dict]:
+        """ The latest GPU enforcement decisions, newest first """
         with self.cursor() as cur:
-            cur.execute("""
-                SELECT username, SUM(ngpus * uptime) FROM resource_usage
-                WHERE start_time > ? AND ngpus > 0 AND username IN ({})
-                GROUP BY username
-            """.format(','.join('?' for _ in username)), (after, *username))
-            result = cur.fetchall()
-            return {row[0]: row[1] for row in result}
+            cur.execute(f"""
+                SELECT time, action, container, username, gpus, quota, reason FROM gpu_enforcement
+                WHERE time >= ? {"AND username = ?" if username else ""} ORDER BY id DESC LIMIT ?
+            """, (after, username, limit) if username else (after, limit))
+            return [
+                {"time": t, "action": a, "container": c, "username": u, "gpus": [int(g) for g in gpus.split(",") if g], "quota": q, "reason": r}
+                for t, a, c, u, gpus, q, r in cur.fetchall()
+            ]
+
+    def query_cputime(self, *username: str, after: float = 0, group_by: StatGroupBy = 'user') -> dict[str, float]:
+        return self._query_rollup('cputime', username, after, group_by)
+    
+    def query_gputime(self, *username: str, after: float = 0, group_by: StatGroupBy = 'user') -> dict[str, float]:
+        return self._query_rollup('gputime', username, after, group_by)
 
 
 if __name__ == "__main__":
-    piter = ProcessIter()
-    for proc, extra in piter.all_process():
-        print(proc.json())
-
-    resmon_db = ResourceMonitorDatabase(in_memory=True)
-    resmon_db.update(map(lambda it: it[0], piter.all_process()))
-    resmon_db.update(map(lambda it: it[0], piter.gpu_process()))
-    print(resmon_db.query_cputime())
-    print(resmon_db.query_gputime())
\ No newline at end of file
+    # per-sweep cost of the update as the history grows,
+    # with synthetic processes of 20 users and a local user lookup
+    import random
+    N_PROC = 500
+    user_lookup = type("UserLookup", (), {
+        "get_user": lambda self, name: type("User", (), {"userid": 1})(), 
+    })()
+
+    def sweep(k: int) -> list[ContainerProcessInfo]:
+        return [
+            ContainerProcessInfo(
+                container_name=f"user{pid % 20}-ins{pid % 3}", 
+                cproc=ProcessInfo(pid, "python train.py", "", 100. + 60 * k, 1.7e9 + pid / 100, 50. + 30 * k, 0),
+                gproc=GPUProcessInfo(pid, 0, 1024) if pid % 10 == 0 else None,
+            ) for pid in range(N_PROC)
+        ]
+
+    db = ResourceMonitorDatabase(in_memory=True)
+    db.user_db = user_lookup    # type: ignore
+    n_rows, n_sweep = 0, 0
+    for target in (10_000, 100_000, 1_000_000, 3_000_000):
+        with db.transaction() as cur:
+            cur.executemany("""
+                INSERT INTO resource_usage (boot_id, pid, start_time, username, container_id, cmd, uptime, cputime, ngpus)
+                VALUES (?, ?, ?, 'user0', 'user0-ins0', 'sleep', 1, 1, 0)
+            """, ((f"old-{i // 30000}", i % 30000, random.random()) for i in range(n_rows, target)))
+        n_rows = target
+        t = time.time()
+        for _ in range(10):
+            n_sweep += 1
+            procs = sweep(n_sweep)
+            db.update(iter(procs + [p for p in procs if p.gproc]))
+        print(f"history {n_rows:>9} rows: {(time.time() - t) / 10 * 1000:.1f}ms per sweep of {N_PROC} processes")
+
+    # statistics queries over a year of rollups for 20 users x 3 pods
+    now = time.time()
+    acc: dict[tuple[int, int, str, str], list[float]] = {}
+    for u in range(20):
+        for i in range(3):
+            ResourceMonitorDatabase._accumulate(acc, now - 365 * DAY, now, f"user{u}", f"user{u}-ins{i}", 1e6, 1e6)
+    with db.transaction() as cur:
+        ResourceMonitorDatabase._write_rollups(cur, acc)
+    db.user_db.list_users = lambda: [type("User", (), {"userid": 1, "name": f"user{u}"})() for u in range(20)]  # type: ignore
+    for t_range, group_by in ((7 * DAY, 'user'), (365 * DAY, 'user'), (365 * DAY, 'day')):
+        t = time.time()
+        r = db.query_gputime(after=now - t_range, group_by=group_by)
+        print(f"gputime of {t_range // DAY} days by {group_by}: {(time.time() - t) * 1000:.1f}ms, {len(r)} groups")
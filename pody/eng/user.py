@@ -1,7 +1,8 @@
-import sqlite3
+import os, time, sqlite3, pathlib, threading
 import hashlib
 import dataclasses
-from typing import Optional, Literal
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Literal
 
 import requests
 import urllib.parse
@@ -49,10 +50,12 @@ class UserDatabase:
         return self._impl.add_user(username, password, is_admin)
     
     def update_user(self, username: str, **kwargs) -> None:
-        return self._impl.update_user(username, **kwargs)
+        try: return self._impl.update_user(username, **kwargs)
+        finally: invalidate_credential_cache(username)
     
     def delete_user(self, username: str) -> None:
-        return self._impl.delete_user(username)
+        try: return self._impl.delete_user(username)
+        finally: invalidate_credential_cache(username)
 
     def get_user(self, user_id: str | int) -> UserRecord:
         return self._impl.get_user(user_id)
@@ -64,9 +67,9 @@ class UserDatabase:
         return self._impl.list_users(usernames)
 
 class UserDatabase_Remote:
-    def __init__(self):
+    def __init__(self, provider: Optional[Any] = None):
         self.logger = get_logger('engine')
-        self._provider = config().remote_user_profile.provider
+        self._provider = provider if provider is not None else config().remote_user_profile.provider
         if not self._provider.enabled:
             raise NotImplementedError("Remote user profile provider is not enabled")
         if not self._provider.access_token or not self._provider.endpoint:
@@ -127,25 +130,28 @@ class UserDatabase_Remote:
 class UserDatabase_Local(DatabaseAbstract):
     @property
     def conn(self): return self._conn
-    def __init__(self):
+    def __init__(self, db_path: Optional[pathlib.Path] = None):
+        """ db_path: defaults to DATA_HOME/users.db """
         self.logger = get_logger('engine')
 
-        DATA_HOME.mkdir(exist_ok=True)
-        self._conn = sqlite3.connect(DATA_HOME / "users.db", check_same_thread=False)
-        # enable foreign key constraint
-        self.conn.execute("PRAGMA foreign_keys = ON;")
+        if db_path is None:
+            DATA_HOME.mkdir(exist_ok=True)
+            db_path = DATA_HOME / "users.db"
+        self._conn = self.open_shared(db_path, self.__setup)
 
-        with self.transaction() as cursor:
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY,
-                    username TEXT NOT NULL UNIQUE,
-                    credential TEXT NOT NULL, 
-                    is_admin BOOLEAN NOT NULL DEFAULT 0
-                );
-                """
-            )
+    @staticmethod
+    def __setup(cursor: sqlite3.Cursor):
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL UNIQUE,
+                credential TEXT NOT NULL, 
+                is_admin BOOLEAN NOT NULL DEFAULT 0
+            );
+            """
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_credential ON users (credential)")
 
     def add_user(self, username: str, password: str, is_admin: bool = False):
         check_username(username)
@@ -207,3 +213,131 @@ class UserDatabase_Local(DatabaseAbstract):
             with self.cursor() as cur:
                 cur.execute(f"SELECT id, username, is_admin FROM users WHERE username IN ({','.join(['?']*len(usernames))})", usernames)
                 return [UserRecord(*u) for u in cur.fetchall()]
+
+
+class CredentialCache:
+    """
+    LRU cache of credential hash -> user record, for authenticating requests.
+    - check_user: the uncached lookup
+    - ttl / negative_ttl: seconds to keep found / not found (userid=0) records
+    - data_version: optional function that changes whenever the user table is modified,
+        the cache is cleared when it changes (e.g. by the CLI in another process)
+    """
+    def __init__(
+        self,
+        check_user: Callable[[str], UserRecord],
+        max_size: int = 1024,
+        ttl: float = 60,
+        negative_ttl: float = 5,
+        data_version: Optional[Callable[[], Any]] = None,
+        ):
+        self._check_user = check_user
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data_version = data_version
+        self._version = data_version() if data_version else None
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, tuple[float, UserRecord]] = OrderedDict()     # credential -> (expire time, user)
+
+    def check_user(self, credential: str) -> UserRecord:
+        now = time.time()
+        with self._lock:
+            if self._data_version is not None and (v := self._data_version()) != self._version:
+                self._cache.clear()
+                self._version = v
+            if (hit := self._cache.get(credential)) is not None and hit[0] > now:
+                self._cache.move_to_end(credential)
+                return hit[1]
+        user = self._check_user(credential)
+        with self._lock:
+            self._cache[credential] = (now + (self.ttl if user.userid != 0 else self.negative_ttl), user)
+            self._cache.move_to_end(credential)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return user
+
+    def invalidate(self, username: Optional[str] = None):
+        """ Drop the records of the user, and all negative records (e.g. the new password of the user) """
+        with self._lock:
+            if username is None:
+                self._cache.clear()
+                return
+            for k in [k for k, (_, u) in self._cache.items() if u.name == username or u.userid == 0]:
+                del self._cache[k]
+
+def _users_db_version(db_path: Optional[pathlib.Path] = None) -> Callable[[], int]:
+    # data_version of a dedicated connection changes on commits of any other connection
+    conn = sqlite3.connect(db_path or DATA_HOME / "users.db", check_same_thread=False)
+    return lambda: conn.execute("PRAGMA data_version").fetchone()[0]
+
+__g_cred_cache: Optional[CredentialCache] = None
+__g_cred_cache_key: Optional[tuple[int, bool]] = None
+__g_cred_cache_lock = threading.Lock()
+def get_credential_cache() -> CredentialCache:
+    """ Return the process-wide credential cache of the configured user database """
+    global __g_cred_cache, __g_cred_cache_key
+    remote = config().remote_user_profile.provider.enabled
+    with __g_cred_cache_lock:
+        if __g_cred_cache is None or __g_cred_cache_key != (os.getpid(), remote):
+            if remote:
+                __g_cred_cache = CredentialCache(lambda c: UserDatabase('remote').check_user(c))
+            else:
+                UserDatabase_Local()     # make sure the table exists
+                __g_cred_cache = CredentialCache(
+                    lambda c: UserDatabase('local').check_user(c), data_version=_users_db_version()
+                    )
+            __g_cred_cache_key = (os.getpid(), remote)
+        return __g_cred_cache
+
+def invalidate_credential_cache(username: Optional[str] = None):
+    if __g_cred_cache is not None:
+        __g_cred_cache.invalidate(username)
+
+
+if __name__ == "__main__":
+    # auth overhead per request, uncached (a new user database per request) vs cached,
+    # with a temporary local database and a stub remote provider (1ms round trip)
+    import tempfile, json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    N_REQ = 2000
+    with tempfile.TemporaryDirectory() as d:
+        db_path = pathlib.Path(d) / "users.db"
+        UserDatabase_Local(db_path).add_user("alice", "passwd")
+        cred = hash_password("alice", "passwd")
+
+        class StubProvider(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(0.001)
+                body = json.dumps({"userid": 1, "name": "alice", "is_admin": False}).encode()
+                self.send_response(200); self.send_header("Content-Length", str(len(body))); self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *_): pass
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubProvider)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        provider = type("Provider", (), {
+            "enabled": True, "access_token": "token", "endpoint": f"http://127.0.0.1:{server.server_port}"
+            })()
+
+        def local_uncached(c: str): 
+            db = UserDatabase_Local(db_path)
+            try: return db.check_user(c)
+            finally: db.close()
+        def remote_uncached(c: str):
+            db = UserDatabase_Remote(provider)
+            try: return db.check_user(c)
+            finally: db.close()
+
+        for mode, lookup, version in (
+            ("local", local_uncached, _users_db_version(db_path)), 
+            ("remote", remote_uncached, None),
+            ):
+            t = time.time()
+            for _ in range(N_REQ // 10): lookup(cred)
+            uncached = (time.time() - t) / (N_REQ // 10)
+            cache = CredentialCache(lookup, data_version=version)
+            t = time.time()
+            for _ in range(N_REQ): cache.check_user(cred)
+            cached = (time.time() - t) / N_REQ
+            print(f"{mode:>6}: uncached {uncached * 1e6:.0f}us, cached {cached * 1e6:.1f}us per request")
+        server.shutdown()
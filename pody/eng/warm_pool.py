@@ -0,0 +1,271 @@
+"""
+Warm pools of pre-created pods, for the images configured with `warm_pool = N`.
+Docker cannot change the mounts or the port bindings of a container after it is created,
+so a pooled container is created with everything the pod will have except its name:
+the volume mappings, the limits of the default quota, and host ports reserved under the pooled name.
+A create claims a pooled container of the same spec by renaming it and starting it,
+the rename is atomic in the docker daemon, so concurrent claims (also across server workers) never share one.
+Creates of other specs fall back to a regular create, hence:
+- images can only be pooled if the volume mappings do not depend on the user ($username),
+- only users whose quota gives the same limits as the default quota get pooled pods.
+Pooled containers are kept in the created state, holding no memory or GPU, and refilled by the daemon.
+"""
+import time, random, hashlib, dataclasses
+from contextlib import suppress
+from string import Template
+from typing import Optional
+
+import docker.errors
+
+from .docker import ContainerAction, ContainerConfig, DockerController, used_ports_from_attrs
+from .docker_state import DockerStateCache
+from .errors import DuplicateError
+from .ports import PortAllocator
+from .quota import UserQuota, get_fallback_quota
+from .log import get_logger
+from .metrics import Counter, REGISTRY
+from ..config import Config, config
+
+WARM_POOL_CLAIMS: Counter = REGISTRY.register(Counter(
+    "pody_warm_pool_claims_total", "Pod creations by whether a pooled container was claimed",
+    ("image", "result"),
+))  # type: ignore
+
+@dataclasses.dataclass(frozen=True)
+class PodSpec:
+    """ Everything of a pod container but its name and host ports """
+    image: str
+    ports: tuple[int, ...]              # container ports
+    volumes: tuple[str, ...]
+    network: str
+    gpu_ids: Optional[tuple[int, ...]]  # None for all gpus
+    memory_limit: Optional[str]
+    storage_size: Optional[str]
+    shm_size: Optional[str]
+    tmpfs_size: Optional[str]
+
+    @property
+    def key(self) -> str:
+        return hashlib.sha1(repr(dataclasses.astuple(self)).encode()).hexdigest()[:12]
+
+    def container_config(self, container_name: str, host_ports: list[int]) -> ContainerConfig:
+        return ContainerConfig(
+            image_name=self.image,
+            container_name=container_name,
+            volumes=list(self.volumes),
+            port_mapping=[f'{host}:{target}' for host, target in zip(host_ports, self.ports)],
+            network=self.network,
+            gpu_ids=list(self.gpu_ids) if self.gpu_ids is not None else None,
+            memory_limit=self.memory_limit,
+            storage_size=self.storage_size,
+            shm_size=self.shm_size,
+            tmpfs_size=self.tmpfs_size,
+        )
+
+def pod_spec(image: str, ports: tuple[int, ...], username: str, quota: UserQuota, cfg: Config) -> PodSpec:
+    def parse_gpuids(s: str) -> Optional[tuple[int, ...]]:
+        s = s.strip().lower()
+        if s == '' or s == 'all': return None   # no limit, all gpus
+        if s == 'none': return ()               # no gpu
+        return tuple(int(i) for i in s.split(',') if i.isdigit())
+    def size(v: int) -> Optional[str]:
+        return f'{v}b' if v > 0 else None
+    return PodSpec(
+        image=image,
+        ports=tuple(ports),
+        volumes=tuple(Template(mapping).substitute(username=username) for mapping in cfg.volume_mappings),
+        network=cfg.network,
+        gpu_ids=parse_gpuids(quota.gpus),
+        memory_limit=size(quota.memory_limit),
+        storage_size=size(quota.storage_size),
+        shm_size=size(quota.shm_size),
+        tmpfs_size=size(quota.tmpfs_size),
+    )
+
+def pool_prefix(cfg: Config) -> str:
+    # four name parts, never parsed as a pod of a user
+    return f"{cfg.name_prefix or 'pody'}-pool-"
+
+def depends_on_user(mapping: str) -> bool:
+    """ Whether the volume mapping contains $username or ${username} """
+    return any(
+        (m.group('named') or m.group('braced')) == 'username'
+        for m in Template.pattern.finditer(mapping)
+    )
+
+def pooled_specs(cfg: Config) -> dict[str, tuple[PodSpec, int]]:
+    """ Spec key -> (spec, pool size) of the images with a warm pool, empty if the volumes depend on the user """
+    if not any(im.warm_pool > 0 for im in cfg.images) or any(depends_on_user(m) for m in cfg.volume_mappings):
+        return {}
+    quota = get_fallback_quota(UserQuota(-1, -1, "", -1, -1, -1, -1, -1, -1), cfg.default_quota)
+    specs = {}
+    for im in cfg.images:
+        # an image without tag is a family of images, the one to pre-create is unknown
+        if im.warm_pool > 0 and ':' in im.name:
+            spec = pod_spec(im.name, im.ports, "", quota, cfg)
+            specs[spec.key] = (spec, im.warm_pool)
+    return specs
+
+class WarmPool:
+    """
+    Claim and refill pooled containers, named [prefix]-pool-[spec key]-[random],
+    the host ports of a pooled container are reserved under its name and move with it when claimed
+    """
+    def __init__(self, docker_con: DockerController, state: DockerStateCache, port_allocator: PortAllocator):
+        self.docker_con = docker_con
+        self.state = state
+        self.port_allocator = port_allocator
+        self.logger = get_logger('engine')
+
+    def is_claimable(self, name: str) -> bool:
+        """
+        The container is not started, and its host ports are still reserved under its name,
+        otherwise they may be given to another pod and the start would fail
+        """
+        attrs = self.state.get_container(name)
+        return attrs is not None and attrs['State']['Status'] == 'created' \
+            and set(used_ports_from_attrs(attrs)) <= self.port_allocator.reserved_by(name)
+
+    def pooled(self, key: str = "") -> list[str]:
+        """ Names of the pooled containers that can be claimed, of the spec key or of all specs """
+        prefix = pool_prefix(config()) + (f"{key}-" if key else "")
+        return [name for name in self.state.list_containers(prefix) if name.startswith(prefix) and self.is_claimable(name)]
+
+    def claim(self, spec: PodSpec, container_name: str) -> Optional[str]:
+        """ Turn a pooled container of the spec into the pod, return the log, None if there is none to claim """
+        if not spec.key in pooled_specs(config()):
+            return None
+        candidates = self.pooled(spec.key)
+        random.shuffle(candidates)
+        for name in candidates:
+            try:
+                self.docker_con.client.api.rename(name, container_name)
+            except docker.errors.NotFound:
+                continue    # claimed by another worker, or removed by the refill
+            except docker.errors.APIError as e:
+                # the rename did not happen, the pooled container stays in the pool
+                if e.status_code == 409:
+                    raise DuplicateError(f"Container {container_name} already exists")
+                raise e
+            self.port_allocator.transfer(name, container_name)
+            self.state.refresh_container(container_name)
+            try:
+                log = self.docker_con.container_action(container_name, ContainerAction.START)
+            except Exception as e:
+                self.logger.warning(f"Pooled container {name} failed to start as {container_name}, discarded: {e}")
+                with suppress(docker.errors.NotFound):
+                    self.docker_con.client.api.remove_container(container_name, force=True)
+                self.port_allocator.release(container_name)
+                self.state.refresh_container(container_name)
+                continue
+            self.state.refresh_container(container_name)
+            self.logger.info(f"Pooled container {name} claimed as {container_name}")
+            WARM_POOL_CLAIMS.inc(image=spec.image, result="hit")
+            return log
+        WARM_POOL_CLAIMS.inc(image=spec.image, result="miss")
+        return None
+
+    def create_pooled(self, spec: PodSpec) -> str:
+        cfg = config()
+        name = f"{pool_prefix(cfg)}{spec.key}-{random.randbytes(4).hex()}"
+        host_ports = self.port_allocator.allocate(
+            name, len(spec.ports), available=cfg.port_ranges, exclude=set(self.state.used_ports())
+            )
+        try:
+            self.docker_con.create_container(spec.container_config(name, host_ports), start=False)
+        except Exception as e:
+            self.port_allocator.release(name)
+            raise e
+        self.state.refresh_container(name)
+        return name
+
+    def remove_pooled(self, name: str):
+        try:
+            self.docker_con.client.api.remove_container(name, force=True)
+        except docker.errors.NotFound:
+            pass    # just claimed, the ports moved with the rename
+        else:
+            self.port_allocator.release(name)
+        self.state.refresh_container(name)
+
+    def fill(self) -> dict[str, int]:
+        """
+        Remove the pooled containers of outdated specs or images, create the missing ones,
+        return the number of created containers of each image
+        """
+        cfg = config()
+        specs = pooled_specs(cfg)
+        if not specs and any(im.warm_pool > 0 for im in cfg.images):
+            self.logger.warning("Warm pools are configured but not filled, the volume mappings depend on the user")
+        by_key: dict[str, list[str]] = {}
+        prefix = pool_prefix(cfg)
+        for name in self.state.list_containers(prefix):
+            if not name.startswith(prefix): continue
+            by_key.setdefault(name[len(prefix):].split('-')[0], []).append(name)
+
+        image_ids: dict[str, Optional[str]] = {}
+        def image_id(image: str) -> Optional[str]:
+            if image not in image_ids:
+                try: image_ids[image] = self.docker_con.client.images.get(image).id
+                except docker.errors.ImageNotFound: image_ids[image] = None
+            return image_ids[image]
+
+        def is_current(name: str, spec: Optional[PodSpec]) -> bool:
+            attrs = self.state.get_container(name)
+            return spec is not None and attrs is not None and self.is_claimable(name) \
+                and attrs.get('Image') == image_id(spec.image)
+
+        kept: dict[str, int] = {}
+        for key, names in by_key.items():
+            spec, size = specs.get(key, (None, 0))
+            current = [name for name in names if is_current(name, spec)]
+            for name in [name for name in names if not name in current] + current[size:]:
+                self.logger.info(f"Pooled container {name} is outdated or surplus, removed")
+                self.remove_pooled(name)
+            kept[key] = min(len(current), size)
+
+        created: dict[str, int] = {}
+        for key, (spec, size) in specs.items():
+            if image_id(spec.image) is None:
+                self.logger.warning(f"Image {spec.image} not found, warm pool not filled")
+                continue
+            for _ in range(size - kept.get(key, 0)):
+                self.create_pooled(spec)
+                created[spec.image] = created.get(spec.image, 0) + 1
+        if created:
+            self.logger.info(f"Warm pools refilled: {created}")
+        return created
+
+
+if __name__ == "__main__":
+    # create latency with and without the pool, against the local docker daemon:
+    # python -m pody.eng.warm_pool <image:tag> [n]
+    import sys
+    from .docker_state import get_docker_state
+    image, n = sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    cfg = config()
+    spec = PodSpec(image, (22,), (), cfg.network, (), None, None, None, None)
+    pool = WarmPool(DockerController(), get_docker_state(), PortAllocator())
+
+    def create_cold(name: str):
+        ports = pool.port_allocator.allocate(name, len(spec.ports), cfg.port_ranges, set(pool.state.used_ports()))
+        pool.docker_con.create_container(spec.container_config(name, ports))
+
+    def timed_creates(create) -> list[float]:
+        latencies = []
+        for i in range(n):
+            name = f"pody-bench-pool-{i}"
+            t = time.perf_counter()
+            create(name)
+            latencies.append(time.perf_counter() - t)
+            pool.remove_pooled(name)
+            pool.port_allocator.release(name)
+        return latencies
+
+    cold = timed_creates(create_cold)
+    for _ in range(n): pool.create_pooled(spec)
+    warm = timed_creates(lambda name: pool.claim(spec, name) or create_cold(name))
+    for name in pool.pooled(spec.key): pool.remove_pooled(name)
+    for label, latencies in (("without pool", cold), ("with pool", warm)):
+        latencies.sort()
+        print(f"{label:12s} n={n} mean={sum(latencies) / n * 1000:.0f}ms p50={latencies[n // 2] * 1000:.0f}ms max={latencies[-1] * 1000:.0f}ms")
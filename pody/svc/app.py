@@ -2,6 +2,7 @@ import uvicorn
 from typing import Optional
 
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from .daemon import daemon_context
 from .app_base import *
 from .router_host import router_host
@@ -9,7 +10,9 @@ from .router_pod import router_pod
 from .router_user import router_user
 from .router_stat import router_stat
 from .router_image import router_image
+from .router_job import router_job
 from .router_user_api import router_user_api
+from ..eng.metrics import collect_metrics
 from ..config import SRC_HOME
 from ..version import VERSION
 
@@ -18,24 +21,27 @@ app.include_router(router_user)
 app.include_router(router_user_api)
 app.include_router(router_pod)
 app.include_router(router_image)
+app.include_router(router_job)
 app.include_router(router_stat)
 app.include_router(router_host)
 
-import inspect
-from fastapi import Depends
+import inspect, json, hashlib
+from fastapi import Depends, Request, Response
 from starlette.routing import Route, BaseRoute
 from pody.eng.user import UserRecord
-@app.get("/help")
-@handle_exception
-async def help(path: Optional[str] = None, _: UserRecord = Depends(require_permission("all"))):
-    """
-    return the http method and params for the path
-    """
+
+__g_route_table: Optional[tuple[list[dict], str]] = None
+def route_table() -> tuple[list[dict], str]:
+    """ The help info of all public routes and its ETag, built once, the routes do not change after startup """
+    global __g_route_table
+    if __g_route_table is not None:
+        return __g_route_table
+
     def get_path_info(route: Route):
         params = inspect.signature(route.endpoint).parameters
         def fmt_param(p: inspect.Parameter) -> Optional[dict]:
             try:
-                if p.annotation == UserRecord:  # skip user dependency
+                if p.annotation in (UserRecord, Request):  # skip user dependency and the request object
                     return None
                 return {
                     "name": p.name,
@@ -46,7 +52,7 @@ async def help(path: Optional[str] = None, _: UserRecord = Depends(require_permi
                 return None
         return {
             "path": route.path,
-            "methods": route.methods,
+            "methods": sorted(route.methods or []),
             "params": [x for p in params if (x:=fmt_param(params[p])) is not None]
         }
     def filter_routes(routes: list[BaseRoute]) -> list[Route]:
@@ -56,21 +62,42 @@ async def help(path: Optional[str] = None, _: UserRecord = Depends(require_permi
             ] and not route.path.startswith("/user_api")   # user_api routes are not for public use
         return [route for route in routes if criteria(route)]   # type: ignore
 
-    route_candidates = filter_routes(app.routes)
+    table = [get_path_info(route) for route in filter_routes(app.routes)]
+    # the server version is part of the tag, clients may key their cache by it
+    digest = hashlib.sha1(json.dumps(table, sort_keys=True).encode()).hexdigest()[:16]
+    __g_route_table = (table, f'"{".".join(map(str, VERSION))}-{digest}"')
+    return __g_route_table
+
+@app.get("/help")
+@handle_exception
+async def help(request: Request, path: Optional[str] = None, _: UserRecord = Depends(require_permission("all"))):
+    """
+    return the http method and params for the path,
+    the full table (without path) is served with an ETag and revalidated with If-None-Match
+    """
+    table, etag = route_table()
     if path is None:
-        return [get_path_info(route) for route in route_candidates if isinstance(route, Route)]
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(json.dumps(table), media_type="application/json", headers={"ETag": etag})
 
     path = path.split("?")[0]   # remove query string
-    ret = []
-    for route in route_candidates:
-        if not isinstance(route, Route): continue
-        if (path.endswith("/") and route.path.startswith(path)) or route.path == path:
-            ret.append(get_path_info(route))
-    return ret
+    return [
+        info for info in table
+        if (path.endswith("/") and info["path"].startswith(path)) or info["path"] == path
+    ]
 
 @app.get("/version")
 def version():
     return VERSION
+
+@app.get("/metrics")
+@handle_exception
+def metrics(_: UserRecord = Depends(require_permission("admin"))):
+    """
+    metrics of the server and daemon processes, in the Prometheus text format
+    """
+    return PlainTextResponse(collect_metrics(), media_type="text/plain; version=0.0.4", headers={"X-Skip-Log": "1"})
                 
 def start_server(
     host: str = "0.0.0.0",
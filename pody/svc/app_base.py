@@ -1,4 +1,4 @@
-import inspect, json
+import inspect, json, threading, time, random
 import rich
 import requests
 from functools import wraps
@@ -7,18 +7,28 @@ from fastapi import FastAPI, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import HTTPException
 from fastapi.security import HTTPBasicCredentials, HTTPBasic
+from starlette.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
-from typing import Literal
+from typing import Literal, Optional
 import docker
 
 from ..eng.errors import *
 from ..eng.log import get_logger
+from ..eng.metrics import HTTP_REQUEST_SECONDS, start_metrics_dumper
+from ..eng.docker_state import get_docker_state
+from ..eng.ports import reconcile_port_reservations
+from ..eng.jobs import recover_jobs
 from ..config import config
-from ..eng.user import UserDatabase, hash_password, UserRecord
+from ..eng.user import hash_password, UserRecord, get_credential_cache
 
 @asynccontextmanager
 async def life_span(app: FastAPI):
     config()    # maybe init configuration file at the beginning
+    # start following docker events, in a thread as the client connects to the daemon on creation
+    threading.Thread(target=get_docker_state, kwargs={"wait_ready": None}, daemon=True).start()
+    threading.Thread(target=reconcile_port_reservations, daemon=True).start()
+    threading.Thread(target=recover_jobs, daemon=True).start()     # resume the jobs queued before a restart
+    start_metrics_dumper()      # for /metrics served by the other workers
     yield
 
 app = FastAPI(docs_url=None, redoc_url=None, lifespan=life_span)
@@ -36,36 +46,42 @@ def deprecated_route(message: str):
             if inspect.iscoroutinefunction(func):
                 res = await func(*args, **kwargs)
             else:
-                res = func(*args, **kwargs)
+                res = await run_in_threadpool(func, *args, **kwargs)
             return {"deprecated": message, "res": res}
         return wrapper
     return decorator
                     
+def http_exception_of(e: Exception) -> Optional[HTTPException]:
+    """ The HTTP error of an engine exception, None for unexpected errors """
+    if isinstance(e, HTTPException): return e
+    if isinstance(e, InvalidInputError): return HTTPException(status_code=400, detail=str(e))
+    if isinstance(e, PermissionError): return HTTPException(status_code=403, detail=str(e))
+    if isinstance(e, NotFoundError): return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, DuplicateError): return HTTPException(status_code=409, detail=str(e))
+    if isinstance(e, IncorrectConfigError): return HTTPException(status_code=500, detail=str(e))
+    if isinstance(e, docker.errors.NotFound): return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, docker.errors.APIError): return HTTPException(status_code=500, detail=str(e))
+    if isinstance(e, requests.exceptions.ReadTimeout): return HTTPException(status_code=504, detail="Request timed out")
+    return None
+
 def handle_exception(fn):
     @wraps(fn)
     async def wrapper(*args, **kwargs):
         try:
             if inspect.iscoroutinefunction(fn):
                 return await fn(*args, **kwargs)
-            return fn(*args, **kwargs)
+            # blocking handlers (e.g. docker-py calls) should not stall the event loop
+            return await run_in_threadpool(fn, *args, **kwargs)
         except Exception as e:
             if isinstance(e, HTTPException): 
                 print(f"HTTPException: {e}, detail: {e.detail}")
-            if isinstance(e, HTTPException): raise e
-            if isinstance(e, InvalidInputError): raise HTTPException(status_code=400, detail=str(e))
-            if isinstance(e, PermissionError): raise HTTPException(status_code=403, detail=str(e))
-            if isinstance(e, NotFoundError): raise HTTPException(status_code=404, detail=str(e))
-            if isinstance(e, DuplicateError): raise HTTPException(status_code=409, detail=str(e))
-            if isinstance(e, IncorrectConfigError): raise HTTPException(status_code=500, detail=str(e))
-            if isinstance(e, docker.errors.NotFound): raise HTTPException(status_code=404, detail=str(e))
-            if isinstance(e, docker.errors.APIError): raise HTTPException(status_code=500, detail=str(e))
-            if isinstance(e, requests.exceptions.ReadTimeout): raise HTTPException(status_code=504, detail="Request timed out")
+            if (http_e := http_exception_of(e)) is not None: raise http_e
             raise
     return wrapper
 
 def user_from_credentials(r: Request, credentials: HTTPBasicCredentials = Depends(HTTPBasic(auto_error=True))):
     key = hash_password(credentials.username, credentials.password)
-    user = UserDatabase().check_user(key)
+    user = get_credential_cache().check_user(key)
     r.state.user = user
     return user
 
@@ -83,7 +99,14 @@ def require_permission(permission: Literal['all', 'admin'] = "all"):
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     logger = get_logger('requests')
+    start = time.perf_counter()
     response: Response = await call_next(request)
+    # route template, so that path parameters and unknown paths do not blow up the label set
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method, route=getattr(route, "path", "<unmatched>"), status=response.status_code,
+    )
 
     if response.headers.get("X-Skip-Log") == "1":
         return response
@@ -97,26 +120,25 @@ async def log_requests(request: Request, call_next):
             return "blue"
         else:
             return "green"
-    rich.print(
-        f"[{request.method}] {str(request.url).split('?')[0]} "
-        f"from [purple]{request.client.host if request.client else 'unknown'}[/purple] "
-        f"[[{status_color(response.status_code)}]{response.status_code}[/{status_color(response.status_code)}]]"
-    )
+    # sampled access log on the console, errors are always printed
+    if response.status_code >= 400 or random.random() < config().log.access_log_sample:
+        rich.print(
+            f"[{request.method}] {request.url.path} "
+            f"from [purple]{request.client.host if request.client else 'unknown'}[/purple] "
+            f"[[{status_color(response.status_code)}]{response.status_code}[/{status_color(response.status_code)}]]"
+        )
 
     user = request.state.user if hasattr(request.state, 'user') else None
-    url_str = str(request.url) if request.url else ''
-    url_base = url_str.split('?')[0] if url_str else ''
-    url_params = url_str.split('?')[1] if '?' in url_str else ''
     logger.debug(json.dumps({
-        "url": url_base,
+        "url": f"{request.url.scheme}://{request.url.netloc}{request.url.path}",
         "user": user.name if user else "",
-        "params": url_params,
+        "params": request.url.query,
         "method": str(request.method),
         "client": str(request.client.host if request.client else 'unknown'),
-        "headers": dict(request.headers),
+        "user_agent": request.headers.get("user-agent", ""),
         "status": response.status_code,
     }))
     return response
 
-__all__ = ["app", "require_permission", "handle_exception", "deprecated_route"]
+__all__ = ["app", "require_permission", "handle_exception", "http_exception_of", "deprecated_route", "run_in_threadpool"]
                 
\ No newline at end of file
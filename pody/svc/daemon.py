@@ -1,103 +1,233 @@
-import time
-import typing 
-import docker
+import os, time, json, heapq, random, threading, itertools
+import typing
+import dataclasses
 import multiprocessing as mp
 from contextlib import contextmanager
+from functools import cached_property
 from ..eng.user import UserDatabase
 from ..eng.quota import QuotaDatabase
-from ..eng.gpu import GPUHandler
 from ..eng.docker import DockerController
-from ..eng.resmon import ProcessIter, ContainerProcessInfo, ResourceMonitorDatabase
+from ..eng.docker_state import get_docker_state
+from ..eng.ports import PortAllocator
+from ..eng.warm_pool import WarmPool
+from ..eng.resmon import ProcessIter, ResourceMonitorDatabase
+from ..eng.gpu_enforce import GPUEnforcer
 from ..eng.log import get_logger
-from ..eng.nparse import split_name_component
+from ..eng.metrics import Counter, REGISTRY, DAEMON_TASK_SECONDS, start_metrics_dumper
+from ..config import DATA_HOME, config
 
-def leave_info(container_name, info: str, level: str = "info"):
-    assert "'" not in info, "Single quote is not allowed in info"
-    curr_time_str = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-    logdir = "/log/pody"
-    fname = f"{curr_time_str}.{level}.log"
-    DockerController().exec_container_bash(container_name, f"mkdir -p {logdir} && echo '{info}' > {logdir}/{fname}")
+DAEMON_STATS_FILE = DATA_HOME / "daemon_stats.json"
 
-def task_check_gpu_usage():
-    logger = get_logger('daemon')
-    client = docker.from_env()
-    user_db = UserDatabase()
-    quota_db = QuotaDatabase()
-
-    user_proc_count: dict[str, int] = {}
-    user_procs: dict[str, list[ContainerProcessInfo]] = {}
-
-    def is_user_process(p: ContainerProcessInfo):
-        name_sp = split_name_component(p.container_name, check=True)
-        username = name_sp['username'] if name_sp else ""
-        user = user_db.get_user(username)
-        return ProcessIter.FilterReturn(
-            is_valid=name_sp is not None and user.userid != 0,
-            extra=user
+DAEMON_TASK_SKIPPED: Counter = REGISTRY.register(Counter(
+    "pody_daemon_task_skipped_total", "Ticks skipped because the previous run of the task was still running",
+    ("task",),
+))  # type: ignore
+
+class DaemonEngines:
+    """ Engine objects shared by the tasks of the scheduler process, created on first use """
+    @cached_property
+    def docker(self): return DockerController()
+    @cached_property
+    def user_db(self): return UserDatabase()
+    @cached_property
+    def quota_db(self): return QuotaDatabase()
+    @cached_property
+    def resmon_db(self): return ResourceMonitorDatabase()
+    @cached_property
+    def process_iter(self): return ProcessIter()
+    @cached_property
+    def warm_pool(self): return WarmPool(self.docker, get_docker_state(), PortAllocator())
+    @cached_property
+    def gpu_enforcer(self) -> GPUEnforcer:
+        cfg = config().daemon
+        return GPUEnforcer(
+            process_iter=self.process_iter,
+            quota_of=lambda username: self.quota_db.check_quota(username, use_fallback=True).gpu_count,
+            is_user=lambda username: self.user_db.get_user(username).userid != 0,
+            docker_con=self.docker,
+            resmon_db=self.resmon_db,
+            grace=cfg.gpu_grace_period,
+            kill_after=cfg.gpu_kill_after,
         )
-    mon = ProcessIter(filter_fn=is_user_process)
-
-    for i in range(GPUHandler().device_count()):
-        this_gpu_users = set()
-        for p, user in mon.gpu_process([i]):
-            pod_name: str = p.container_name
-            username = user.name
-            this_gpu_users.add(username)
-            user_procs[username] = user_procs.get(username, []) + [p]
-        for user in this_gpu_users:
-            user_proc_count[user] = user_proc_count.get(user, 0) + 1
-    
-    for username, proc_count in user_proc_count.items():
-        max_gpu_count = quota_db.check_quota(username, use_fallback=True).gpu_count
-        if max_gpu_count >= 0 and proc_count > max_gpu_count:
-            # kill container from this user (the one with the shortest uptime)
-            # not process because we may not have permission to kill process...
-            user_procs[username].sort(key=lambda x: x.cproc.uptime)
-            proc_info = user_procs[username][0]
-            pod_name = proc_info.container_name
-            pid = int(proc_info.cproc.pid)
-            cmd = proc_info.cproc.cmd
-            leave_info(pod_name, f"Killed container with pid-{pid} ({cmd}) due to GPU quota exceeded.", "critical")
-            client.containers.get(pod_name).stop()
-            logger.info(f"Killed container {pod_name} with pid-{pid} ({cmd}) due to GPU quota exceeded.")
-
-def task_record_resource_usage():
+
+def task_enforce_gpu_quota(eng: DaemonEngines):
+    """ Warn, stop and kill containers of users over their GPU quota, see `GPUEnforcer` """
+    eng.gpu_enforcer.poll()
+
+def task_record_resource_usage(eng: DaemonEngines):
     """
     Record resource usage of all containers.
     This is a daemon task that runs periodically.
     """
     logger = get_logger('daemon')
-    mon = ProcessIter()
-    resmon_db = ResourceMonitorDatabase()
-    
+    mon = eng.process_iter
     try:
-        resmon_db.update(map(lambda it: it[0], mon.all_process()))
-        resmon_db.update(map(lambda it: it[0], mon.gpu_process()))
+        # one transaction per sweep, GPU entries are merged into the process rows
+        eng.resmon_db.update(map(lambda it: it[0], itertools.chain(mon.all_process(), mon.gpu_process())))
     except Exception as e:
         logger.error(f"Error recording resource usage: {e}")
 
-def create_daemon_worker(fn: typing.Callable, interval, delay=0, args = (), kwargs = {}):
-    def daemon_worker():
-        time.sleep(delay)
-        while True:
-            try:
-                fn(*args, **kwargs)
-                get_logger('daemon.exec').debug(f"Daemon worker [{fn.__name__}] executed")
-            except Exception as e:
-                if isinstance(e, KeyboardInterrupt): raise
-                get_logger('daemon.err').exception(f"Error in daemon worker [{fn.__name__}]: {e}")
-            time.sleep(interval)
-    return mp.Process(target=daemon_worker)
+def task_fill_warm_pool(eng: DaemonEngines):
+    """ Keep the configured number of pre-created pods of each image, see `WarmPool` """
+    eng.warm_pool.fill()
+
+@dataclasses.dataclass
+class TaskStats:
+    interval: float
+    runs: int = 0
+    errors: int = 0
+    skipped: int = 0
+    running: bool = False
+    last_start: float = 0           # epoch
+    last_duration: float = 0        # seconds
+    last_lag: float = 0             # start delay after the scheduled (jittered) time, seconds
+    max_lag: float = 0
+    last_error: str = ""
+
+@dataclasses.dataclass
+class ScheduledTask:
+    name: str
+    fn: typing.Callable[[DaemonEngines], typing.Any]
+    interval: float
+    delay: float = 0
+    jitter: float = 0
+
+class Scheduler:
+    """
+    Run the registered tasks at fixed rates in one process, each run in its own thread.
+    Ticks are at `start + delay + k * interval`, each delayed by a random jitter in [0, jitter).
+    A tick is skipped if the previous run of the task is still running,
+    the ticks missed while it was running are coalesced into the next one.
+    """
+    def __init__(self, engines: typing.Optional[DaemonEngines] = None, stats_file: typing.Optional[os.PathLike] = DAEMON_STATS_FILE):
+        self.engines = engines if engines is not None else DaemonEngines()
+        self.stats_file = stats_file
+        self.tasks: list[ScheduledTask] = []
+        self.stats: dict[str, TaskStats] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def register(self, task: ScheduledTask):
+        self.tasks.append(task)
+        self.stats[task.name] = TaskStats(interval=task.interval)
+
+    def _execute(self, task: ScheduledTask, fire: float):
+        stats = self.stats[task.name]
+        start = time.time()
+        with self._lock:
+            stats.last_start = start
+            stats.last_lag = max(0, time.monotonic() - fire)
+            stats.max_lag = max(stats.max_lag, stats.last_lag)
+        result = "ok"
+        try:
+            task.fn(self.engines)
+            get_logger('daemon.exec').debug(f"Daemon task [{task.name}] executed")
+        except Exception as e:
+            result = "error"
+            with self._lock:
+                stats.errors += 1
+                stats.last_error = f"{type(e).__name__}: {e}"
+            get_logger('daemon.err').exception(f"Error in daemon task [{task.name}]: {e}")
+        finally:
+            duration = time.time() - start
+            DAEMON_TASK_SECONDS.observe(duration, task=task.name, result=result)
+            with self._lock:
+                stats.runs += 1
+                stats.last_duration = duration
+                stats.running = False
+            self.dump_stats()
+
+    def dump_stats(self):
+        if self.stats_file is None: return
+        with self._lock:
+            data = {
+                "pid": os.getpid(), "time": time.time(),
+                "tasks": {name: dataclasses.asdict(s) for name, s in self.stats.items()},
+            }
+        tmp = f"{self.stats_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.stats_file)
+
+    def run(self):
+        """ Run until `stop` is called """
+        t0 = time.monotonic()
+        # (fire time, tick without jitter, task index)
+        queue = [(t0 + t.delay + random.uniform(0, t.jitter), t0 + t.delay, i) for i, t in enumerate(self.tasks)]
+        heapq.heapify(queue)
+        self.dump_stats()
+        while queue and not self._stop.is_set():
+            fire, tick, i = queue[0]
+            if self._stop.wait(max(0, fire - time.monotonic())):
+                break
+            heapq.heappop(queue)
+            task, stats = self.tasks[i], self.stats[self.tasks[i].name]
+            with self._lock:
+                skip = stats.running
+                if skip:
+                    stats.skipped += 1
+                else:
+                    stats.running = True
+            if skip:
+                DAEMON_TASK_SKIPPED.inc(task=task.name)
+                get_logger('daemon').warning(f"Daemon task [{task.name}] is still running, tick skipped")
+            else:
+                threading.Thread(target=self._execute, args=(task, fire), name=f"daemon-{task.name}", daemon=True).start()
+            # next tick on the fixed grid after now, missed ticks are coalesced
+            n_missed = max(0, int((time.monotonic() - tick) // task.interval))
+            next_tick = tick + (n_missed + 1) * task.interval
+            heapq.heappush(queue, (next_tick + random.uniform(0, task.jitter), next_tick, i))
+
+    def stop(self):
+        self._stop.set()
+
+def read_daemon_stats() -> dict:
+    """ Stats of the scheduler process, written by the scheduler after each run """
+    try:
+        with open(DAEMON_STATS_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"pid": None, "time": None, "tasks": {}}
+
+def create_scheduler() -> Scheduler:
+    cfg = config().daemon
+    scheduler = Scheduler()
+    # short interval without jitter, the grace period is counted from the first poll over quota
+    scheduler.register(ScheduledTask("enforce_gpu_quota", task_enforce_gpu_quota, cfg.gpu_check_interval))
+    scheduler.register(ScheduledTask("record_resource_usage", task_record_resource_usage, cfg.resource_record_interval, delay=5, jitter=cfg.jitter))
+    if any(im.warm_pool > 0 for im in config().images):
+        scheduler.register(ScheduledTask("fill_warm_pool", task_fill_warm_pool, cfg.warm_pool_interval, delay=1))
+    return scheduler
+
+def _scheduler_process():
+    start_metrics_dumper()
+    create_scheduler().run()
 
 @contextmanager
 def daemon_context():
-    ps = [
-        create_daemon_worker(task_check_gpu_usage, 60),
-        create_daemon_worker(task_record_resource_usage, 60, delay=5)
-    ]
-    for p in ps: p.start()
+    p = mp.Process(target=_scheduler_process, name="pody-daemon")
+    p.start()
     try:
         yield
     finally:
-        for p in ps: p.terminate()
-        for p in ps: p.join()
\ No newline at end of file
+        p.terminate()
+        p.join()
+
+
+if __name__ == "__main__":
+    # drift and overlap with tasks that sometimes run longer than the interval
+    def make_task(name: str, durations: list[float]):
+        it = iter(durations * 100)
+        def fn(_):
+            time.sleep(next(it))
+        return ScheduledTask(name, fn, interval=0.2, jitter=0.02)
+
+    scheduler = Scheduler(engines=DaemonEngines(), stats_file=None)
+    scheduler.register(make_task("steady", [0.05]))
+    scheduler.register(make_task("overrun", [0.05, 0.05, 0.5]))
+    threading.Timer(5, scheduler.stop).start()
+    t = time.time()
+    scheduler.run()
+    print(f"ran for {time.time() - t:.1f}s, 25 ticks expected per task")
+    for name, s in scheduler.stats.items():
+        print(f"{name:8s} runs={s.runs} skipped={s.skipped} last_duration={s.last_duration:.3f}s max_lag={s.max_lag * 1000:.1f}ms")
@@ -7,8 +7,9 @@ from typing import Optional
 from ..eng.errors import *
 from ..eng.user import UserRecord
 from ..eng.docker import DockerController
-from ..eng.gpu import GPUHandler
-from ..eng.resmon import ProcessIter
+from ..eng.gpu import get_gpu_sampler
+from ..eng.resmon import ProcessIter, ResourceMonitorDatabase
+from .daemon import read_daemon_stats
 
 from ..version import VERSION
 
@@ -29,13 +30,16 @@ def gpu_status_impl(gpu_ids: list[int]):
         return ProcessIter.FilterReturn(is_valid=True, extra=r)
     
     piter = ProcessIter(filter_fn=gpu_proc_filter, docker_only=False)
-    return {i: list(map(lambda x: x[1], piter.gpu_process([i]))) for i in gpu_ids}
+    res: dict[int, list[dict]] = {i: [] for i in gpu_ids}
+    for p, r in piter.gpu_process(gpu_ids):
+        res[p.gproc.gpu_id].append(r)   # type: ignore
+    return res
 
 @router_host.get("/gpu-ps")
 @handle_exception
 def gpu_status(id: Optional[str] = None):
     if id is None:
-        _ids = list(range(GPUHandler().device_count()))
+        _ids = list(range(get_gpu_sampler().device_count()))
     else:
         try:
             _ids = [int(i.strip()) for i in id.split(",")]
@@ -43,6 +47,17 @@ def gpu_status(id: Optional[str] = None):
             raise InvalidInputError("Invalid GPU ID")
     return gpu_status_impl(_ids)
 
+@router_host.get("/daemon-stats")
+@handle_exception
+def daemon_stats(_: UserRecord = Depends(require_permission("admin"))):
+    """ Run statistics of the periodic tasks, e.g. last duration, lag to the scheduled time and skipped runs """
+    return read_daemon_stats()
+
+@router_host.get("/gpu-enforcement")
+@handle_exception
+def gpu_enforcement(user: Optional[str] = None, limit: int = 100, _: UserRecord = Depends(require_permission("admin"))):
+    return ResourceMonitorDatabase().query_enforcement(username=user, limit=limit)
+
 @router_host.get("/spec")
 def spec(_: UserRecord = Depends(require_permission("all"))):
     def get_docerk_version():
@@ -6,7 +6,8 @@ from fastapi.routing import APIRouter
 from ..eng.errors import *
 from ..eng.user import UserRecord
 from ..eng.docker import DockerController
-from ..eng.nparse import ImageFilter, ImageNameTran
+from ..eng.docker_state import get_docker_state
+from ..eng.nparse import ImageNameTran
 from ..config import config
 
 router_image = APIRouter(prefix="/image")
@@ -15,14 +16,7 @@ router_image = APIRouter(prefix="/image")
 @handle_exception
 def list_images(user: UserRecord = Depends(require_permission("all"))):
     tran = ImageNameTran(config().commit_name)
-    it =map(
-            tran.abbreviate_if_user_commit,
-            ImageFilter(
-                config = config(), 
-                raw_images=DockerController().list_docker_images(), 
-                username = user.name
-            ).iter()
-        )
+    it = map(tran.abbreviate_if_user_commit, get_docker_state().image_catalog().iter(user.name))
     return sorted(it, key=lambda x: (":" in x, x))
 
 @router_image.post("/delete")
@@ -30,20 +24,15 @@ def list_images(user: UserRecord = Depends(require_permission("all"))):
 def delete_image(image: str, user: UserRecord = Depends(require_permission("all"))):
     image = ImageNameTran(config().commit_name)\
             .expand_if_user_commit(image)
-    c = DockerController()
-    im_list = c.list_docker_images()
-    if not image in im_list:
+    state = get_docker_state()
+    catalog = state.image_catalog()
+    if not image in catalog:
         raise InvalidInputError("Image not found, please check the available images")
-
-    im_filter = ImageFilter(
-        config = config(), 
-        raw_images = im_list,
-        username=user.name
-    )
-    if not im_filter.has_user_image(image):
+    if not catalog.has_user_image(image, user.name):
         raise PermissionError("Can only delete user commit images")
     
-    c.delete_docker_image(image)
+    DockerController().delete_docker_image(image)
+    state.refresh_images()
     return {"log": "Image {} deleted".format(image)}
 
 @router_image.post("/inspect")
@@ -51,18 +40,10 @@ def delete_image(image: str, user: UserRecord = Depends(require_permission("all"
 def inspect_image(image: str, user: UserRecord = Depends(require_permission("all"))):
     image = ImageNameTran(config().commit_name)\
             .expand_if_user_commit(image)
-    c = DockerController()
-    im_list = c.list_docker_images()
-    if not image in im_list:
+    catalog = get_docker_state().image_catalog()
+    if not image in catalog:
         raise InvalidInputError("Image not found, please check the available images")
-
-    im_filter = ImageFilter(
-        config = config(), 
-        raw_images = im_list,
-        username=user.name
-    )
-    if im_filter.query_config(image) or im_filter.has_user_image(image):
-        return c.inspect_docker_image(image)
+    if catalog.query_config(image, user.name):
+        return DockerController().inspect_docker_image(image)
     else:
         raise PermissionError("Invalid image name, please check the available images")
-    
\ No newline at end of file
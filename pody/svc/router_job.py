@@ -0,0 +1,49 @@
+from .app_base import *
+
+import asyncio, time, dataclasses
+from fastapi import Depends
+from fastapi.routing import APIRouter
+
+from ..eng.errors import *
+from ..eng.user import UserRecord
+from ..eng.jobs import JobDatabase, JobRecord
+
+router_job = APIRouter(prefix="/job")
+
+WAIT_MAX_TIMEOUT = 300
+
+def get_job_raise(id: str, user: UserRecord) -> JobRecord:
+    record = JobDatabase().get(id)
+    # jobs of other users are reported as not found
+    if record is None or (record.username != user.name and not user.is_admin):
+        raise NotFoundError(f"Job {id} not found")
+    return record
+
+@router_job.get("/status")
+@handle_exception
+def job_status(id: str, user: UserRecord = Depends(require_permission("all"))):
+    return dataclasses.asdict(get_job_raise(id, user))
+
+@router_job.get("/wait")
+@handle_exception
+async def job_wait(id: str, timeout: float = 30, user: UserRecord = Depends(require_permission("all"))):
+    """
+    Wait until the job is finished or the timeout (seconds, at most 300) is reached, 
+    return the job status either way, the job may run in another server process
+    """
+    timeout = min(max(timeout, 0), WAIT_MAX_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    interval = 0.05
+    while True:
+        record = await run_in_threadpool(get_job_raise, id, user)
+        if record.is_finished or time.monotonic() >= deadline:
+            return dataclasses.asdict(record)
+        await asyncio.sleep(min(interval, max(0, deadline - time.monotonic())))
+        interval = min(interval * 2, 0.5)
+
+@router_job.get("/list")
+@handle_exception
+def job_list(limit: int = 20, user: UserRecord = Depends(require_permission("all"))):
+    """ The latest jobs of the user, of all users for admin """
+    records = JobDatabase().list_jobs(username=None if user.is_admin else user.name, limit=min(max(limit, 1), 1000))
+    return [dataclasses.asdict(r) for r in records]
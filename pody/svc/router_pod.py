@@ -1,31 +1,34 @@
-import random
-from string import Template
+import asyncio, codecs, json, time, typing
 from typing import Optional
 
 from .app_base import *
 import dataclasses
 from fastapi import Depends
 from fastapi.routing import APIRouter
+from fastapi.responses import StreamingResponse
 from contextlib import suppress
 
 from ..eng.nparse import eval_name_raise, get_user_pod_prefix
 
 from ..config import config
 from ..eng.errors import *
-from ..eng.nparse import ImageFilter, check_name_part, ImageNameTran
+from ..eng.nparse import check_name_part, ImageNameTran
 from ..eng.utils import format_storage_size
 from ..eng.user import UserRecord
 from ..eng.quota import QuotaDatabase
-from ..eng.docker import ContainerAction, ContainerConfig, DockerController
+from ..eng.docker import ContainerAction, ContainerInfo, DockerController
+from ..eng.docker_state import get_docker_state
+from ..eng.docker_async import get_async_docker
+from ..eng.docker_exec import get_exec_engine
+from ..eng.ports import PortAllocator
+from ..eng.warm_pool import WarmPool, pod_spec
+from ..eng.log import get_logger
+from ..eng.user import UserDatabase
+from ..eng.jobs import JobError, JobHandler, JobRecord, get_job_engine, register_job_handler
 
 router_pod = APIRouter(prefix="/pod")
 
-@router_pod.post("/create")
-@handle_exception
-def create_pod(
-    ins: str, image: str, 
-    user: UserRecord = Depends(require_permission("all"))
-    ):
+def create_pod_op(ins: str, image: str, user: UserRecord):
     valid, reason = check_name_part(ins)
     if not valid:
         raise InvalidInputError(f"Invalid pod name: {reason}")
@@ -37,110 +40,152 @@ def create_pod(
     container_name = eval_name_raise(ins, user)
 
     c = DockerController()
+    state = get_docker_state()
     # first check if the container exists
     with suppress(ContainerNotFoundError):
-        c.check_container_raise(container_name)
+        state.check_container_raise(container_name)
         raise DuplicateError(f"Container {container_name} already exists")
 
     # check user quota
     user_quota = QuotaDatabase().check_quota(user.name, use_fallback=True)
-    user_containers = c.list_docker_containers(get_user_pod_prefix(user.name))
+    user_containers = state.list_containers(get_user_pod_prefix(user.name))
     if user_quota.max_pods != -1 and user_quota.max_pods <= len(user_containers):
         raise PermissionError("Exceed max pod limit")
 
     # check image
-    im_filter = ImageFilter(
-        config = server_config, 
-        raw_images=c.list_docker_images(), 
-        username=user.name
-        )
-    target_im_config = im_filter.query_config(image)
+    target_im_config = state.image_catalog().query_config(image, user.name)
     if not target_im_config:
         raise InvalidInputError("Invalid image name, please check the available images")
 
-    # hanlding port
-    def to_individual_port(ports: list[int | tuple[int, int]]) -> list[int]:
-        res = []
-        for port in ports:
-            if isinstance(port, tuple):
-                res.extend(range(port[0], port[1]+1))
-            else:
-                res.append(port)
-        return res
-
-    used_port_list = c.get_docker_used_ports()
-    available_port_list = list(set(to_individual_port(server_config.available_ports)) - set(used_port_list))
-
-    target_ports = target_im_config.ports
-    if len(target_ports) > len(available_port_list):
-        raise PermissionError("No available port")
-    
-    random.shuffle(available_port_list)
-    port_mapping = [f'{available_port_list[i]}:{target_ports[i]}' for i in range(len(target_ports))]
-
-    # handling volume
-    volume_mappings = [Template(mapping).substitute(username=user.name) for mapping in server_config.volume_mappings]
-
-    def parse_gpuids(s: str) -> Optional[list[int]]:
-        s = s.strip().lower()
-        if s == '' or s == 'all': return None   # no limit, all gpus
-        if s == 'none': return []               # no gpu
-        return [int(i) for i in s.split(',') if i.isdigit()]
-        
-    # create container
-    container_config = ContainerConfig(
-        image_name=image,
-        container_name=container_name,
-        volumes=volume_mappings,
-        port_mapping=port_mapping,
-        network=server_config.network, 
-        gpu_ids=parse_gpuids(user_quota.gpus),
-        memory_limit=f'{user_quota.memory_limit}b' if user_quota.memory_limit > 0 else None,
-        storage_size=f'{user_quota.storage_size}b' if user_quota.storage_size > 0 else None, 
-        shm_size=f'{user_quota.shm_size}b' if user_quota.shm_size > 0 else None, 
-        tmpfs_size= f'{user_quota.tmpfs_size}b' if user_quota.tmpfs_size > 0 else None,
-    )
-    log = c.create_container(container_config) 
-    try: container_info = c.inspect_container(container_name)
+    spec = pod_spec(image, target_im_config.ports, user.name, user_quota, server_config)
+    port_allocator = PortAllocator()
+    # a pooled container of the same spec is renamed and started, see eng.warm_pool
+    log = WarmPool(c, state, port_allocator).claim(spec, container_name)
+    if log is None:
+        # handling port, reserved until the container is deleted
+        host_ports = port_allocator.allocate(
+            container_name, len(spec.ports), 
+            available=server_config.port_ranges, 
+            exclude=set(state.used_ports()), 
+            )
+        try: log = c.create_container(spec.container_config(container_name, host_ports)) 
+        except Exception as e:
+            port_allocator.release(container_name)
+            raise e
+    state.refresh_container(container_name)
+    try: container_info = state.inspect_container(container_name)
     except Exception as e: container_info = None
     return {"log": log, "info": container_info}
 
+@router_pod.post("/create")
+@handle_exception
+def create_pod(
+    ins: str, image: str, 
+    job: bool = False,
+    user: UserRecord = Depends(require_permission("all"))
+    ):
+    """ with job=true, return the job id right away, the result is reported by /job/status and /job/wait """
+    if job:
+        eval_name_raise(ins, user)
+        return job_response(get_job_engine().submit("create", user.name, {"ins": ins, "image": image}))
+    return create_pod_op(ins, image, user)
+
+async def pod_action(container_name: str, action: ContainerAction, with_logs: bool = True) -> str:
+    """ Run a lifecycle action and sync the state cache, the ports of a deleted pod are released """
+    log = await get_async_docker().container_action(container_name, action, with_logs=with_logs)
+    await run_in_threadpool(lambda: get_docker_state().refresh_container(container_name))
+    if action == ContainerAction.DELETE:
+        await run_in_threadpool(lambda: PortAllocator().release(container_name))
+    return log
+
+def delete_pod_op(ins: str, user: UserRecord):
+    container_name = eval_name_raise(ins, user)
+    log = DockerController().container_action(container_name, ContainerAction.DELETE)
+    get_docker_state().refresh_container(container_name)
+    PortAllocator().release(container_name)
+    return {"log": log}
+
 @router_pod.post("/delete")
 @handle_exception
-def delete_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
+async def delete_pod(ins: str, job: bool = False, user: UserRecord = Depends(require_permission("all"))):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
-    return {"log": c.container_action(container_name, ContainerAction.DELETE)}
+    if job:
+        return job_response(await run_in_threadpool(get_job_engine().submit, "delete", user.name, {"ins": ins}))
+    return {"log": await pod_action(container_name, ContainerAction.DELETE)}
 
 @router_pod.post("/restart")
 @handle_exception
-def restart_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
+async def restart_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
-    return {"log": c.container_action(container_name, ContainerAction.RESTART)}
+    return {"log": await pod_action(container_name, ContainerAction.RESTART)}
 
 @router_pod.post("/stop")
 @handle_exception
-def stop_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
+async def stop_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
-    return {"log": c.container_action(container_name, ContainerAction.STOP)}
+    return {"log": await pod_action(container_name, ContainerAction.STOP)}
 
 @router_pod.post("/start")
 @handle_exception
-def start_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
+async def start_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
-    return {"log": c.container_action(container_name, ContainerAction.START)}
+    return {"log": await pod_action(container_name, ContainerAction.START)}
 
-@router_pod.post("/commit")
+BATCH_ACTIONS = {a.value: a for a in (ContainerAction.START, ContainerAction.STOP, ContainerAction.RESTART, ContainerAction.DELETE)}
+BATCH_MAX_ITEMS = 256
+BATCH_MAX_CONCURRENCY = 16
+
+def parse_batch_items(items: str) -> list[tuple[str, str]]:
+    """ Parse `action:ins,action:ins,...` into (action, ins) pairs """
+    pairs = []
+    for item in filter(None, map(str.strip, items.split(','))):
+        action, sep, ins = item.partition(':')
+        if not sep or not ins:
+            raise InvalidInputError(f"Invalid batch item: {item}, the format should be action:ins")
+        if not action in BATCH_ACTIONS:
+            raise InvalidInputError(f"Invalid batch action: {action}, should be one of {', '.join(BATCH_ACTIONS)}")
+        pairs.append((action, ins))
+    if not pairs:
+        raise InvalidInputError("No batch items")
+    if len(pairs) > BATCH_MAX_ITEMS:
+        raise InvalidInputError(f"Too many batch items, at most {BATCH_MAX_ITEMS}")
+    return pairs
+
+@router_pod.post("/batch")
 @handle_exception
-def commit_pod(
-    ins: str, 
-    tag: Optional[str] = None, 
-    msg: Optional[str] = None,
+async def batch_pod(
+    items: str, 
+    concurrency: int = 4, 
+    logs: bool = False,
     user: UserRecord = Depends(require_permission("all"))
     ):
+    """
+    Run lifecycle actions on many pods, items are `action:ins` separated by comma,
+    the actions run with bounded concurrency, a failed item does not abort the others
+    """
+    pairs = parse_batch_items(items)
+    sem = asyncio.Semaphore(max(1, min(concurrency, BATCH_MAX_CONCURRENCY)))
+
+    async def run_item(action: str, ins: str) -> dict:
+        res: dict = {"action": action, "ins": ins}
+        try:
+            container_name = eval_name_raise(ins, user)
+            res["pod"] = container_name
+            async with sem:
+                res["log"] = await pod_action(container_name, BATCH_ACTIONS[action], with_logs=logs)
+            res["ok"] = True
+        except Exception as e:
+            http_e = http_exception_of(e)
+            res.update(ok=False, status=http_e.status_code if http_e else 500, error=http_e.detail if http_e else str(e))
+            if http_e is None:
+                get_logger('engine').exception(f"Batch action [{action}] on {ins} failed: {e}")
+        return res
+
+    results = await asyncio.gather(*(run_item(action, ins) for action, ins in pairs))
+    n_ok = sum(r["ok"] for r in results)
+    return {"ok": n_ok, "failed": len(results) - n_ok, "results": results}
+
+def commit_pod_op(ins: str, tag: Optional[str], msg: Optional[str], user: UserRecord):
     container_name = eval_name_raise(ins, user)
     cfg = config()
     c = DockerController()
@@ -152,17 +197,12 @@ def commit_pod(
     # check commit quota
     user_quota = QuotaDatabase().check_quota(user.name, use_fallback=True)
     if user_quota.commit_count != -1:
-        im_filter = ImageFilter(
-            config = cfg, 
-            raw_images=c.list_docker_images(),
-            username=user.name
-        )
-        n_user_commits = sum(im_filter.has_user_image(im) for im in im_filter.iter())
+        n_user_commits = len(get_docker_state().image_catalog().user_images(user.name))
         if n_user_commits >= user_quota.commit_count:
             raise PermissionError(f"Exceed user commit limit ({user_quota.commit_count}), please delete some images first")
 
-    # check size
-    container_size = c.inspect_container_size(container_name)
+    # check size, always the current size of this container, a cached one may be outdated
+    container_size = c.inspect_container_size(container_name, fresh=True)
     if container_size.total > user_quota.commit_size_limit:
         raise PermissionError(
             f"Container size {format_storage_size(container_size.total)} "
@@ -171,41 +211,211 @@ def commit_pod(
     commit_image_name = cfg.commit_name
     commit_tag_name = f"{user.name}" + (f"-{tag}" if tag else "")
     im_name = c.commit_container(container_name, commit_image_name, commit_tag_name, message=msg)
+    get_docker_state().refresh_images()
     return {"image_name": im_name, "log": f"Container {container_name} committed to image: {im_name}"}
 
+@router_pod.post("/commit")
+@handle_exception
+def commit_pod(
+    ins: str, 
+    tag: Optional[str] = None, 
+    msg: Optional[str] = None,
+    job: bool = False,
+    user: UserRecord = Depends(require_permission("all"))
+    ):
+    """ with job=true, return the job id right away, the result is reported by /job/status and /job/wait """
+    if job:
+        eval_name_raise(ins, user)
+        return job_response(get_job_engine().submit("commit", user.name, {"ins": ins, "tag": tag, "msg": msg}))
+    return commit_pod_op(ins, tag, msg, user)
+
 @router_pod.get("/inspect")
 @handle_exception
 def inspect_pod(ins: str, user: UserRecord = Depends(require_permission("all"))):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
     ins_name = container_name.split('-')[-1]
     return {
         "instance": ins_name,
-        **dataclasses.asdict(c.inspect_container(container_name))
+        **dataclasses.asdict(get_docker_state().inspect_container(container_name))
     }
 
+POD_INFO_FIELDS = ("instance", "username", *(f.name for f in dataclasses.fields(ContainerInfo)))
+
+@router_pod.get("/inspect-many")
+@handle_exception
+def inspect_many_pods(
+    users: Optional[str] = None,
+    status: Optional[str] = None,
+    image: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: UserRecord = Depends(require_permission("all"))
+    ):
+    """
+    Inspect many pods at once from the state cache, admin sees all containers, other users see their own pods,
+    - users: comma separated usernames (admin only)
+    - status: comma separated container status, e.g. running,exited
+    - image: image name, a name without tag matches all tags of the image
+    - fields: comma separated fields of each record, all fields by default
+    """
+    name_parser = config().name_parser
+    if users is not None and not user.is_admin:
+        raise InsufficientPermissionsError("Only admin can inspect pods of other users")
+    user_set = set(filter(None, users.split(','))) if users is not None else None
+    status_set = set(filter(None, status.split(','))) if status is not None else None
+    field_list = list(filter(None, fields.split(','))) if fields is not None else list(POD_INFO_FIELDS)
+    if (unknown := [f for f in field_list if not f in POD_INFO_FIELDS]):
+        raise InvalidInputError(f"Unknown fields: {', '.join(unknown)}, should be in {', '.join(POD_INFO_FIELDS)}")
+
+    filter_name = "" if user.is_admin else name_parser.user_prefix(user.name)
+    ret = []
+    for info in get_docker_state().inspect_containers(filter_name):
+        name_sp = name_parser.split(info.name, check=True)
+        if not user.is_admin and (name_sp is None or name_sp['username'] != user.name):
+            continue
+        if user_set is not None and (name_sp is None or not name_sp['username'] in user_set):
+            continue
+        if status_set is not None and not info.status in status_set:
+            continue
+        if image is not None and not (info.image == image or (not ':' in image and info.image.split(':')[0] == image)):
+            continue
+        record = {
+            "instance": name_sp['instance'] if name_sp else None,
+            "username": name_sp['username'] if name_sp else None,
+            **dataclasses.asdict(info),
+        }
+        ret.append({f: record[f] for f in field_list})
+    return ret
+
 @router_pod.get("/list")
 @handle_exception
 def list_pod(user: UserRecord = Depends(require_permission("all"))):
-    c = DockerController()
-    return [x.split('-')[-1] for x in c.list_docker_containers(get_user_pod_prefix(user.name))]
+    state = get_docker_state()
+    return [x.split('-')[-1] for x in state.list_containers(get_user_pod_prefix(user.name))]
 
 @router_pod.post("/exec")
 @handle_exception
-def exec_pod(
+async def exec_pod(
     ins: str, cmd: str, timeout: Optional[int] = None,
     user: UserRecord = Depends(require_permission("all"))
     ):
     container_name = eval_name_raise(ins, user)
-    c = DockerController()
     if timeout is None:
         timeout = 30
-    exit_code, log = c.exec_container_bash(container_name, cmd, timeout=timeout)
+    fut = get_exec_engine().submit(container_name, cmd, timeout=timeout, user=user.name)
+    exit_code, log = await asyncio.wrap_future(fut)
     return {"exit_code": exit_code, "log": log}
 
+@router_pod.post("/exec-stream")
+@handle_exception
+async def exec_pod_stream(
+    ins: str, cmd: str, timeout: Optional[int] = None,
+    user: UserRecord = Depends(require_permission("all"))
+    ):
+    """
+    Stream the output as newline-delimited json frames: {"stream": "stdout" | "stderr", "data": ...}, 
+    the last frame is the trailer: {"exit_code": ..., "error"?: ...}
+    """
+    container_name = eval_name_raise(ins, user)
+    # off the event loop, the state cache may still be listing after startup
+    await run_in_threadpool(lambda: get_docker_state().check_container_raise(container_name))
+    if timeout is None:
+        timeout = 30
+
+    frames = get_exec_engine().stream_frames(container_name, cmd, timeout=timeout, user=user.name)
+    async def iter_frames():
+        try:
+            async for frame in frames:
+                yield json.dumps(frame) + "\n"
+        finally:
+            await frames.aclose()     # aborts the exec if the client disconnected
+
+    return StreamingResponse(iter_frames(), media_type="application/x-ndjson")
+
+LOG_MAX_BYTES = 16 * 1024 * 1024
+
+def parse_log_time(s: str) -> float:
+    """ Epoch seconds, or a duration before now, e.g. 30s, 10m, 2h, 7d """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    s = s.strip().lower()
+    try:
+        if s[-1:] in units:
+            return time.time() - float(s[:-1]) * units[s[-1]]
+        return float(s)
+    except ValueError:
+        raise InvalidInputError(f"Invalid time: {s}, should be epoch seconds or a duration like 30s, 10m, 2h, 7d")
+
+@router_pod.get("/logs")
+@handle_exception
+async def logs_pod(
+    ins: str,
+    tail: int = 100,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    max_bytes: int = 1024 * 1024,
+    timestamps: bool = False,
+    follow: bool = False,
+    user: UserRecord = Depends(require_permission("all"))
+    ):
+    """
+    The container log of the pod,
+    - tail: number of lines from the end, -1 for all
+    - since / until: epoch seconds or a duration before now, e.g. 10m
+    - max_bytes: the log is cut to this many bytes from the end (at a line boundary)
+    - timestamps: prefix each line with its RFC3339 timestamp, e.g. to page backwards with `until`
+    - follow: stream newline-delimited json frames {"stream": "stdout" | "stderr", "data": ...} 
+        until the container stops, `until` and `max_bytes` are ignored
+    """
+    container_name = eval_name_raise(ins, user)
+    # off the event loop, the state cache may still be listing after startup
+    await run_in_threadpool(lambda: get_docker_state().check_container_raise(container_name))
+    t_since = parse_log_time(since) if since else None
+    t_until = parse_log_time(until) if until else None
+    docker_c = get_async_docker()
+
+    if not follow:
+        if not 0 < max_bytes <= LOG_MAX_BYTES:
+            raise InvalidInputError(f"max_bytes should be between 1 and {LOG_MAX_BYTES}")
+        raw, truncated = await docker_c.logs_tail(
+            container_name, max_bytes, tail=tail, since=t_since, until=t_until, timestamps=timestamps
+            )
+        if truncated:
+            raw = raw[raw.find(b"\n") + 1:] if b"\n" in raw else raw
+        return {"log": raw.decode(errors='replace'), "truncated": truncated}
+
+    async def iter_frames():
+        decoders = {s: codecs.getincrementaldecoder('utf-8')(errors='replace') for s in ("stdout", "stderr")}
+        async for stream, data in docker_c.follow_logs(container_name, tail=tail, since=t_since, timestamps=timestamps):
+            if (text := decoders[stream].decode(data)):
+                yield json.dumps({"stream": stream, "data": text}) + "\n"
+        for stream, decoder in decoders.items():
+            if (text := decoder.decode(b"", final=True)):
+                yield json.dumps({"stream": stream, "data": text}) + "\n"
+    return StreamingResponse(iter_frames(), media_type="application/x-ndjson")
+
+# ====== jobs ======
+def job_response(record: JobRecord) -> dict:
+    return {"job_id": record.id, "kind": record.kind, "status": record.status}
+
+def pod_job_handler(op: typing.Callable[..., dict]) -> JobHandler:
+    """ Run the pod operation as the user of the job, errors carry the HTTP status of the route """
+    def handler(job: JobRecord):
+        user = UserDatabase().get_user(job.username)
+        if user.userid == 0:
+            raise JobError(f"User {job.username} not found", 404)
+        try:
+            return op(**job.params, user=user)
+        except Exception as e:
+            if (http_e := http_exception_of(e)) is not None:
+                raise JobError(http_e.detail, http_e.status_code) from e
+            raise
+    return handler
+
 # ====== admin only ======
 @router_pod.get("/listall")
 @handle_exception
 def listall_pod(_: UserRecord = Depends(require_permission("admin"))):
-    c = DockerController()
-    return c.list_docker_containers("")
+    return get_docker_state().list_containers("")
+
+register_job_handler("create", pod_job_handler(create_pod_op))
+register_job_handler("commit", pod_job_handler(commit_pod_op))
+register_job_handler("delete", pod_job_handler(delete_pod_op))
@@ -8,7 +8,7 @@ from typing import Optional
 
 from ..eng.errors import *
 from ..eng.user import UserRecord
-from ..eng.resmon import ResourceMonitorDatabase
+from ..eng.resmon import ResourceMonitorDatabase, StatGroupBy
 
 router_stat = APIRouter(prefix="/stat")
 
@@ -33,7 +33,10 @@ def parse_time(time_str: str) -> Optional[float]:
     
 @router_stat.get("/cputime")
 @handle_exception
-def cputime(_: UserRecord = Depends(require_permission("all")), user: Optional[str] = None, t: Optional[str] = None):
+def cputime(
+    _: UserRecord = Depends(require_permission("all")), 
+    user: Optional[str] = None, t: Optional[str] = None, group_by: StatGroupBy = 'user'
+    ):
     resmon_db = ResourceMonitorDatabase()
 
     ft = parse_time(t) if t else None
@@ -43,13 +46,16 @@ def cputime(_: UserRecord = Depends(require_permission("all")), user: Optional[s
         after = 0
 
     if user is None:
-        return resmon_db.query_cputime(after=after)
+        return resmon_db.query_cputime(after=after, group_by=group_by)
     else:
-        return resmon_db.query_cputime(*user.split(","), after=after)
+        return resmon_db.query_cputime(*user.split(","), after=after, group_by=group_by)
 
 @router_stat.get("/gputime")
 @handle_exception
-def gputime(_: UserRecord = Depends(require_permission("all")), user: Optional[str] = None, t: Optional[str] = None):
+def gputime(
+    _: UserRecord = Depends(require_permission("all")), 
+    user: Optional[str] = None, t: Optional[str] = None, group_by: StatGroupBy = 'user'
+    ):
     resmon_db = ResourceMonitorDatabase()
 
     ft = parse_time(t) if t else None
@@ -59,6 +65,6 @@ def gputime(_: UserRecord = Depends(require_permission("all")), user: Optional[s
         after = 0
 
     if user is None:
-        return resmon_db.query_gputime(after=after)
+        return resmon_db.query_gputime(after=after, group_by=group_by)
     else:
-        return resmon_db.query_gputime(*user.split(","), after=after)
\ No newline at end of file
+        return resmon_db.query_gputime(*user.split(","), after=after, group_by=group_by)
\ No newline at end of file
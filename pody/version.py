@@ -99,6 +99,33 @@ VERSION_HISTORY = {
         "Allow user resource cleanup even when user deletion failed",
         "Remove `user_api` routes from help",
         "Fix user auth async blocking issue",
+    ], 
+    "0.4.2": [
+        "Resolve process containers with a per-sweep container index",
+        "Keep a persistent NVML session, sample all GPUs in one batched snapshot",
+        "Serve pod and image listing from an event-driven docker state cache",
+        "Run blocking route handlers in thread pool, add async docker engine for pod lifecycle actions",
+        "Allocate pod ports from a persistent reservation table, safe for concurrent creates",
+        "Query container sizes from docker API in batches with a TTL cache, exact byte counts for commit size check",
+        "Run pod exec on a shared thread-pooled exec engine with socket deadlines and per-user concurrency limit",
+        "Add /pod/exec-stream and `pody exec` to stream command output incrementally",
+        "Upsert resource usage records with a unique process index, one transaction per sweep",
+        "Hourly and daily usage rollups for /stat, count usage within the time range, add group_by option",
+        "Cache authenticated credentials with TTL and negative caching, index user credentials",
+        "Share one WAL-mode SQLite connection per database per process, run schema setup once",
+        "Log records go through one bounded queue to a single writer thread with a persistent connection, order preserved",
+        "Log databases are indexed by time and level, pruned by whole days with the new [log] config, pody-log gets --since/--until/--grep, keyset pages and tail -f",
+        "Add /metrics in the Prometheus text format, with request, docker call, GPU sampling, daemon task and SQLite latency; the console access log is sampled by log.access_log_sample",
+        "Periodic tasks run in one scheduler process at fixed rates with jitter, overrunning ticks are skipped, intervals in [daemon], stats at /host/daemon-stats",
+        "GPU quota enforcement every 5s on whole containers: warn, SIGTERM after a grace period, then SIGKILL; decisions are recorded and listed at /host/gpu-enforcement",
+        "Configuration is reloaded when config.toml changes instead of every 5s, snapshots are immutable with prebuilt port ranges, image matcher and pod name parser",
+        "Image routes and commit quota checks use an image catalog indexed by name and by user, rebuilt only when the images or the configuration change",
+        "PodyAPI keeps a pooled keep-alive session with retries, the /help route table is cached on disk and revalidated with ETag",
+        "Add /pod/batch and pody batch to run start / stop / restart / delete on many pods in one request with bounded concurrency",
+        "Add /pod/inspect-many to inspect many pods from the state cache in one call, with filters and field projection",
+        "Lifecycle actions return only the last 100 log lines, add /pod/logs with tail / since / until / byte limit / follow and pody logs -f",
+        "Pod create, commit and delete can run as persistent background jobs with job=true, add /job/status, /job/wait and /job/list",
+        "Optional warm pool of pre-created pods per image (images.warm_pool), claimed by pod creation and refilled by the daemon",
     ]
 }
 